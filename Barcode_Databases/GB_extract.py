@@ -15,6 +15,10 @@ from Bio.SeqRecord import SeqRecord
 import pandas as pd
 import os
 import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+import ref_index
+import taxid_cache
+import telemetry
 
 
 # # Parameters
@@ -106,6 +110,14 @@ def get_qualifier(feature, attribute):
         return None 
 
 
+# NCBI TaxID of a source feature, from its taxon: db_xref (records can have BOLD: or other db_xref first)
+def get_taxid(feature):
+    for ixref in feature.qualifiers.get('db_xref', []):
+        if ixref.startswith('taxon:'):
+            return ixref.replace('taxon:','')
+    return None
+
+
 # In[58]:
 
 
@@ -122,6 +134,7 @@ print(count)
 
 # %%time
 print('reading genbank_file',end='...')
+span = telemetry.start('gb_parse', barcode=ref)
 rec_ls = []; rec_rm=[]; rec_count=0
 for record in SeqIO.parse(gb_file, "genbank"):
     rec_count += 1
@@ -143,11 +156,12 @@ for record in SeqIO.parse(gb_file, "genbank"):
                         if (feature.type == "source"):
                             seq_dic['sci_name'] = get_qualifier(feature, 'organism')
                             seq_dic['mol_type'] = get_qualifier(feature, 'mol_type')
-                            seq_dic['TaxID'] = get_qualifier(feature, 'db_xref').replace('taxon:','')
+                            seq_dic['TaxID'] = get_taxid(feature)
                     rec_ls.append(seq_dic)      
                 else:
                     rec_rm.append(seq_dic)
 print('read',rec_count,'accessions')
+span.end(rows_in=rec_count, rows_out=len(rec_ls), bytes_read=os.path.getsize(gb_file))
 
 
 # In[60]:
@@ -173,6 +187,8 @@ rec_df.Len.hist(bins=100);
 # In[62]:
 
 
+span = telemetry.start('gb_filter', barcode=ref)
+rows_in = rec_df.shape[0]
 rec_df['rN'] = rec_df.Nn/rec_df.Len
 print('Removing',rec_df[rec_df.rN>=max_N].shape[0],'accessions with too many Ns')
 print(rec_df.shape[0],end=' > ')
@@ -186,6 +202,7 @@ print('Removing',rec_df[rec_df.Len>max_len].shape[0],'accessions too long')
 print(rec_df.shape[0],end=' > ')
 rec_df = rec_df[rec_df.Len<=max_len]
 print(rec_df.shape[0])
+span.end(rows_in=rows_in, rows_out=rec_df.shape[0])
 
 
 # In[63]:
@@ -199,23 +216,55 @@ for char in rm_char:
 # In[64]:
 
 
-print('sending',rec_df.sci_name.nunique(),'species names to WCVP_taxo')
-rec_df.groupby('sci_name').head(1).sci_name.to_csv(gb_file.replace('.gb','_NCBI.csv'),index=False)
+# TaxIDs already resolved with this WCVP release and options are taken from the TaxID cache (taxid_cache.py),
+# only the names of new TaxIDs, and of records without TaxID, are sent to WCVP_taxo
+wcvp_file = 'wcvp_v5_jun_2021.txt'
+wcvp_opts = '-g -s similarity_genus -d divert_genusOK'
+taxid_wcvp = taxid_cache.TaxidCache(taxid_cache.wcvp_release(wcvp_file), wcvp_opts)
+has_taxid = rec_df.TaxID.notnull()
+new_taxids = taxid_wcvp.missing(rec_df.TaxID[has_taxid])
+new_df = rec_df[rec_df.TaxID.isin(new_taxids) | ~has_taxid]
+print(rec_df.TaxID.nunique() - len(new_taxids),'TaxIDs in cache',taxid_wcvp.path,', sending',new_df.sci_name.nunique(),
+      'species names of',len(new_taxids),'new TaxIDs and',(~has_taxid).sum(),'records without TaxID to WCVP_taxo')
+new_df.groupby('sci_name').head(1).sci_name.to_csv(gb_file.replace('.gb','_NCBI.csv'),index=False)
 
 
 # In[65]:
 
 
-print('running wcvp_taxo',end='...')
-# print(os.system('python ../../PAFTOL_DB/wcvp_taxo.py ../../PAFTOL_DB/wcvp_v5_jun_2021.txt ' + \
-#           gb_file.replace('.gb','_NCBI.csv') + ' -g -s similarity_genus -d divert_genusOK'))
-print(os.system('python wcvp_taxo.py wcvp_v5_jun_2021.txt ' +           gb_file.replace('.gb','_NCBI.csv') + ' -g -s similarity_genus -d divert_genusOK'))
-wcvp = pd.read_csv(gb_file.replace('.gb','_NCBI_wcvp.csv'))
-wcvp = wcvp[wcvp.sci_name.notnull()]
-print('found',wcvp.sci_name.nunique(),'species in WCVP')
+span = telemetry.start('gb_wcvp', barcode=ref)
+rows_in = rec_df.shape[0]
+resolved = pd.DataFrame(columns=['Ini_sci_name','sci_name'])
+if new_df.shape[0] > 0:
+    print('running wcvp_taxo',end='...')
+    # print(os.system('python ../../PAFTOL_DB/wcvp_taxo.py ../../PAFTOL_DB/wcvp_v5_jun_2021.txt ' + \
+    #           gb_file.replace('.gb','_NCBI.csv') + ' -g -s similarity_genus -d divert_genusOK'))
+    # WCVP lookup service (wcvp_server.py, started with the same WCVP file) if WCVP_SOCKET is set, so that
+    # concurrent extractions share one WCVP
+    if os.environ.get('WCVP_SOCKET', '') != '':
+        wcvp_cmd = 'python wcvp_client.py --socket ' + os.environ['WCVP_SOCKET'] + ' '
+    else:
+        wcvp_cmd = 'python wcvp_taxo.py ' + wcvp_file + ' '
+    if os.path.isfile(gb_file.replace('.gb','_NCBI_wcvp.csv')):
+        os.remove(gb_file.replace('.gb','_NCBI_wcvp.csv'))
+    print(os.system(wcvp_cmd + gb_file.replace('.gb','_NCBI.csv') + ' ' + wcvp_opts))
+    if os.path.isfile(gb_file.replace('.gb','_NCBI_wcvp.csv')):
+        resolved = pd.read_csv(gb_file.replace('.gb','_NCBI_wcvp.csv'))
+        taxid_wcvp.add(new_df[new_df.TaxID.isin(new_taxids)], resolved)
+        taxid_wcvp.save()
+    else:
+        print('no output of wcvp_taxo, new TaxIDs not cached')
+# Records with a TaxID take the resolution of their TaxID, records without TaxID that of their name
+wcvp = taxid_wcvp.lookup(rec_df.TaxID)
+wcvp_names = resolved[resolved.sci_name.notnull()].drop_duplicates('Ini_sci_name')
+print('found',pd.concat([wcvp.sci_name, wcvp_names.sci_name]).nunique(),'species in WCVP')
 print(rec_df.shape[0],end=' > ')
-rec_df = pd.merge(rec_df.rename(columns={'sci_name':'Ini_sci_name'}),wcvp,how='inner',on='Ini_sci_name')
+rec_df = rec_df.rename(columns={'sci_name':'Ini_sci_name'})
+rec_df = pd.concat([pd.merge(rec_df[has_taxid],wcvp,how='inner',on='TaxID'),
+                    pd.merge(rec_df[~has_taxid],wcvp_names.drop(columns=['TaxID'],errors='ignore'),how='inner',
+                             on='Ini_sci_name')], ignore_index=True)
 print(rec_df.shape[0])
+span.end(rows_in=rows_in, rows_out=rec_df.shape[0])
 
 
 # In[66]:
@@ -246,6 +295,7 @@ print('f:',rec_df.family.nunique(),'g:',rec_df.genus.nunique(),'s:',rec_df.sci_n
 # In[69]:
 
 
+span = telemetry.start('gb_write', barcode=ref)
 types = list(rec_df.type.unique())
 print(rec_df.groupby('type').size().to_dict())
 rec_fasta=[]
@@ -258,6 +308,9 @@ SeqIO.write(rec_fasta,gb_file.replace('.gb','.fasta'),format='fasta')
 rec_df[['Locus','gene','mol_type', 'Len',
           'sci_name', 'kew_id','family', 'genus', 'species', 'infraspecies', 'Duplicates',
           'Ini_sci_name', 'TaxID']].to_csv(gb_file.replace('.gb','_TAXO.csv'),index=False)
+# faidx index and taxonomy sidecar, for lookups by Locus
+ref_index.build_index(gb_file.replace('.gb','.fasta'))
+span.end(rows_out=len(rec_fasta), bytes_written=os.path.getsize(gb_file.replace('.gb','.fasta')))
 
 
 # In[70]:
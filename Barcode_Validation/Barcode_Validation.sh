@@ -14,15 +14,27 @@
 
 ### Command ###
 # ./Barcode_Validation.sh 2021-07-27_paftol_export.csv 'OneKP'
+# Batched mode, one blastn run per barcode database for every 200 samples:
+# ./Barcode_Validation.sh 2021-07-27_paftol_export.csv 'OneKP' 200
+# Without SLURM, tasks run in a local process pool (job_runner.py):
+# backend=local ./Barcode_Validation.sh 2021-07-27_paftol_export.csv 'OneKP'
 
 source activate py36
 slurmThrottle=10
+# slurm or local
+backend=${backend:-slurm}
+# Stage spans of all tasks of this run are tagged with the same run id, and recorded in run_log.jsonl of each
+# working directory (Pipeline_Utils/telemetry.py)
+export TELEMETRY_RUN=${TELEMETRY_RUN:-$(date +%Y%m%d-%H%M%S)}
+export TELEMETRY_LOG=${TELEMETRY_LOG:-run_log.jsonl}
 
 ### Inputs:
 # latest paftol_export. Needs the following fields : idSequencing, idPaftol, DataSource, Family, Genus, Species
 paftol_export=$1
 # DataSource: PAFTOL, SRA, GAP, OneKP, AG, UG
 DataSource=$2
+# Optional: number of samples per batch (batched mode)
+batch_size=$3
 if [[ $DataSource == OneKP || $DataSource == AG || $DataSource == UG ]]
 then
 type="contigs"
@@ -40,11 +52,21 @@ mkdir -p $DataSource/out_blast
 mkdir -p $DataSource/Barcode_Validation
 
 ### List samples to blast by DataSource. 
-# Samples with existing validation cards will be omitted
-python Make_samples_list.py --db $paftol_export --DataSource $DataSource
+# Samples with existing validation cards will be omitted, unless their query fasta, barcode database or test parameters changed
+python Make_samples_list.py --db $paftol_export --DataSource $DataSource --barcodes_table Barcode_DB/Barcode_Tests.csv --type $type
 
-Nsamples=($(wc -l $DataSource/'Samples_to_barcode.txt'))
+### Plan blast searches. Samples are only blasted on databases containing their genus or family
+python Plan_blast_jobs.py --DataSource $DataSource --type $type --barcodes_table Barcode_DB/Barcode_Tests.csv
+
+Nsamples=($(wc -l $DataSource/'Samples_to_blast.txt'))
 echo "blast $Nsamples samples on barcode databases" 
-if (( $Nsamples > 0 )); then
-	sbatch -p short --array=1-${Nsamples}%$slurmThrottle Blast_on_barcodes.sh $DataSource $type
+if (( $Nsamples > 0 )) && [ -z "$batch_size" ]; then
+	python ../Pipeline_Utils/job_runner.py --backend $backend --tasks $DataSource/Samples_to_blast.txt --throttle $slurmThrottle --run $TELEMETRY_RUN \
+		--cpus 4 --mem 8000 "--sbatch_args=-p short" --script Blast_on_barcodes.sh --script_args $DataSource $type
+elif (( $Nsamples > 0 )); then
+	Nbatches=$(( (Nsamples + batch_size - 1) / batch_size ))
+	echo "blast in $Nbatches batches of $batch_size samples"
+	seq -f "batch_%g" 1 $Nbatches > $DataSource/Batches.txt
+	python ../Pipeline_Utils/job_runner.py --backend $backend --tasks $DataSource/Batches.txt --throttle $slurmThrottle --run $TELEMETRY_RUN \
+		--cpus 16 --mem 32000 --script Blast_batch.sh --script_args $DataSource $type $batch_size
 fi
\ No newline at end of file
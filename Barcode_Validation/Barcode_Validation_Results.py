@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # Barcode Validation Results
+# Headless version of Barcode_Validation_Results_v1.5.ipynb.
+# Classifies each barcode test of the validation cards (Pass both, Pass pid, Pass bitscore, Fail rank, Fail match,
+# Not in DB, No Blast match), counts tests per sample (NVfam, VATfam, Vfam_pc, ...) and decides the barcode validation
+# of each sample (Confirmed, Rejected, Inconclusive) with min_test, min_test_invalid and max_rank.
+# PDF figures and Excel tables are optional.
+#
+# Validation cards are collected from <DataSource>/Barcode_Validation/ in the current directory (or --cards_dir), as in
+# the notebook, and outputs are written next to the samples file.
+#
+# python Barcode_Validation_Results.py --samples_file Release_1.5/R1.5_samples.csv --collect
+# python Barcode_Validation_Results.py --samples_file Release_1.5/R1.5_samples.csv --excel --pdf
+
+# In[1]:
+
+
+import pandas as pd
+import numpy as np
+import os
+import sys
+import argparse
+
+
+# ## Parameters
+
+# In[2]:
+
+
+taxo_ranks=['genus','family']
+min_test = 1
+min_test_invalid = 2
+max_rank = 1
+pass_cat=['Pass both','Pass pid','Pass bitscore']
+fail_cat = ['Fail rank','Fail match']
+rank_suffix = {'family':'fam','genus':'gen'}
+cards_file = 'All_barcode_validation_data.csv'
+
+
+# ## Functions
+
+# In[3]:
+
+
+def load_samples(samples_file):
+    samples_df = pd.read_csv(samples_file).rename(columns={'Order':'order','Family':'family','Genus':'genus','Species':'species'})
+    samples_df.DataSource = samples_df.DataSource.replace({'Annotated genome':'AG','Unannotated genome':'UG'})
+    if 'Sample' not in samples_df.columns:
+        samples_df['Sample'] = samples_df['ExternalSequenceID']
+        is_paftol = samples_df.DataSource=='PAFTOL'
+        samples_df.loc[is_paftol,'Sample'] = \
+            'PAFTOL_' + samples_df.loc[is_paftol,'idSequencing'].astype(int).astype('str').str.zfill(6)
+    col_samples = [icol for icol in ['Sample','idSequencing','DataSource','order','family','genus','species']
+                   if icol in samples_df.columns]
+    return samples_df[col_samples]
+
+
+# In[4]:
+
+
+# Consolidate validation cards (<cards_dir><DataSource>/Barcode_Validation/BV_<Sample>.csv) in one table,
+# None if no card is found
+def collect_cards(samples_df, cards_dir=''):
+    list_ = []
+    card_paths = cards_dir + samples_df.DataSource + '/Barcode_Validation/BV_' + samples_df.Sample + '.csv'
+    samples_df['Validation_file'] = card_paths.apply(os.path.isfile)
+    for isample, path_sr in zip(samples_df.Sample[samples_df.Validation_file], card_paths[samples_df.Validation_file]):
+        sample_validation = pd.read_csv(path_sr); sample_validation.insert(loc=0, column='Sample', value=isample)
+        list_.append(sample_validation)
+    print((samples_df.Validation_file==False).sum(),'barcode validation files missing:',
+          list(samples_df[samples_df.Validation_file==False].Sample))
+    if len(list_) == 0:
+        return None
+    return pd.concat(list_,ignore_index=True)
+
+
+# In[5]:
+
+
+# Category of each barcode test
+def classify_tests(results_df, max_rank=max_rank):
+    in_db = results_df.taxo_in_db==True
+    has_match = in_db & (results_df.Nmatch>0)
+    match = has_match & (results_df.match==True)
+    pass_pid = results_df.rank_pid<=max_rank
+    pass_bsc = results_df.rank_bsc<=max_rank
+    conditions = [(results_df.taxo_in_db.isna() | in_db) & (results_df.Nmatch==0),
+                  results_df.taxo_in_db==False,
+                  match & ~pass_pid & ~pass_bsc,
+                  has_match & (results_df.match==False),
+                  match & ~pass_pid & pass_bsc,
+                  match & pass_pid & ~pass_bsc,
+                  match & pass_pid & pass_bsc]
+    choices = ['No Blast match','Not in DB','Fail rank','Fail match','Pass bitscore','Pass pid','Pass both']
+    results_df['Validation'] = np.select(conditions, choices, default=None)
+    return results_df
+
+
+# In[6]:
+
+
+def get_test_stats(results_df):
+    return results_df.groupby(['Test','tax_level','Validation']).size().unstack().fillna(0).reset_index()
+
+
+def get_gene_stats(results_df):
+    return results_df.groupby(['tax_level','Test'])['taxo_in_db'].sum().to_frame().reset_index()
+
+
+# In[7]:
+
+
+# Number of tests (NV), passed tests (VAT), % passed and most frequent wrong taxon per sample, for family and genus
+def summarize_samples(samples_df, results_df):
+    samples_results = samples_df.copy()
+    tested = results_df[results_df.Validation.isin(pass_cat + fail_cat)]
+    tested = tested.assign(Passed=tested.Validation.isin(pass_cat))
+    counts = tested.groupby(['Sample','tax_level']).Passed.agg(['size','sum']).unstack()
+    for icount, iname in [('size','NV'),('sum','VAT')]:
+        for itax in ['family','genus']:
+            isuffix = rank_suffix[itax]
+            if (icount, itax) in counts.columns:
+                samples_results[iname + isuffix] = samples_results.Sample.map(counts[(icount, itax)])
+            else:
+                samples_results[iname + isuffix] = np.nan
+            samples_results[iname + isuffix] = samples_results[iname + isuffix].fillna(0).astype(int)
+    for itax in ['family','genus']:
+        isuffix = rank_suffix[itax]
+        samples_results['V' + isuffix + '_pc'] = round(samples_results['VAT' + isuffix]/samples_results['NV' + isuffix]*100,0)
+
+    ### Best matching taxo for failed tests
+    for itax in ['family','genus']:
+        wrong_df = results_df[(results_df.tax_level==itax) & (results_df.Validation.isin(fail_cat))]
+        wrong_df = wrong_df.groupby(['Sample','best']).size().sort_values(ascending=False).to_frame().reset_index()\
+                .rename(columns={'best':'best matching ' + itax, 0:'N best ' + itax}).groupby('Sample').head(1)
+        samples_results = pd.merge(samples_results, wrong_df, how='left', on='Sample')
+    return samples_results
+
+
+# In[8]:
+
+
+# Confirmed if at least min_test passed tests, Rejected if at least min_test_invalid tests agree on the same wrong taxon,
+# Inconclusive if both, or otherwise
+def decide(samples_results, min_test=min_test, min_test_invalid=min_test_invalid):
+    for itax, icol in [('family','Validation'),('genus','Validation_genus')]:
+        isuffix = rank_suffix[itax]
+        confirmed = samples_results['VAT' + isuffix]>=min_test
+        rejected = samples_results['N best ' + itax]>=min_test_invalid
+        samples_results[icol] = np.select([(samples_results['V' + isuffix + '_pc']>0) & rejected, rejected, confirmed],
+                                          ['Inconclusive','Rejected','Confirmed'], default='Inconclusive')
+    return samples_results
+
+
+# In[9]:
+
+
+def write_pdf(pdf_path, stats_tests, samples_results, gene_stats, min_test=min_test):
+    import seaborn as sns
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt; from matplotlib.backends.backend_pdf import PdfPages
+    plt.rcParams['figure.figsize'] = [10, 6]
+    plt.rcParams['figure.dpi'] = 200
+    colors = ['r', 'orange', 'grey', 'lightgrey', 'LightGreen', 'green', '#2CA02C']
+    pp = PdfPages(pdf_path)
+    for itax in ['genus','family']:
+        ax = stats_tests[stats_tests['tax_level']==itax].drop(columns='tax_level').set_index(['Test'])\
+            .plot.barh(stacked=True, color=colors)
+        ax.set_title('Tests at ' + itax + ' level'); ax.set_ylabel('Barcodes'); ax.set_xlabel('# Samples')
+        ax.legend(bbox_to_anchor=(1.04,0.5), loc="center left")
+        pp.savefig(bbox_inches='tight'); plt.close()
+    ax = stats_tests.set_index(['Test','tax_level']).plot.barh(stacked=True, color=colors)
+    ax.set_title('Validation by taxonomic level and test'); ax.set_ylabel('Barcodes'); ax.set_xlabel('# Samples')
+    ax.legend(bbox_to_anchor=(1.04,0.5), loc="center left")
+    pp.savefig(bbox_inches='tight'); plt.close()
+    all_val = pd.concat([samples_results.groupby('VAT' + rank_suffix[itax]).size().rename(itax) for itax in ['family','genus']],
+                        axis=1).T
+    ax2 = all_val.plot.barh(stacked=True, colormap='RdBu')
+    ax2.legend(bbox_to_anchor=(1.04,0.5), loc="center left")
+    ax2.set_title('Sum of passed tests (min ' + str(min_test) + ' test)'); ax2.set_xlabel('# Samples')
+    pp.savefig(bbox_inches='tight'); plt.close()
+    for itax in ['genus','family']:
+        sns.histplot(samples_results['V' + rank_suffix[itax] + '_pc'], kde=False, bins=20, color='k')
+        plt.title("% of tests passed at " + itax + " level"); plt.ylabel("Count"); plt.xlabel("%")
+        pp.savefig(bbox_inches='tight'); plt.close()
+    g = sns.barplot(data=gene_stats, x="taxo_in_db", y="Test", hue="tax_level")
+    g.set_title("Samples in Reference DBs")
+    pp.savefig(bbox_inches='tight'); plt.close()
+    pp.close()
+
+
+# In[10]:
+
+
+def write_excel(excel_path, samples_results, stats_tests, gene_stats, min_test_invalid=min_test_invalid):
+    writer = pd.ExcelWriter(excel_path, engine='xlsxwriter')
+    samples_results.to_excel(writer, sheet_name='Validation_Results',index=False)
+    samples_results[samples_results['N best family']>=min_test_invalid].to_excel(writer, sheet_name='Wrong_family',index=False)
+    samples_results[samples_results['N best genus']>=min_test_invalid].to_excel(writer, sheet_name='Wrong_genus',index=False)
+    stats_tests.to_excel(writer, sheet_name='Test_stats',index=False)
+    gene_stats.to_excel(writer, sheet_name='BarcodeDB_stats',index=False)
+    writer.close()
+
+
+# ## Main
+
+# In[11]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Barcode validation decisions from validation cards')
+    parser.add_argument("--samples_file", type=str, help="spreadsheet of samples with DataSource and taxonomy")
+    parser.add_argument("--cards", type=str, default=None,
+                        help="consolidated validation cards, default All_barcode_validation_data.csv next to samples_file")
+    parser.add_argument("--collect", action="store_true", default=False,
+                        help="consolidate validation cards from <DataSource>/Barcode_Validation/ first")
+    parser.add_argument("--cards_dir", type=str, default='',
+                        help="collect: directory of the DataSource folders, default current directory")
+    parser.add_argument("--min_test", type=int, default=min_test)
+    parser.add_argument("--min_test_invalid", type=int, default=min_test_invalid)
+    parser.add_argument("--max_rank", type=int, default=max_rank)
+    parser.add_argument("--pdf", action="store_true", default=False, help="write figures in a pdf")
+    parser.add_argument("--excel", action="store_true", default=False, help="write tables in an Excel file")
+    args = parser.parse_args()
+
+    wdir = os.path.dirname(os.path.abspath(args.samples_file)) + '/'
+    project = os.path.basename(os.path.normpath(wdir))
+    path_cards = args.cards if args.cards is not None else wdir + cards_file
+    samples_df = load_samples(args.samples_file)
+    print(samples_df.shape[0],samples_df.Sample.nunique(),samples_df.groupby('DataSource').size().to_dict())
+
+    if args.collect:
+        cards_dir = os.path.join(args.cards_dir, '') if args.cards_dir != '' else ''
+        results_df = collect_cards(samples_df, cards_dir)
+        if results_df is None:
+            print('no validation cards found in', os.path.abspath(cards_dir) + '/<DataSource>/Barcode_Validation/')
+            sys.exit(1)
+        results_df.to_csv(path_cards,index=False)
+    else:
+        results_df = pd.read_csv(path_cards)
+    print(results_df.shape[0],'tests,',results_df.Sample.nunique(),'samples,',results_df.Test.nunique(),'barcodes')
+
+    ## Tests
+    results_df = classify_tests(results_df, max_rank=args.max_rank)
+    print(results_df.Validation.isna().sum(),'NA')
+    stats_tests = get_test_stats(results_df)
+    stats_tests.to_csv(wdir + project + '_Test_stats.csv',index=False)
+    gene_stats = get_gene_stats(results_df)
+    gene_stats.to_csv(wdir + project + '_BarcodeDB_stats.csv',index=False)
+
+    ## Samples
+    samples_results = summarize_samples(samples_df.drop(columns='Validation_file', errors='ignore'), results_df)
+    samples_results = decide(samples_results, min_test=args.min_test, min_test_invalid=args.min_test_invalid)
+    print(samples_results.groupby(['Validation']).size().to_dict())
+    print(samples_results.groupby(['DataSource','Validation']).size().to_dict())
+    samples_results.to_csv(wdir + project + '_Barcode_Validation.csv',index=False)
+
+    if args.pdf:
+        write_pdf(wdir + project + '_Barcoding_Validation.pdf', stats_tests, samples_results, gene_stats,
+                  min_test=args.min_test)
+    if args.excel:
+        write_excel(wdir + project + '_Barcode_Validation.xlsx', samples_results, stats_tests, gene_stats,
+                    min_test_invalid=args.min_test_invalid)
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # Benchmark of the barcode validation
+# Measures the throughput of the validation path without a cluster or real data.
+# For each size (number of samples), a synthetic dataset is generated once in <bench_dir>/n<size>/:
+# - Barcode_DB/: the barcode tests of Barcode_Tests.csv, each with a reference fasta and _TAXO.csv of synthetic
+#   families, genera and species (reference counts and lengths shaped like the real databases, fasta sequences are
+#   capped at max_seq_len as the validation only reads the taxonomy),
+# - BENCH/BENCH_samples.csv and samples.csv: samples drawn from the synthetic genera, some absent from the databases,
+# - BENCH/out_blast/: outfmt 6 blast outputs with up to max_blast subjects, several HSPs per subject for Refseq_pt.
+# Get_validation_cards.py is then run on every sample (in n_proc worker processes, as array tasks would),
+# followed by the results aggregation (Barcode_Validation_Results.py --collect).
+# Each stage reports samples/s, peak memory and file I/O (read/write calls and bytes, from /proc/self/io).
+# Results are compared with the last baseline of another version in Benchmark_baselines.csv, and saved with --save.
+#
+# python Benchmark_validation.py --sizes 1000 10000 50000 --n_proc 8 --save
+
+# In[1]:
+
+
+import pandas as pd
+import numpy as np
+import os
+import sys
+import time
+import runpy
+import shutil
+import resource
+import argparse
+import subprocess
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+import sample_registry
+
+
+# ## Parameters
+
+# In[2]:
+
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+cards_script = os.path.join(script_dir, 'Get_validation_cards.py')
+results_script = os.path.join(script_dir, 'Barcode_Validation_Results.py')
+barcodes_table = os.path.join(script_dir, '..', 'Barcode_Databases', 'Barcode_Tests.csv')
+baselines_file = os.path.join(script_dir, 'Benchmark_baselines.csv')
+DataSource = 'BENCH'
+
+n_families=450
+n_genera=8000
+# references and typical sequence length of each database (others: default_refs, default_len)
+db_refs={'BOLD_rbcLa':60000,'BOLD_rbcL':50000,'BOLD_matK':45000,'BOLD_ITS2':40000,
+         'NCBI_23s':3000,'NCBI_16s':8000,'NCBI_18s':15000,'Refseq_pt':5600}
+db_len={'BOLD_rbcLa':550,'BOLD_rbcL':1300,'BOLD_matK':800,'BOLD_ITS2':250,
+        'NCBI_23s':2800,'NCBI_16s':1500,'NCBI_18s':1800,'Refseq_pt':155000}
+default_refs=20000; default_len=1000
+max_seq_len=2000
+# HSPs per subject, whole plastomes give many local alignments
+db_hsps={'Refseq_pt':20}
+genus_coverage=0.7    # fraction of genera present in the databases
+p_correct=0.85        # best hit in the sample's genus
+p_no_hit=0.05         # blast output without hits
+sseqid_gb=0.1         # fraction of sseqid in gb|Locus| format
+regression_tol=0.2
+n_proc=os.cpu_count()
+chunk_samples=50
+
+
+# ## Functions
+
+# ### Synthetic data
+
+# In[3]:
+
+
+def make_taxonomy(rng):
+    families = ['Fam' + str(i).zfill(3) + 'aceae' for i in range(n_families)]
+    genera = pd.DataFrame({'genus': ['Gen' + str(i).zfill(4) for i in range(n_genera)],
+                           'family': rng.choice(families, n_genera)})
+    return genera
+
+
+# Reference fasta and _TAXO.csv of a barcode database, with references of a subset of genera
+def write_database(db_dir, barcode, gene_type, genera_db, rng):
+    n_refs = db_refs.get(barcode, default_refs); seq_len = db_len.get(barcode, default_len)
+    refs = genera_db.sample(n_refs, replace=True, random_state=rng).reset_index(drop=True)
+    refs.insert(0, 'Locus', ['SYN' + str(i).zfill(7) + '.1' for i in range(n_refs)])
+    refs['species'] = 'sp' + pd.Series(rng.randint(0, 30, n_refs)).astype(str)
+    refs['sci_name'] = refs.genus + ' ' + refs.species
+    refs['Len'] = (seq_len * rng.uniform(0.9, 1.1, n_refs)).astype(int)
+    refs['gene'] = barcode.split('_')[-1]; refs['mol_type'] = 'genomic DNA'
+    refs['kew_id'] = ''; refs['infraspecies'] = ''; refs['Duplicates'] = False
+    refs['Ini_sci_name'] = refs.sci_name; refs['TaxID'] = rng.randint(1000, 10**6, n_refs)
+    refs[['Locus','gene','mol_type','Len','sci_name','kew_id','family','genus','species','infraspecies','Duplicates',
+          'Ini_sci_name','TaxID']].to_csv(db_dir + barcode + '_TAXO.csv', index=False)
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+    with open(db_dir + barcode + '.fasta', 'w') as fout:
+        for row in refs.itertuples():
+            seq = bases[rng.randint(0, 4, min(row.Len, max_seq_len))].tobytes().decode()
+            fout.write('>' + row.Locus + ' ;gene=' + row.gene + ',type=' + gene_type + ',f=' + row.family + ',g=' +
+                       row.genus + ',s=' + row.sci_name + ',ini_s=' + row.Ini_sci_name + ';\n')
+            fout.write(''.join([seq[i:i + 60] + '\n' for i in range(0, len(seq), 60)]))
+    return refs
+
+
+# In[4]:
+
+
+# Hit lines of a blast output: best subjects first, several HSPs per subject
+def blast_lines(rng, refs, ref_idx, qlen, hsps, min_len):
+    lines=[]
+    pident = np.sort(rng.uniform(90, 100, len(ref_idx)))[::-1]
+    for iref, ipid in zip(ref_idx, pident):
+        slen = refs.Len.values[iref]; locus = refs.Locus.values[iref]
+        sseqid = 'gb|' + locus + '|' if rng.rand() < sseqid_gb else locus
+        for ihsp in range(rng.randint(1, hsps + 1) if hsps > 1 else 1):
+            length = int(min(slen, qlen) * rng.uniform(0.85, 1.0)) if hsps == 1 else rng.randint(min_len // 2, 5000)
+            sstart = rng.randint(1, max(2, slen - length)); qstart = rng.randint(1, max(2, qlen - length))
+            bitscore = round(length * ipid / 55, 1)
+            lines.append('\t'.join([
+                'contig_1', sseqid, '%.3f' % ipid, str(length), str(slen), str(qlen),
+                str(int(length * (100 - ipid) / 100)), str(rng.randint(0, 3)), str(qstart), str(qstart + length - 1),
+                str(sstart), str(sstart + length - 1), '%.2e' % (10.0 ** -rng.randint(20, 180)), str(bitscore)]) + '\n')
+    return lines
+
+
+# Blast outputs of a chunk of samples on all barcode tests, for samples whose genus or family is in the database
+def write_blast_chunk(args):
+    project_dir, samples, genes, seed = args
+    rng = np.random.RandomState(seed)
+    dbs = {igene.Barcode: pd.read_csv(project_dir + '../Barcode_DB/' + igene.Barcode + '_TAXO.csv',
+                                      usecols=['Locus','Len','family','genus']) for igene in genes.itertuples()}
+    by_genus = {ibarcode: refs.groupby('genus').indices for ibarcode, refs in dbs.items()}
+    by_family = {ibarcode: refs.groupby('family').indices for ibarcode, refs in dbs.items()}
+    for isample in samples.itertuples():
+        for igene in genes.itertuples():
+            refs = dbs[igene.Barcode]
+            if isample.genus not in by_genus[igene.Barcode] and isample.family not in by_family[igene.Barcode]:
+                continue
+            out_path = project_dir + 'out_blast/' + isample.Sample + '-' + igene.Barcode + '.out'
+            if rng.rand() < p_no_hit:
+                open(out_path, 'w').close()
+                continue
+            n_subjects = igene.max_blast if rng.rand() < 0.6 else rng.randint(1, igene.max_blast + 1)
+            ref_idx = list(rng.randint(0, refs.shape[0], n_subjects))
+            if rng.rand() < p_correct:
+                own = by_genus[igene.Barcode].get(isample.genus, by_family[igene.Barcode].get(isample.family))
+                ref_idx[0] = rng.choice(own)
+            qlen = int(db_len.get(igene.Barcode, default_len) * rng.uniform(0.95, 1.2))
+            with open(out_path, 'w') as fout:
+                fout.writelines(blast_lines(rng, refs, ref_idx, qlen, db_hsps.get(igene.Barcode, 1), igene.min_len))
+    return samples.shape[0]
+
+
+# In[5]:
+
+
+def make_dataset(size_dir, n_samples, genes, seed=1, n_proc=n_proc):
+    rng = np.random.RandomState(seed)
+    project_dir = size_dir + DataSource + '/'
+    db_dir = size_dir + 'Barcode_DB/'
+    for idir in [db_dir, project_dir + 'out_blast', project_dir + 'Barcode_Validation']:
+        os.makedirs(idir, exist_ok=True)
+    genera = make_taxonomy(rng)
+    genera_db = genera.sample(frac=genus_coverage, random_state=rng)
+    genes.to_csv(db_dir + 'Barcode_Tests.csv', index=False)
+    for igene in genes.itertuples():
+        print('database', igene.Barcode, db_refs.get(igene.Barcode, default_refs), 'references')
+        write_database(db_dir, igene.Barcode, igene.type, genera_db, rng)
+
+    samples = genera.sample(n_samples, replace=True, random_state=rng).reset_index(drop=True)
+    samples.insert(0, 'Sample', [DataSource + '_' + str(i).zfill(6) for i in range(n_samples)])
+    samples['idSequencing'] = range(n_samples); samples['idPaftol'] = range(n_samples)
+    samples['species'] = 'sp' + pd.Series(rng.randint(0, 30, n_samples)).astype(str)
+    samples[['Sample','idSequencing','idPaftol','family','genus','species']].to_csv(
+        project_dir + DataSource + '_samples.csv', index=False)
+    samples.assign(DataSource=DataSource).rename(columns={'family':'Family','genus':'Genus','species':'Species'})[
+        ['Sample','idSequencing','DataSource','Family','Genus','Species']].to_csv(size_dir + 'samples.csv', index=False)
+    sample_registry.open_registry(project_dir + DataSource + '_samples.csv')
+
+    chunks = [(project_dir, samples[i:i + chunk_samples], genes, seed + i) for i in range(0, n_samples, chunk_samples)]
+    with ProcessPoolExecutor(max_workers=n_proc) as executor:
+        Ndone = sum(executor.map(write_blast_chunk, chunks))
+    print(Ndone, 'samples with blast outputs in', project_dir + 'out_blast/')
+    open(size_dir + 'dataset.done', 'w').write(dataset_label(n_samples, genes) + '\n')
+
+
+def dataset_label(n_samples, genes):
+    return str(n_samples) + ' ' + ' '.join(genes.Barcode)
+
+
+def dataset_ready(size_dir, n_samples, genes):
+    return os.path.isfile(size_dir + 'dataset.done') and \
+        open(size_dir + 'dataset.done').read().strip() == dataset_label(n_samples, genes)
+
+
+# ### Measures
+
+# In[6]:
+
+
+# Read and write calls and bytes of the process
+def read_io_counts():
+    try:
+        with open('/proc/self/io') as fin:
+            io = dict([iline.split(': ') for iline in fin.read().splitlines()])
+        return {ikey: int(io[ikey]) for ikey in ['syscr','syscw','rchar','wchar']}
+    except (OSError, KeyError, ValueError):
+        return {ikey: 0 for ikey in ['syscr','syscw','rchar','wchar']}
+
+
+# Run a script as __main__ in this process with its command line arguments, silencing its output
+def run_script(script, argv):
+    sys.argv = [script] + argv
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        runpy.run_path(script, run_name='__main__')
+
+
+def run_cards_chunk(args):
+    project_dir, samples = args
+    os.chdir(project_dir)
+    io_start = read_io_counts()
+    for isample in samples:
+        run_script(cards_script, ['--sample', isample, '--samples_file', DataSource + '_samples.csv',
+                                  '--barcodes_table', '../Barcode_DB/Barcode_Tests.csv'])
+    io_end = read_io_counts()
+    counts = {ikey: io_end[ikey] - io_start[ikey] for ikey in io_start}
+    counts['maxrss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return counts
+
+
+def run_results(size_dir):
+    os.chdir(size_dir)
+    io_start = read_io_counts()
+    run_script(results_script, ['--samples_file', size_dir + 'samples.csv', '--collect'])
+    io_end = read_io_counts()
+    counts = {ikey: io_end[ikey] - io_start[ikey] for ikey in io_start}
+    counts['maxrss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return counts
+
+
+# In[7]:
+
+
+def measure(stage, n_samples, func, tasks, n_proc):
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_proc) as executor:
+        counts = list(executor.map(func, tasks))
+    wall = time.perf_counter() - start
+    return {'stage': stage, 'size': n_samples, 'n_proc': n_proc, 'wall_s': round(wall, 2),
+            'samples_per_s': round(n_samples / wall, 2),
+            'maxrss_mb': round(max([icount['maxrss_mb'] for icount in counts]), 1),
+            'read_calls': sum([icount['syscr'] for icount in counts]),
+            'write_calls': sum([icount['syscw'] for icount in counts]),
+            'read_mb': round(sum([icount['rchar'] for icount in counts]) / 1024**2, 1),
+            'write_mb': round(sum([icount['wchar'] for icount in counts]) / 1024**2, 1)}
+
+
+def run_benchmark(size_dir, n_samples, n_proc=n_proc):
+    project_dir = size_dir + DataSource + '/'
+    samples = list(pd.read_csv(project_dir + DataSource + '_samples.csv').Sample)
+    for icard in os.listdir(project_dir + 'Barcode_Validation/'):
+        os.remove(project_dir + 'Barcode_Validation/' + icard)
+    chunks = [(project_dir, samples[i:i + chunk_samples]) for i in range(0, len(samples), chunk_samples)]
+    cards = measure('cards', n_samples, run_cards_chunk, chunks, n_proc)
+    print(cards)
+    results = measure('results', n_samples, run_results, [size_dir], 1)
+    print(results)
+    return [cards, results]
+
+
+# ### Baselines
+
+# In[8]:
+
+
+def get_version():
+    try:
+        out = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=script_dir, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, universal_newlines=True)
+        return out.stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+# Ratios to the last baseline of another version, with the same barcode tests, size, stage and number of processes
+def compare_baselines(bench_df, baselines_file=baselines_file, tol=regression_tol):
+    if not os.path.isfile(baselines_file):
+        print('no baselines in', baselines_file)
+        return bench_df
+    baselines = pd.read_csv(baselines_file)
+    baselines = baselines[~baselines.version.isin(bench_df.version)].groupby(['barcodes','size','stage','n_proc']).last()
+    keys = list(zip(bench_df.barcodes, bench_df['size'], bench_df.stage, bench_df.n_proc))
+    for icol in ['version','samples_per_s','maxrss_mb','read_calls']:
+        bench_df['base_' + icol] = [baselines[icol].get(ikey, np.nan) for ikey in keys]
+    bench_df['speed_ratio'] = (bench_df.samples_per_s / bench_df.base_samples_per_s).round(2)
+    bench_df['mem_ratio'] = (bench_df.maxrss_mb / bench_df.base_maxrss_mb).round(2)
+    bench_df['regression'] = (bench_df.speed_ratio < 1 - tol) | (bench_df.mem_ratio > 1 + tol)
+    return bench_df
+
+
+# ## Main
+
+# In[9]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark of validation cards and results aggregation on synthetic datasets')
+    parser.add_argument("--sizes", nargs='*', type=int, default=[1000, 10000, 50000], help="numbers of samples")
+    parser.add_argument("--bench_dir", type=str, default='Benchmark', help="directory of synthetic datasets, reused")
+    parser.add_argument("--barcodes_table", type=str, default=barcodes_table, help="barcode tests to simulate")
+    parser.add_argument("--barcodes", nargs='*', default=None, help="only these barcode tests")
+    parser.add_argument("--n_proc", type=int, default=n_proc, help="processes building validation cards")
+    parser.add_argument("--version", type=str, default=None, help="version label, git describe by default")
+    parser.add_argument("--save", action="store_true", default=False, help="append results to the baselines")
+    parser.add_argument("--baselines", type=str, default=baselines_file)
+    args = parser.parse_args()
+
+    # Spans of the validation scripts are not recorded during the benchmark
+    os.environ['TELEMETRY_LOG'] = 'none'
+    genes = pd.read_csv(args.barcodes_table, encoding='utf-8-sig')
+    if args.barcodes is not None:
+        genes = genes[genes.Barcode.isin(args.barcodes)].reset_index(drop=True)
+    version = args.version if args.version is not None else get_version()
+    print('benchmark of version', version, 'on', genes.shape[0], 'barcode tests, sizes', args.sizes)
+
+    bench=[]
+    for isize in args.sizes:
+        size_dir = os.path.abspath(os.path.join(args.bench_dir, 'n' + str(isize))) + '/'
+        if not dataset_ready(size_dir, isize, genes):
+            print('\ngenerating', isize, 'samples in', size_dir)
+            shutil.rmtree(size_dir, ignore_errors=True)
+            make_dataset(size_dir, isize, genes, n_proc=args.n_proc)
+        print('\nbenchmark of', isize, 'samples')
+        bench += run_benchmark(size_dir, isize, n_proc=args.n_proc)
+
+    bench_df = pd.DataFrame(bench)
+    bench_df.insert(0, 'version', version)
+    bench_df.insert(1, 'date', time.strftime('%Y-%m-%d %H:%M'))
+    bench_df.insert(2, 'host', os.uname()[1])
+    bench_df.insert(3, 'barcodes', ' '.join(genes.Barcode))
+    report = compare_baselines(bench_df.copy(), args.baselines)
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(report)
+    if report.get('regression', pd.Series(dtype=bool)).fillna(False).any():
+        print('REGRESSION against', list(report.base_version.dropna().unique()))
+    if args.save:
+        bench_df.to_csv(args.baselines, mode='a', header=not os.path.isfile(args.baselines), index=False)
+        print('saved to', args.baselines)
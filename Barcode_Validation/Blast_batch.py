@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # Batched blast on barcode databases
+# Blast a batch of samples with a single blastn run per barcode database, instead of one run per sample and database.
+# Query sequences of all samples are concatenated, with their sequence ID tagged by sample (sample|seqid).
+# The blast output is then split back into one out_blast/<sample>-<barcode>.out file per sample,
+# identical to the output of Blast_on_barcodes.sh, so that Get_validation_cards.py can be used unchanged.
+# Samples whose output is in the blast cache (blast_cache.py) are not blasted again, and new outputs are cached.
+# Must be run from the DataSource directory.
+
+# In[1]:
+
+
+import pandas as pd
+import os
+import sys
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+import blast_cache
+import telemetry
+
+
+# ## Parameters
+
+# In[2]:
+
+
+sample_sep='|'
+blast_fmt='6 qseqid sseqid pident length slen qlen mismatch gapopen qstart qend sstart send evalue bitscore'
+type_org={'cpDNA':'pt','rDNA':'nr','pt':'pt','nr':'nr'}
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Samples of batch ibatch (starting at 1), in the same order as the samples file
+def get_batch_samples(samples_file, ibatch, batch_size):
+    samples = [iline.strip() for iline in open(samples_file) if iline.strip() != '']
+    return samples[(ibatch-1)*batch_size : ibatch*batch_size]
+
+
+# In[4]:
+
+
+def get_query_file(sample, org, fasta_type):
+    if fasta_type == 'contigs':
+        return 'in_fasta/' + sample + '.fasta'
+    elif fasta_type == 'pt_nr':
+        return 'fasta_' + org + '/' + sample + '_' + org + '.fasta'
+
+
+# In[5]:
+
+
+# Concatenate query fasta files, tagging each sequence ID with its sample
+def write_batch_query(jobs_df, batch_query):
+    with open(batch_query, 'w') as fout:
+        for idx, row in jobs_df.iterrows():
+            with open(row.query_file) as fin:
+                iline = '\n'
+                for iline in fin:
+                    if iline.startswith('>'):
+                        iline = '>' + row.Sample + sample_sep + iline[1:]
+                    fout.write(iline)
+                if not iline.endswith('\n'):
+                    fout.write('\n')
+
+
+# In[6]:
+
+
+# blastn run, in a telemetry span of its own (stage blast_batch)
+def run_blast(query, db, out, perc_identity, max_target_seqs, ncpu, barcode=None, n_samples=None):
+    cmd = ['blastn', '-query', query, '-db', db, '-perc_identity', str(perc_identity), '-outfmt', blast_fmt,
+           '-num_threads', str(ncpu), '-max_target_seqs', str(max_target_seqs), '-out', out]
+    print(' '.join(cmd))
+    return telemetry.run_command(cmd, 'blast_batch', barcode=barcode, n_samples=n_samples)
+
+
+# In[7]:
+
+
+# Split the batch blast output into one file per sample, removing the sample tag of qseqid.
+# Samples without hits get an empty file, as with a blastn run per sample.
+def demultiplex_blast(batch_out, samples, barcode, out_dir='out_blast/'):
+    handles = {isample: open(out_dir + isample + '-' + barcode + '.out', 'w') for isample in samples}
+    Nhits = dict.fromkeys(samples, 0)
+    try:
+        with open(batch_out) as fin:
+            for iline in fin:
+                isample, iline = iline.split(sample_sep, 1)
+                handles[isample].write(iline)
+                Nhits[isample] += 1
+    finally:
+        for ihandle in handles.values():
+            ihandle.close()
+    return Nhits
+
+
+# In[8]:
+
+
+# List blast jobs of a batch, from the planned jobs (Plan_blast_jobs.py) if available
+def get_batch_jobs(samples, genes_df, fasta_type, jobs_file='Blast_jobs.csv'):
+    if os.path.isfile(jobs_file):
+        jobs_df = pd.read_csv(jobs_file)
+        return jobs_df[jobs_df.Sample.isin(samples)].reset_index(drop=True)
+    jobs=[]
+    for gene_idx, gene_row in genes_df.iterrows():
+        for isample in samples:
+            query_file = get_query_file(isample, type_org[gene_row['type']], fasta_type)
+            if os.path.isfile(query_file):
+                jobs.append({'Sample': isample, 'Barcode': gene_row.Barcode, 'query_file': query_file})
+    return pd.DataFrame(jobs, columns=['Sample','Barcode','query_file'])
+
+
+# ## Main
+
+# In[9]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Blast a batch of samples on barcode databases, one blastn run per database')
+    parser.add_argument("--samples_file", type=str, help="list of samples, one per line")
+    parser.add_argument("--batch", type=int, help="batch number, starting at 1 (e.g. SLURM_ARRAY_TASK_ID)")
+    parser.add_argument("--batch_size", type=int, help="number of samples per batch")
+    parser.add_argument("--type", type=str, help="type of query fasta: contigs or pt_nr")
+    parser.add_argument("--barcodes_table", type=str, help="spreadsheet of barcode tests with parameters")
+    parser.add_argument("--ncpu", type=int, default=4, help="number of blastn threads")
+    args = parser.parse_args()
+
+    barcode_DB_dir = os.path.split(args.barcodes_table)[0] + '/'
+    genes_df = pd.read_csv(args.barcodes_table)
+    samples = get_batch_samples(args.samples_file, args.batch, args.batch_size)
+    print('batch',args.batch,':',len(samples),'samples')
+    jobs_df = get_batch_jobs(samples, genes_df, args.type)
+
+    os.makedirs('out_blast', exist_ok=True)
+    os.makedirs('tmp_batch', exist_ok=True)
+    cache = blast_cache.BlastCache()
+    for gene_idx, gene_row in genes_df.iterrows():
+        barcode_jobs = jobs_df[jobs_df.Barcode == gene_row.Barcode]
+        print('\nBarcode Test:',gene_row.Barcode,',',barcode_jobs.shape[0],'samples,',
+              'blast_max_matches:',gene_row.max_blast,', blast_min_pid:',gene_row.blast_pid)
+        # Outputs already in the cache
+        keys = {isample: blast_cache.blast_key(iquery, barcode_DB_dir + gene_row.Barcode + '.fasta',
+                                               gene_row.blast_pid, gene_row.max_blast)
+                for isample, iquery in zip(barcode_jobs.Sample, barcode_jobs.query_file)}
+        cached = [cache.get(keys[isample], 'out_blast/' + isample + '-' + gene_row.Barcode + '.out')
+                  for isample in barcode_jobs.Sample]
+        barcode_jobs = barcode_jobs[[not icached for icached in cached]]
+        print(sum(cached),'samples from blast cache')
+        if barcode_jobs.shape[0] == 0:
+            continue
+        batch_name = 'tmp_batch/batch_' + str(args.batch) + '-' + gene_row.Barcode
+        write_batch_query(barcode_jobs, batch_name + '.fasta')
+        exit_code = run_blast(query=batch_name + '.fasta', db=barcode_DB_dir + gene_row.Barcode + '.fasta',
+                              out=batch_name + '.out', perc_identity=gene_row.blast_pid,
+                              max_target_seqs=gene_row.max_blast, ncpu=args.ncpu, barcode=gene_row.Barcode,
+                              n_samples=barcode_jobs.Sample.nunique())
+        if exit_code != 0:
+            print('ERROR', gene_row.Barcode, ', blastn exited with code', exit_code)
+            continue
+        Nhits = demultiplex_blast(batch_name + '.out', list(barcode_jobs.Sample), gene_row.Barcode)
+        print(sum(Nhits.values()),'hits for',sum([ihits > 0 for ihits in Nhits.values()]),'samples')
+        for isample in barcode_jobs.Sample:
+            cache.put(keys[isample], 'out_blast/' + isample + '-' + gene_row.Barcode + '.out')
+        os.remove(batch_name + '.fasta'); os.remove(batch_name + '.out')
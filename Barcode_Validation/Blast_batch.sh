@@ -0,0 +1,42 @@
+#!/bin/bash
+#SBATCH --job-name="blast_batch"
+#SBATCH --export=ALL
+#SBATCH --cpus-per-task=16
+#SBATCH --partition=medium
+#SBATCH --ntasks=1
+#SBATCH --mem=32000
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+### Batched version of Blast_on_barcodes.sh: one array task per batch of samples, one blastn run per barcode database
+# sbatch --array=1-${Nbatches}%$slurmThrottle Blast_batch.sh $DataSource $type $batch_size
+ncpu=16
+
+project_dir=$1
+type=$2
+batch_size=$3
+cd $project_dir
+
+barcodes_table=../Barcode_DB/Barcode_Tests.csv
+Samples_file=Samples_to_blast.txt
+if [ ! -f $Samples_file ]; then
+	Samples_file=Samples_to_barcode.txt
+fi
+
+python ../Blast_batch.py --samples_file $Samples_file --batch $SLURM_ARRAY_TASK_ID --batch_size $batch_size \
+	--type $type --barcodes_table $barcodes_table --ncpu $ncpu
+
+first=$(( (SLURM_ARRAY_TASK_ID - 1) * batch_size + 1 ))
+last=$(( SLURM_ARRAY_TASK_ID * batch_size ))
+## Validation cards of the samples of the batch in one run, loading the taxonomy of the databases once
+batch_list=Samples_batch_${SLURM_ARRAY_TASK_ID}.txt
+sed -n "${first},${last}p" $Samples_file > $batch_list
+python ../Get_validation_cards.py --samples_list $batch_list --samples_file "$project_dir"_samples.csv \
+	--barcodes_table $barcodes_table --type $type
+rc=$?
+rm -f $batch_list
+exit $rc
@@ -18,9 +18,12 @@ type=$2
 cd $project_dir
 
 barcodes_table=../Barcode_DB/Barcode_Tests.csv
-Samples_file=Samples_to_barcode.txt
-# sample=$(sed -n "$SLURM_ARRAY_TASK_ID"p $Samples_file)
-sample=$(sed -n 1p $Samples_file)
+Samples_file=Samples_to_blast.txt
+jobs_file=Blast_jobs.csv
+if [ ! -f $Samples_file ]; then
+	Samples_file=Samples_to_barcode.txt
+fi
+sample=$(sed -n "$SLURM_ARRAY_TASK_ID"p $Samples_file)
 
 if [ $type == contigs ] 
 then
@@ -33,6 +36,8 @@ then
 fi
 
 echo "sample:$sample,pt_fasta:$fasta_pt_file,nr_fasta:$fasta_nr_file"
+# Thresholds of the k-mer prescreen, part of the blast cache key of prescreened searches
+kmer_params=$(python ../Kmer_prescreen.py params)
 
 sed 1d $barcodes_table | while read iline; do
 	idb="$(cut -d',' -f1 <<<"$iline")"
@@ -40,20 +45,76 @@ sed 1d $barcodes_table | while read iline; do
 	max_blast="$(cut -d',' -f5 <<<"$iline")"
 	blast_pid="$(cut -d',' -f6 <<<"$iline")"
 	echo "Barcode Test:$idb,type:$type,blast_max_matches:$max_blast,blast_min_pid:$blast_pid"
-	
-	if [ $type == nr ] && [ -f $fasta_nr_file ]; then
-		blastn  -query $fasta_nr_file -db ../Barcode_DB/"$idb".fasta \
-			-perc_identity $blast_pid -outfmt "6 qseqid sseqid pident length slen qlen mismatch gapopen qstart qend sstart send evalue bitscore" \
-			-num_threads $ncpu -max_target_seqs $max_blast \
-			-out out_blast/"$sample"-"$idb".out
-	elif [ $type == pt ] && [ -f $fasta_pt_file ]; then
-		blastn  -query $fasta_pt_file -db ../Barcode_DB/"$idb".fasta \
+	if [ $type == cpDNA ]; then type=pt; elif [ $type == rDNA ]; then type=nr; fi
+	if [ -f $jobs_file ] && ! grep -q "^$sample,$idb," $jobs_file; then
+		echo "skip $idb, not testable (see Blast_skipped.csv)"
+		continue
+	fi
+
+	if [ $type == nr ]; then query_file=$fasta_nr_file; elif [ $type == pt ]; then query_file=$fasta_pt_file; else query_file=""; fi
+	if [ -z "$query_file" ] || [ ! -f $query_file ]; then
+		echo "ERROR $idb, invalid type or no fasta file"
+		continue
+	fi
+	out_file=out_blast/"$sample"-"$idb".out
+
+	# Blast output cache, keyed by query, database, parameters, prescreen indexes and their parameters:
+	# only changed pairs are blasted again
+	prescreen_opt=""; params_opt=""
+	if [ -f ../Barcode_DB/"$idb".kmer.npz ]; then
+		prescreen_opt="../Barcode_DB/${idb}.kmer.npz"; params_opt="$kmer_params"
+	fi
+	# partitions (with the thresholds of the check and the taxonomy of the sample) are part of the key only if
+	# partition search is enabled for the barcode (partition_search)
+	partitions_on=false
+	if [ -f ../Barcode_DB/"$idb".partitions.csv ] && partition_params=$(python ../Taxo_partitions.py enabled \
+		--barcodes_table $barcodes_table --barcode $idb --samples_file "$project_dir"_samples.csv --sample $sample); then
+		partitions_on=true
+		prescreen_opt="$prescreen_opt ../Barcode_DB/${idb}.partitions.csv"; params_opt="$params_opt $partition_params"
+	fi
+	if [ -n "$prescreen_opt" ]; then prescreen_opt="--prescreen $prescreen_opt --params $params_opt"; fi
+	if python ../../Pipeline_Utils/blast_cache.py get --query $query_file --db ../Barcode_DB/"$idb".fasta \
+		--perc_identity $blast_pid --max_target_seqs $max_blast $prescreen_opt --out $out_file; then
+		continue
+	fi
+
+	# Optional taxonomy partitions (partition_search in Barcode_Tests.csv): blast on the partition of the sample's family
+	# and sentinels first, and on the full database if the result is not conclusive
+	# Conclusive outputs are marked (.partition_search, cached with the output), cards then record Search=partition
+	partition_file=out_blast/"$sample"-"$idb".partition
+	rm -f $out_file.partition_search
+	if [ $partitions_on == true ] && python ../Taxo_partitions.py query \
+		--index ../Barcode_DB/"$idb".partitions.csv --samples_file "$project_dir"_samples.csv --sample $sample \
+		--barcodes_table $barcodes_table --barcode $idb --out $partition_file; then
+		python ../../Pipeline_Utils/telemetry.py run --stage blast_partition --sample $sample --barcode $idb -- \
+		blastn  -query $query_file -db ../Barcode_DB/"$idb".fasta \
 			-perc_identity $blast_pid -outfmt "6 qseqid sseqid pident length slen qlen mismatch gapopen qstart qend sstart send evalue bitscore" \
-			-num_threads $ncpu -max_target_seqs $max_blast \
-			-out out_blast/"$sample"-"$idb".out
-	else
-	  echo "ERROR $idb, invalid type or no fasta file"
+			-num_threads $ncpu -max_target_seqs $max_blast -seqidlist $partition_file -out $partition_file.out
+		if python ../Taxo_partitions.py check --index ../Barcode_DB/"$idb".partitions.csv \
+			--samples_file "$project_dir"_samples.csv --sample $sample --barcodes_table $barcodes_table --barcode $idb \
+			--blast $partition_file.out; then
+			mv $partition_file.out $out_file && touch $out_file.partition_search && \
+				python ../../Pipeline_Utils/blast_cache.py put --out $out_file
+			rm -f $partition_file
+			continue
+		fi
+		rm -f $partition_file $partition_file.out
 	fi
+
+	# Optional k-mer prescreen: blast only on candidate references, full database if ambiguous
+	seqid_opt=""
+	if [ -f ../Barcode_DB/"$idb".kmer.npz ] && python ../Kmer_prescreen.py query --index ../Barcode_DB/"$idb".kmer.npz \
+		--query $query_file --out out_blast/"$sample"-"$idb".seqidlist; then
+		seqid_opt="-seqidlist out_blast/${sample}-${idb}.seqidlist"
+	fi
+
+	# blastn in a telemetry span of its own (Pipeline_Utils/telemetry.py)
+	python ../../Pipeline_Utils/telemetry.py run --stage blast --sample $sample --barcode $idb -- \
+	blastn  -query $query_file -db ../Barcode_DB/"$idb".fasta \
+		-perc_identity $blast_pid -outfmt "6 qseqid sseqid pident length slen qlen mismatch gapopen qstart qend sstart send evalue bitscore" \
+		-num_threads $ncpu -max_target_seqs $max_blast $seqid_opt \
+		-out $out_file && python ../../Pipeline_Utils/blast_cache.py put --out $out_file
 done
 
-python ../Get_validation_cards.py --sample $sample --samples_file "$project_dir"_samples.csv --barcodes_table $barcodes_table
\ No newline at end of file
+python ../Get_validation_cards.py --sample $sample --samples_file "$project_dir"_samples.csv --barcodes_table $barcodes_table \
+	--type $type
\ No newline at end of file
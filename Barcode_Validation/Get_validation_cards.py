@@ -14,9 +14,16 @@ import pandas as pd
 from tqdm import tqdm
 import numpy as np
 import os
+import sys
 import argparse
 import warnings
 warnings.filterwarnings('ignore')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+import sample_registry
+import blast_cache
+import blast_store
+import ref_index
+import telemetry
 
 
 # ## Parameters
@@ -29,12 +36,21 @@ parser = argparse.ArgumentParser(
     description='Blast sample sequences on Barcode database and process the results')
 parser.add_argument("--samples_file", type=str, help="spreadsheet of samples with their taxonomy")
 parser.add_argument("--sample", type=str, help="sample for which a barcode validation will be produced")
+parser.add_argument("--samples_list", type=str, default=None,
+                    help="file of samples (one per line) for which barcode validations will be produced, instead of --sample")
 parser.add_argument("--barcodes_table", type=str, help="spreadsheet of barcode tests with parameters")
+parser.add_argument("--type", type=str, default=None,
+                    help="type of query fasta (contigs or pt_nr), to record the inputs of the card for stale card detection")
+parser.add_argument("--blast_store", type=str, default=None,
+                    help="DataSource directory of the blast hits store (blast_store.py), e.g. ../Blast_store/PAFTOL, "
+                    "to read filtered hits from the store instead of out_blast")
 args = parser.parse_args()
 
 samples_file = args.samples_file
 sample = args.sample
 barcode_tests_file = args.barcodes_table
+fasta_type = args.type
+blast_store_dir = args.blast_store
 
 
 # In[67]:
@@ -53,7 +69,7 @@ barcode_tests_file = args.barcodes_table
 barcode_DB_dir = os.path.split(barcode_tests_file)[0] +'/'
 col_taxo_db=['Locus','species','genus','family']
 taxo_ranks=['genus','family']
-val_col_order = ['Test','tax_level','taxo','taxo_in_db','Blast','Nmatch','match','rank_pid','rank_bsc','pid','len','scov','qcov',
+val_col_order = ['Test','tax_level','taxo','taxo_in_db','Blast','Search','Nmatch','match','rank_pid','rank_bsc','pid','len','scov','qcov',
                  'best','best_pid','best_score','best_scov','best_qcov','NseqID']
 
 
@@ -107,6 +123,33 @@ def filter_blast(blast_filt_df, filter_dict):
     return blast_filt_df
 
 
+# Hits of a sample passing the barcode test thresholds, from out_blast or from the blast store.
+# Returns the number of raw hits and the filtered hits, None if there is no blast output
+def get_filtered_blast(sample, gene_row, partitions=None):
+    filter_dict={'min_pident':gene_row.blast_pid,'min_length':gene_row.min_len,'min_scov':gene_row.min_cov}
+    if partitions is None:
+        raw_blast=load_blast_file(blastpath = 'out_blast/' + sample + '-' + gene_row.Barcode + '.out')
+        if isinstance(raw_blast,type(None)):
+            return None, None
+        return raw_blast.shape[0], filter_blast(raw_blast, filter_dict)
+    # Thresholds are applied by the store, on the rows of the sample only
+    part = partitions[gene_row.Barcode]
+    Nhits = part.count(sample)
+    if Nhits is None or Nhits==0:
+        return None, None
+    filters = [('pident','>=',filter_dict['min_pident']),('length','>=',filter_dict['min_length']),
+               ('scov','>=',filter_dict['min_scov'])]
+    return Nhits, part.scan(samples=[sample], filters=filters,
+                            columns=['qseqid','sseqid','length','slen','qlen','scov','qcov','pident','evalue','bitscore'])
+
+
+# Blast output marked as a conclusive partition search by Blast_on_barcodes.sh, full database otherwise
+def search_type(sample, gene_row):
+    if os.path.isfile('out_blast/' + sample + '-' + gene_row.Barcode + '.out.partition_search'):
+        return 'partition'
+    return 'full'
+
+
 # In[72]:
 
 
@@ -145,8 +188,13 @@ def get_blast_results(validic, blast_sample):
 def load_taxo_db(genes_df):
     all_taxo_db = pd.DataFrame()
     for gene_idx, gene_row in genes_df.iterrows():
-        ## Load db_taxo
-        taxo_db = pd.read_csv(barcode_DB_dir + gene_row.Barcode + '_TAXO.csv')
+        ## Load db_taxo, from the up to date taxonomy sidecar of the fasta (ref_index.py), otherwise _TAXO.csv
+        fasta_db = barcode_DB_dir + gene_row.Barcode + '.fasta'
+        taxo_sidecar = fasta_db + '.taxo.npy'
+        if os.path.isfile(fasta_db) and not ref_index.is_stale(fasta_db):
+            taxo_db = pd.DataFrame(np.load(taxo_sidecar))[col_taxo_db].replace('', np.nan)
+        else:
+            taxo_db = pd.read_csv(barcode_DB_dir + gene_row.Barcode + '_TAXO.csv')
         taxo_db = taxo_db[col_taxo_db]; taxo_db['Locus']= taxo_db['Locus'].astype('str')
         taxo_db['Barcode'] = gene_row.Barcode
         all_taxo_db = pd.concat([all_taxo_db,taxo_db],ignore_index=True)
@@ -154,35 +202,16 @@ def load_taxo_db(genes_df):
     return all_taxo_db
 
 
-# ## Main
-
 # In[74]:
 
 
-samples_df = pd.read_csv(samples_file)
-sample_dic = samples_df[samples_df.Sample==sample].to_dict(orient='records')[0]
-sample_dic['genus']
-
-
-# In[75]:
-
-
-if __name__ == "__main__":
-    ## Load data
-    genes_df = pd.read_csv(barcode_tests_file)
-    samples_df = pd.read_csv(samples_file)
-    # Convert sample info (taxonomy) as a dictionary
-    sample_dic = samples_df[samples_df.Sample==sample].to_dict(orient='records')[0]
-    print('\n\nProcessing blast output for',genes_df.shape[0],'barcode tests')
-    print(genes_df)
-
-    # Don't run sample's validation if it already exists
-    validation_file = 'Barcode_Validation/BV_' + sample + '.csv'
+# Barcode tests of a sample, for each barcode and taxonomic level
+def make_card(sample, sample_dic, genes_df, all_taxo_db, partitions=None):
     results_blast_df = pd.DataFrame()
-    ## Load all db_taxo
-    all_taxo_db = load_taxo_db(genes_df)
     # For each gene,
     for gene_idx, gene_row in genes_df.iterrows():
+        span = telemetry.start('card_barcode', sample=sample, barcode=gene_row.Barcode)
+        Nhits = 0
         # barcode db_taxo
         taxo_db = all_taxo_db[all_taxo_db.Barcode==gene_row.Barcode].reset_index(drop=True)
         # For each taxonomic level (genus, family)
@@ -193,14 +222,15 @@ if __name__ == "__main__":
             if validic['taxo'] in list(taxo_db[itax]):
                 validic['taxo_in_db'] = True
                 
-                # Get blast output
-                raw_blast=load_blast_file(blastpath = 'out_blast/' + sample + '-' + gene_row.Barcode + '.out')
+                # Get blast output, filtered
+                Nraw, blast_filt_df = get_filtered_blast(sample, gene_row, partitions)
                 
                 ## If blast output, filter it
-                if isinstance(raw_blast,type(None))==False:
+                if Nraw is not None:
                     validic['Blast'] = True
-                    filter_dict={'min_pident':gene_row.blast_pid,'min_length':gene_row.min_len,'min_scov':gene_row.min_cov}
-                    blast_filt_df=filter_blast(raw_blast, filter_dict)
+                    # Hits of a partition search (Taxo_partitions.py) or of the full database
+                    validic['Search'] = search_type(sample, gene_row)
+                    Nhits += Nraw
                     blast_filt_df['sseqid']= blast_filt_df['sseqid'].astype('str')
                     
                     ## If match after filtering, get validation results
@@ -237,11 +267,72 @@ if __name__ == "__main__":
                 validic['taxo_in_db'] = False
                 
             results_blast_df = pd.concat([results_blast_df, pd.DataFrame.from_dict(validic,orient='index').transpose()])
+        span.end(rows_in=Nhits, rows_out=len(taxo_ranks))
+    return results_blast_df
+
+
+# ## Main
+
+# In[75]:
 
-    # Write Output if at least one blast file was found
-    if results_blast_df.Blast.sum()>0:
-        tmp_val_col = [icol for icol in val_col_order if icol in results_blast_df.columns]
-        results_blast_df[tmp_val_col].to_csv(validation_file,index=False)
-    else:
-        print('No Blast files found for',sample)
 
+if __name__ == "__main__":
+    ## Load data
+    genes_df = pd.read_csv(barcode_tests_file)
+    registry = sample_registry.open_registry(samples_file)
+    samples = [sample] if args.samples_list is None else \
+        [iline.strip() for iline in open(args.samples_list) if iline.strip() != '']
+    print('\n\nProcessing blast output for',genes_df.shape[0],'barcode tests')
+    print(genes_df)
+    # Blast hits from the store, by barcode
+    partitions = None
+    if blast_store_dir is not None:
+        # Outputs of out_blast added, modified (size, mtime) or removed since the last ingestion are ingested again,
+        # so that cards are not made from stale hits
+        if os.path.isdir('out_blast'):
+            os.makedirs(blast_store_dir, exist_ok=True)
+            for ibarcode in genes_df.Barcode:
+                Nparsed, Nfiles = blast_store.ingest_barcode(os.path.join(blast_store_dir, ibarcode), 'out_blast', ibarcode)
+                if Nparsed > 0:
+                    print('Blast store of', ibarcode, 'out of date,', Nparsed, '/', Nfiles, 'blast outputs ingested again')
+        else:
+            print('WARNING: no out_blast directory, the blast store cannot be checked against the blast outputs')
+        partitions = {ibarcode: blast_store.Partition(os.path.join(blast_store_dir, ibarcode)) for ibarcode in genes_df.Barcode}
+
+    ## Load all db_taxo, once for all samples of the list
+    span = telemetry.start('card_taxo_load', sample=args.sample, n_samples=len(samples))
+    all_taxo_db = load_taxo_db(genes_df)
+    span.end(rows_out=all_taxo_db.shape[0])
+    failed = []
+    for sample in samples:
+        # Sample info (taxonomy) as a dictionary, from the registry of the samples file
+        sample_dic = registry.get('Sample', sample)
+        if sample_dic is None:
+            print('ERROR', sample, 'not found in', samples_file, ', skipped')
+            failed.append(sample)
+            continue
+        validation_file = 'Barcode_Validation/BV_' + sample + '.csv'
+        card_span = telemetry.start('card', sample=sample)
+        # A failing sample is reported and skipped, the other samples of the list are processed
+        try:
+            results_blast_df = make_card(sample, sample_dic, genes_df, all_taxo_db, partitions)
+        except Exception as e:
+            print('ERROR', sample, repr(e), ', skipped')
+            failed.append(sample)
+            card_span.end(status='error:' + type(e).__name__)
+            continue
+
+        # Write Output if at least one blast file was found (no Blast column if the taxa are in no database)
+        if 'Blast' in results_blast_df.columns and results_blast_df.Blast.sum()>0:
+            tmp_val_col = [icol for icol in val_col_order if icol in results_blast_df.columns]
+            results_blast_df[tmp_val_col].to_csv(validation_file,index=False)
+            # Inputs of the card (blast_cache.py), the card is stale when they change
+            if fasta_type is not None:
+                blast_cache.card_keys(sample, genes_df, fasta_type, barcode_DB_dir, sample_dic=sample_dic).to_csv(
+                    validation_file.replace('.csv','.keys'), index=False)
+        else:
+            print('No Blast files found for',sample)
+        card_span.end(rows_out=results_blast_df.shape[0])
+    if len(failed) > 0:
+        print(len(failed), '/', len(samples), 'samples failed:', failed)
+        sys.exit(1)
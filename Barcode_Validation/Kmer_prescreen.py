@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # K-mer prescreen of barcode databases
+# Builds a k-mer sketch index of a barcode reference fasta (from GB_extract.py or Processing_BOLD.ipynb),
+# and uses it to select, for each query contig, the references sharing most k-mers.
+# blastn can then be run on these candidates only (-seqidlist), instead of the complete database.
+# If the prescreen is ambiguous (too few shared k-mers or too many equally good candidates),
+# no candidate list is written and the full database should be used.
+#
+# python Kmer_prescreen.py build --fasta Barcode_DB/Refseq_pt.fasta
+# python Kmer_prescreen.py query --index Barcode_DB/Refseq_pt.kmer.npz --query fasta_pt/PAFTOL_000001_pt.fasta --out tmp.seqidlist
+
+# In[1]:
+
+
+import pandas as pd
+import numpy as np
+import os
+import sys
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+import kmers
+
+
+# ## Parameters
+
+# In[2]:
+
+
+kmer_size=21
+sketch_scale=10
+min_shared=5          # minimum shared k-mers with the best reference
+min_frac_top=0.5      # candidates share at least this fraction of the k-mers of the best reference
+max_candidates=500    # more equally good candidates than this is ambiguous
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Taxonomy from _TAXO.csv if it exists, otherwise from the fasta description (;...,f=family,g=genus,s=...;)
+def parse_description(desc):
+    taxo = {}
+    for ifield in desc.strip(';').split(','):
+        if '=' in ifield:
+            ikey, ivalue = ifield.split('=', 1)
+            taxo[ikey] = ivalue
+    return {'family': taxo.get('f'), 'genus': taxo.get('g')}
+
+
+# In[4]:
+
+
+def build_index(fasta_path, k=kmer_size, scale=sketch_scale):
+    loci=[]; taxo=[]; hashes=[]; ref_idx=[]
+    for iref, (seq_id, desc, seq) in enumerate(kmers.read_fasta(fasta_path)):
+        loci.append(seq_id)
+        taxo.append(parse_description(desc))
+        ihashes = kmers.sketch(seq, k, scale)
+        hashes.append(ihashes)
+        ref_idx.append(np.full(ihashes.shape[0], iref, dtype=np.int32))
+    hashes = np.concatenate(hashes) if len(hashes) > 0 else np.zeros(0, dtype=np.uint64)
+    ref_idx = np.concatenate(ref_idx) if len(ref_idx) > 0 else np.zeros(0, dtype=np.int32)
+    order = np.argsort(hashes, kind='stable')
+    taxo_df = pd.DataFrame(taxo, index=loci)
+    taxo_file = fasta_path.replace('.fasta', '_TAXO.csv')
+    if os.path.isfile(taxo_file):
+        taxo_csv = pd.read_csv(taxo_file, usecols=['Locus','family','genus']).astype({'Locus':'str'})
+        taxo_csv = taxo_csv.drop_duplicates('Locus').set_index('Locus')
+        taxo_df.update(taxo_csv)
+    return {'hashes': hashes[order], 'ref_idx': ref_idx[order], 'loci': np.array(loci, dtype=str),
+            'family': np.array(taxo_df.family.fillna('').tolist(), dtype=str),
+            'genus': np.array(taxo_df.genus.fillna('').tolist(), dtype=str),
+            'k': np.array(k), 'scale': np.array(scale)}
+
+
+# In[5]:
+
+
+def save_index(index, index_path):
+    np.savez(index_path, **index)
+
+
+def load_index(index_path):
+    with np.load(index_path) as npz:
+        return {ikey: npz[ikey] for ikey in npz.files}
+
+
+# In[6]:
+
+
+# Number of sketch k-mers shared between a query sequence and every reference
+def shared_kmers(index, seq):
+    qhashes = kmers.sketch(seq, int(index['k']), int(index['scale']))
+    left = np.searchsorted(index['hashes'], qhashes, side='left')
+    right = np.searchsorted(index['hashes'], qhashes, side='right')
+    hits = np.concatenate([index['ref_idx'][ileft:iright] for ileft, iright in zip(left, right) if iright > ileft]
+                          + [np.zeros(0, dtype=np.int32)])
+    return np.bincount(hits, minlength=index['loci'].shape[0]), qhashes.shape[0]
+
+
+# In[7]:
+
+
+# Candidate references of one query contig, sorted by shared k-mers. Candidates are None if the prescreen is ambiguous
+def contig_candidates(index, seq, min_shared=min_shared, min_frac_top=min_frac_top, max_candidates=max_candidates):
+    scores, Nkmers = shared_kmers(index, seq)
+    top = scores.max() if scores.shape[0] > 0 else 0
+    if top < min_shared:
+        return None, scores
+    candidates = np.flatnonzero(scores >= top * min_frac_top)
+    if candidates.shape[0] > max_candidates:
+        return None, scores
+    return candidates[np.argsort(-scores[candidates], kind='stable')], scores
+
+
+# In[8]:
+
+
+# Candidate references of a query fasta (union over contigs). Contigs sharing no k-mer with the database are ignored,
+# but an ambiguous contig makes the whole query ambiguous (None) so that blast falls back to the full database
+def prescreen(index, query_fasta, **kwargs):
+    candidates=[]; report=[]
+    for seq_id, desc, seq in kmers.read_fasta(query_fasta):
+        icandidates, scores = contig_candidates(index, seq, **kwargs)
+        if icandidates is None:
+            if scores.shape[0] > 0 and scores.max() > 0:
+                return None, None
+            continue
+        candidates.append(icandidates)
+        best = icandidates[0]
+        report.append({'qseqid': seq_id, 'Ncandidates': icandidates.shape[0], 'best': index['loci'][best],
+                       'best_family': index['family'][best], 'best_genus': index['genus'][best],
+                       'shared_kmers': scores[best],
+                       'families': ';'.join(pd.unique(index['family'][icandidates]))})
+    if len(candidates) == 0:
+        return None, None
+    candidates = np.unique(np.concatenate(candidates))
+    return list(index['loci'][candidates]), pd.DataFrame(report)
+
+
+# ## Main
+
+# In[9]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='K-mer prescreen of barcode databases, to blast query contigs on candidate references only')
+    parser.add_argument("action", type=str, help="build: index a reference fasta, query: candidate references of a query, "
+                        "params: thresholds of queries as name=value, for the blast cache key (blast_cache.py)")
+    parser.add_argument("--fasta", type=str, help="build: reference fasta (e.g. Barcode_DB/NCBI_18s.fasta)")
+    parser.add_argument("--k", type=int, default=kmer_size, help="build: k-mer size (max 31)")
+    parser.add_argument("--scale", type=int, default=sketch_scale, help="build: keep 1/scale of k-mers")
+    parser.add_argument("--index", type=str, help="query: k-mer index (.kmer.npz)")
+    parser.add_argument("--query", type=str, help="query: query fasta")
+    parser.add_argument("--out", type=str, help="query: output list of candidate references (blastn -seqidlist)")
+    parser.add_argument("--min_shared", type=int, default=min_shared)
+    parser.add_argument("--max_candidates", type=int, default=max_candidates)
+    args = parser.parse_args()
+
+    if args.action == 'build':
+        print('Indexing',args.fasta,', k:',args.k,', scale:',args.scale)
+        index = build_index(args.fasta, k=args.k, scale=args.scale)
+        index_path = args.fasta.replace('.fasta', '.kmer.npz')
+        save_index(index, index_path)
+        print(index['loci'].shape[0],'references,',index['hashes'].shape[0],'k-mers, saved to',index_path)
+
+    elif args.action == 'query':
+        index = load_index(args.index)
+        candidates, report = prescreen(index, args.query, min_shared=args.min_shared,
+                                       max_candidates=args.max_candidates)
+        if os.path.isfile(args.out):
+            os.remove(args.out)
+        if candidates is None:
+            print('ambiguous prescreen, use full database')
+            sys.exit(1)
+        print(len(candidates),'/',index['loci'].shape[0],'candidate references for',report.shape[0],'contigs')
+        with open(args.out, 'w') as fout:
+            fout.write('\n'.join(candidates) + '\n')
+        report.to_csv(args.out + '.csv', index=False)
+
+    elif args.action == 'params':
+        print(' '.join(['kmer_min_shared=' + str(args.min_shared), 'kmer_min_frac_top=' + str(min_frac_top),
+                        'kmer_max_candidates=' + str(args.max_candidates)]))
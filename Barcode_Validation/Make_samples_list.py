@@ -11,7 +11,11 @@
 
 
 import pandas as pd
-import argparse; import os
+import argparse; import os; import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+import fs_inventory
+import sample_registry
+import blast_cache
 
 
 # In[2]:
@@ -19,6 +23,8 @@ import argparse; import os
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--db"); parser.add_argument("--DataSource")
+# Optional, to list samples with stale validation cards (inputs changed since the card was made)
+parser.add_argument("--barcodes_table", default=None); parser.add_argument("--type", default=None)
 opts = parser.parse_args()
 db_export_file = opts.db;  DataSource = opts.DataSource
 
@@ -34,10 +40,8 @@ db_export_file = opts.db;  DataSource = opts.DataSource
 # In[21]:
 
 
-# Load data and keep entries for DataSource
-db = pd.read_csv(db_export_file)
-db.DataSource.replace({'Annotated genome':'AG','Unannotated genome':'UG'},inplace=True)
-db = db[db.DataSource==DataSource].astype({'idSequencing':'int','idPaftol':'int'})
+# Load entries for DataSource from the sample registry of the export (Sample column precomputed)
+db = sample_registry.open_registry(db_export_file).datasource(DataSource).astype({'idSequencing':'int','idPaftol':'int'})
 print(db.shape[0],DataSource,'samples')
 if db.R1FastqFile.isna().sum()>0:
     print(db.R1FastqFile.isna().sum(),'samples have no R1FastqFile and are removed from further analysis')
@@ -47,14 +51,8 @@ if db.R1FastqFile.isna().sum()>0:
 # In[23]:
 
 
-# Make Sample column
-if DataSource in ['OneKP','SRA','UG','AG']:
-    db['Sample'] = db['ExternalSequenceID']
-elif DataSource in ['PAFTOL']:
-    db['Sample'] = db['idSequencing'].astype('str').apply(lambda x: 'PAFTOL_' + x.zfill(6))
-elif DataSource in ['GAP']:
-    db['Sample'] = db['idSequencing'].astype('str').apply(lambda x: 'GAP_' + x.zfill(6))
-else:
+# Check Sample column
+if db.shape[0]==0 or db.Sample.isna().all():
     print('could not find Datasource',DataSource)
 
 
@@ -72,8 +70,19 @@ print('First line:\n',samples_df[:1].to_string(index=False))
 
 
 # List existing validation cards and output list of samples to blast
-samples_done = [filename.replace('BV_','').replace('.csv','') for filename in os.listdir(DataSource + '/Barcode_Validation/')]
+inventory = fs_inventory.Inventory(DataSource + '/.fs_inventory.pkl')
+samples_done = [ientry['file'].replace('BV_','').replace('.csv','') for ientry in inventory.list_dir(DataSource + '/Barcode_Validation/')
+                if ientry['file'].endswith('.csv')]
+inventory.save()
 print('\nfound',len(samples_done),'validation cards')
+# Cards made from an older query fasta, barcode database, barcode test parameters or taxonomy are redone
+if opts.barcodes_table is not None and opts.type is not None:
+    genes_df = pd.read_csv(opts.barcodes_table)
+    barcode_DB_dir = os.path.split(opts.barcodes_table)[0] + '/'
+    samples_stale = blast_cache.stale_cards(samples_done, genes_df, opts.type, barcode_DB_dir, project_dir=DataSource + '/',
+                                            samples_df=samples_df)
+    print(len(samples_stale),'stale validation cards')
+    samples_done = [isample for isample in samples_done if isample not in set(samples_stale)]
 samples_todo = db[db.Sample.isin(samples_done)==False]
 print(samples_todo.shape[0],'samples to blast, ',db[db.Sample.isin(samples_done)].shape[0],'samples done')
 
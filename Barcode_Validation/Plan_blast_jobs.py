@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # Plan blast jobs
+# Lists the (sample, barcode, query file) blast searches that can produce a testable result.
+# A sample is only queried against a barcode database if its genus or family is present in the database
+# and if the query fasta (organelle or contigs) exists. Skipped searches are written with the validation
+# card fields they would have produced, so that nothing is lost by not running them.
+
+# In[1]:
+
+
+import pandas as pd
+import os
+import argparse
+
+
+# ## Parameters
+
+# In[2]:
+
+
+taxo_ranks=['genus','family']
+# Barcode type (Barcode_Tests.csv) to organelle fasta
+type_org={'cpDNA':'pt','rDNA':'nr','pt':'pt','nr':'nr'}
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Path of the query fasta for a sample, relative to the DataSource directory
+def get_query_file(sample, org, fasta_type):
+    if fasta_type == 'contigs':
+        return 'in_fasta/' + sample + '.fasta'
+    elif fasta_type == 'pt_nr':
+        return 'fasta_' + org + '/' + sample + '_' + org + '.fasta'
+
+
+# In[4]:
+
+
+# Set of genera and families present in each barcode database
+def load_db_taxa(genes_df, barcode_DB_dir):
+    db_taxa={}
+    for gene_idx, gene_row in genes_df.iterrows():
+        taxo_db = pd.read_csv(barcode_DB_dir + gene_row.Barcode + '_TAXO.csv', usecols=taxo_ranks)
+        db_taxa[gene_row.Barcode] = {itax: set(taxo_db[itax].dropna()) for itax in taxo_ranks}
+    return db_taxa
+
+
+# In[5]:
+
+
+def plan_jobs(samples_df, genes_df, db_taxa, fasta_type, project_dir=''):
+    jobs=[]; skipped=[]
+    for gene_idx, gene_row in genes_df.iterrows():
+        org = type_org[gene_row['type']]
+        in_db = pd.DataFrame({itax: samples_df[itax].isin(db_taxa[gene_row.Barcode][itax]) for itax in taxo_ranks})
+        query_files = samples_df.Sample.apply(lambda x: get_query_file(x, org, fasta_type))
+        query_exist = query_files.apply(lambda x: os.path.isfile(project_dir + x))
+        testable = in_db.any(axis=1)
+
+        # Searches to run
+        jobs.append(pd.DataFrame({'Sample': samples_df.Sample[testable & query_exist], 'Barcode': gene_row.Barcode,
+                                  'query_file': query_files[testable & query_exist]}))
+
+        # Expected card rows for skipped searches
+        for itax in taxo_ranks:
+            skip_df = pd.DataFrame({'Sample': samples_df.Sample, 'Test': gene_row.Barcode, 'tax_level': itax,
+                                    'taxo': samples_df[itax], 'taxo_in_db': in_db[itax]})
+            skip_df['Blast'] = None
+            skip_df.loc[in_db[itax], 'Blast'] = False
+            skip_df['reason'] = 'taxo_not_in_db'
+            skip_df.loc[in_db[itax], 'reason'] = 'no_query_file'
+            skipped.append(skip_df[(~testable) | (~query_exist)])
+    jobs_df = pd.concat(jobs, ignore_index=True)
+    skipped_df = pd.concat(skipped, ignore_index=True).sort_values(['Sample','Test']).reset_index(drop=True)
+    return jobs_df, skipped_df
+
+
+# ## Main
+
+# In[6]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='List blast searches of samples on barcode databases that can produce a testable result')
+    parser.add_argument("--DataSource", type=str, help="DataSource (e.g. PAFTOL, OneKP), also the project directory")
+    parser.add_argument("--type", type=str, help="type of query fasta: contigs or pt_nr")
+    parser.add_argument("--barcodes_table", type=str, help="spreadsheet of barcode tests with parameters")
+    args = parser.parse_args()
+
+    project_dir = args.DataSource + '/'
+    barcode_DB_dir = os.path.split(args.barcodes_table)[0] + '/'
+
+    ## Load data
+    genes_df = pd.read_csv(args.barcodes_table)
+    samples_df = pd.read_csv(project_dir + args.DataSource + '_samples.csv')
+    samples_todo = pd.read_csv(project_dir + 'Samples_to_barcode.txt', header=None, names=['Sample'])
+    samples_df = samples_df[samples_df.Sample.isin(samples_todo.Sample)].reset_index(drop=True)
+    print(samples_df.shape[0],'samples to plan on',genes_df.shape[0],'barcode tests')
+    db_taxa = load_db_taxa(genes_df, barcode_DB_dir)
+
+    ## Plan
+    jobs_df, skipped_df = plan_jobs(samples_df, genes_df, db_taxa, fasta_type=args.type, project_dir=project_dir)
+    n_all = samples_df.shape[0]*genes_df.shape[0]
+    print(jobs_df.shape[0],'/',n_all,'blast searches to run,',n_all-jobs_df.shape[0],'skipped')
+    print(jobs_df.groupby('Barcode').size().to_dict())
+
+    ## Output
+    jobs_df.to_csv(project_dir + 'Blast_jobs.csv',index=False)
+    skipped_df.to_csv(project_dir + 'Blast_skipped.csv',index=False)
+    # Samples without any search would not produce a validation card
+    samples_blast = samples_todo[samples_todo.Sample.isin(jobs_df.Sample)]
+    print(samples_blast.shape[0],'samples with at least one blast search')
+    samples_blast.Sample.to_csv(project_dir + 'Samples_to_blast.txt',index=False,header=False)
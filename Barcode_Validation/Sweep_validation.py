@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # Sweep validation
+# Barcode validation decisions (Confirmed, Rejected, Inconclusive) for a grid of policies, without making validation
+# cards again. Each grid point sets hit filters (min_pident, min_len, min_scov, Barcode_Tests.csv values if not set)
+# and decision parameters (max_rank, min_test, min_test_invalid, as in Barcode_Validation_Results.py).
+# Hits are read from the blast store (Pipeline_Utils/blast_store.py, ingested beforehand). For each barcode and chunk
+# of samples, a single pass evaluates the filters of all grid points at once (hits x filter sets masks), and derives
+# from them the ranks of hits by identity and bitscore among filtered hits, the first hit of the sample's taxon and
+# the best hit of each barcode test, as in Get_validation_cards.py. Ties in identity are broken by bitscore.
+# Tests are then classified for each max_rank, and samples decided for each min_test and min_test_invalid.
+# Decisions are counted by DataSource, tax_level and barcode (All: all barcode tests, <barcode>: that test only),
+# in a single tidy table with one row per grid point, DataSource, barcode, tax_level and decision.
+#
+# Run from the working directory containing the DataSource directories:
+# python Sweep_validation.py --samples_file 2021-07-27_paftol_export.csv --DataSources PAFTOL OneKP \
+#     --min_pident 95 97 99 --min_scov 0 50 --max_rank 1 2 --min_test 1 2 --out Validation_sweep.csv
+# python Sweep_validation.py --samples_file Release_1.5/R1.5_samples.csv --grid policies.csv
+
+# In[1]:
+
+
+import os
+import sys
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+import blast_store
+import ref_index
+import Barcode_Validation_Results as bv_results
+
+
+# ## Parameters
+
+# In[2]:
+
+
+filter_params=['min_pident','min_len','min_scov']
+decision_params=['max_rank','min_test','min_test_invalid']
+# Barcode_Tests.csv columns used when a filter is not set
+barcode_cols={'min_pident':'blast_pid','min_len':'min_len','min_scov':'min_cov'}
+taxo_ranks=bv_results.taxo_ranks
+decisions=['Confirmed','Rejected','Inconclusive']
+max_cells=20000000  # hits x filter sets evaluated at once
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Grid points from a csv, or all combinations of the values given. Filters not set are read from Barcode_Tests.csv
+def make_grid(grid_file=None, values={}):
+    if grid_file is not None:
+        grid = pd.read_csv(grid_file)
+    else:
+        params = [iparam for iparam in filter_params + decision_params if values.get(iparam)]
+        grid = pd.DataFrame(list(itertools.product(*[values[iparam] for iparam in params])), columns=params)
+    for iparam, idefault in [('max_rank',bv_results.max_rank),('min_test',bv_results.min_test),
+                             ('min_test_invalid',bv_results.min_test_invalid)]:
+        if iparam not in grid.columns:
+            grid[iparam] = idefault
+    for iparam in filter_params:
+        if iparam not in grid.columns:
+            grid[iparam] = np.nan
+    grid = grid[filter_params + decision_params].drop_duplicates().reset_index(drop=True)
+    grid['filter_set'] = grid.groupby(filter_params, dropna=False).ngroup()
+    return grid
+
+
+# Locus, genus and family of a barcode database, from the taxonomy sidecar if indexed (ref_index.py) and up to date
+def load_taxo(barcode_DB_dir, barcode):
+    fasta_db = barcode_DB_dir + barcode + '.fasta'
+    taxo_sidecar = fasta_db + '.taxo.npy'
+    if os.path.isfile(fasta_db) and not ref_index.is_stale(fasta_db):
+        taxo_db = pd.DataFrame(np.load(taxo_sidecar))[['Locus'] + taxo_ranks].replace('', np.nan)
+    else:
+        taxo_db = pd.read_csv(barcode_DB_dir + barcode + '_TAXO.csv')[['Locus'] + taxo_ranks]
+    taxo_db['Locus'] = taxo_db.Locus.astype('str')
+    return taxo_db.drop_duplicates('Locus')
+
+
+# Locus of sseqids in gb|KY652173.1| format, as clean_sseqid in Get_validation_cards.py
+def clean_sseqids(sseqids):
+    sseqids = pd.Series(sseqids, dtype=str)
+    return sseqids.str.split('|').str[1].where(sseqids.str.contains('|', regex=False), sseqids).values
+
+
+# In[4]:
+
+
+# Rank (min method, descending) of each hit among the filtered hits of its test, for each filter set.
+# Hits are sorted by test and by descending value, before is the number of filtered hits ahead in the test
+def filtered_ranks(passed, group, group_start, value):
+    before = np.cumsum(passed, axis=0, dtype=np.int32) - passed
+    before = before - before[group_start][group]
+    new_tie = np.r_[True, (group[1:] != group[:-1]) | (value[1:] != value[:-1])]
+    tie_start = np.maximum.accumulate(np.where(new_tie, np.arange(len(group)), 0))
+    return before[tie_start] + 1
+
+
+# Barcode tests of a chunk of hits for all filter sets: Nmatch, match, rank_pid, rank_bsc and best of the sample's
+# genus and family. hits: sample (code), pident, length, scov, bitscore and genus, family codes of the subject
+def sweep_tests(hits, sample_taxo, db_taxa, filters):
+    order = np.lexsort((-hits['bitscore'], -hits['pident'], hits['sample']))
+    hits = {icol: hits[icol][order] for icol in hits}
+    Nhits = len(order); Nfilters = filters.shape[0]
+    new_group = np.r_[True, hits['sample'][1:] != hits['sample'][:-1]]
+    group = np.cumsum(new_group) - 1; group_start = np.flatnonzero(new_group)
+    samples = hits['sample'][group_start]
+    # filters of all grid points at once
+    passed = (hits['pident'][:,None] >= filters[:,0]) & (hits['length'][:,None] >= filters[:,1]) & \
+             (hits['scov'][:,None] >= filters[:,2])
+    Nmatch = np.add.reduceat(passed.astype(np.int32), group_start, axis=0)
+    rank_pid = filtered_ranks(passed, group, group_start, hits['pident'])
+    by_bsc = np.lexsort((-hits['bitscore'], group))
+    rank_bsc = np.empty_like(rank_pid)
+    rank_bsc[by_bsc] = filtered_ranks(passed[by_bsc], group[by_bsc], group_start, hits['bitscore'][by_bsc])
+    rows = np.arange(Nhits)[:,None]; cols = np.arange(Nfilters)[None,:]
+    top = np.minimum.reduceat(np.where(passed, rows, Nhits), group_start, axis=0)
+    list_ = []
+    for itax in taxo_ranks:
+        taxo = sample_taxo[itax][samples]
+        is_match = (hits[itax] == sample_taxo[itax][hits['sample']]) & (hits[itax] >= 0)
+        first = np.minimum.reduceat(np.where(passed & is_match[:,None], rows, Nhits), group_start, axis=0)
+        match = first < Nhits
+        first = np.minimum(first, Nhits - 1)
+        tests = pd.DataFrame({'sample': np.repeat(samples, Nfilters), 'filter_set': np.tile(np.arange(Nfilters), len(samples)),
+                              'in_db': np.repeat(np.isin(taxo, db_taxa[itax]) & (taxo >= 0), Nfilters),
+                              'Nmatch': Nmatch.ravel(), 'match': match.ravel(),
+                              'rank_pid': np.where(match, rank_pid[first, cols], 0).ravel(),
+                              'rank_bsc': np.where(match, rank_bsc[first, cols], 0).ravel(),
+                              'best': np.where(Nmatch > 0, hits[itax][np.minimum(top, Nhits - 1)], -1).ravel()})
+        # only tests with filtered hits and the sample's taxon in the database count in decisions
+        tests = tests[tests.in_db & (tests.Nmatch > 0)].drop(columns=['in_db','Nmatch'])
+        tests['tax_level'] = itax
+        list_.append(tests)
+    return pd.concat(list_, ignore_index=True)
+
+
+# In[5]:
+
+
+# Barcode tests of a DataSource for all filter sets, reading hits of the store by chunks of samples
+def sweep_datasource(DataSource, genes_df, samples_df, filter_sets, taxo_dbs, taxa, store_dir):
+    list_ = []
+    for gene_idx, gene_row in genes_df.iterrows():
+        part = blast_store.Partition(os.path.join(store_dir, DataSource, gene_row.Barcode))
+        if not part.exists:
+            print('no blast store for', DataSource, gene_row.Barcode)
+            continue
+        # filters of this barcode, Barcode_Tests.csv values if not set
+        filters = filter_sets.copy()
+        for iparam in filter_params:
+            filters[iparam] = filters[iparam].fillna(gene_row[barcode_cols[iparam]])
+        filters = filters[filter_params].values.astype(np.float64)
+        # taxonomy codes of subjects and samples
+        locus_taxo = taxo_dbs[gene_row.Barcode].set_index('Locus')
+        sseqids = pd.Index(clean_sseqids(part.dictionary('sseqid')))
+        subject_taxo = {itax: taxa[itax].get_indexer(locus_taxo[itax].reindex(sseqids)) for itax in taxo_ranks}
+        db_taxa = {itax: np.unique(taxa[itax].get_indexer(locus_taxo[itax].dropna())) for itax in taxo_ranks}
+        store_samples = part.dictionary('sample').astype(object)
+        smpl_taxo = samples_df.set_index('Sample').reindex(store_samples)
+        sample_taxo = {itax: taxa[itax].get_indexer(smpl_taxo[itax]) for itax in taxo_ranks}
+        # chunks of samples, within max_cells
+        chunk, chunk_rows = [], 0
+        samples = set(samples_df.Sample)
+        in_samples = [isample for isample in part.offsets if isample in samples]
+        for i, isample in enumerate(in_samples):
+            chunk.append(isample); chunk_rows += part.count(isample)
+            if chunk_rows * filters.shape[0] >= max_cells or i == len(in_samples) - 1:
+                rows = np.concatenate([np.arange(*part.offsets[jsample]) for jsample in chunk])
+                hits = {icol: part.column(icol)[rows] for icol in ['sample','pident','length','scov','bitscore']}
+                sseqid_codes = part.column('sseqid')[rows]
+                for itax in taxo_ranks:
+                    hits[itax] = subject_taxo[itax][sseqid_codes]
+                tests = sweep_tests(hits, sample_taxo, db_taxa, filters)
+                tests['Sample'] = store_samples[tests['sample'].values]
+                tests['Barcode'] = gene_row.Barcode
+                list_.append(tests.drop(columns='sample'))
+                chunk, chunk_rows = [], 0
+        print(DataSource, gene_row.Barcode + ':', len(in_samples), 'samples')
+    if len(list_) == 0:
+        return pd.DataFrame(columns=['Sample','Barcode','tax_level','filter_set','match','rank_pid','rank_bsc','best'])
+    tests = pd.concat(list_, ignore_index=True)
+    tests['DataSource'] = DataSource
+    return tests
+
+
+# In[6]:
+
+
+# NV, VAT and N best (most frequent best taxon of failed tests) of each sample, for all barcodes and each barcode
+def sample_counts(tests, max_rank):
+    tests = tests.assign(Passed=tests.match & ((tests.rank_pid <= max_rank) | (tests.rank_bsc <= max_rank)))
+    tests = pd.concat([tests.assign(Barcode='All'), tests], ignore_index=True)
+    keys = ['DataSource','Barcode','tax_level','Sample']
+    counts = tests.groupby(keys).Passed.agg(NV='size', VAT='sum')
+    failed = tests[~tests.Passed & (tests.best >= 0)]
+    counts['Nbest'] = failed.groupby(keys + ['best']).size().groupby(keys).max()
+    return counts.reset_index()
+
+
+# Decisions as in Barcode_Validation_Results.decide, counted by DataSource, barcode and tax_level.
+# Samples without tests are Inconclusive (Confirmed if min_test is 0)
+def count_decisions(counts, Nsamples, barcodes, min_test, min_test_invalid):
+    confirmed = counts.VAT >= min_test
+    rejected = counts.Nbest >= min_test_invalid
+    tested_pc = round(counts.VAT / counts.NV * 100, 0) > 0
+    counts['Validation'] = np.select([tested_pc & rejected, rejected, confirmed],
+                                     ['Inconclusive','Rejected','Confirmed'], default='Inconclusive')
+    decided = counts.groupby(['DataSource','Barcode','tax_level','Validation']).size().unstack(fill_value=0)
+    decided = decided.reindex(columns=decisions, fill_value=0).reindex(pd.MultiIndex.from_product(
+        [Nsamples.index, ['All'] + barcodes, taxo_ranks], names=['DataSource','Barcode','tax_level']), fill_value=0)
+    untested = Nsamples.reindex(decided.index.get_level_values('DataSource')).values - decided.sum(axis=1)
+    decided['Confirmed' if min_test <= 0 else 'Inconclusive'] += untested
+    return decided.stack().rename('N').reset_index()
+
+
+# Counts of decisions of all grid points, tests are classified once for each filter set and max_rank
+def sweep(tests, grid, Nsamples, barcodes):
+    list_ = []
+    for (ifilter, imax_rank), igrid in grid.groupby(['filter_set','max_rank']):
+        counts = sample_counts(tests[tests.filter_set == ifilter], imax_rank)
+        for ipoint in igrid[filter_params + decision_params].to_dict('records'):
+            decided = count_decisions(counts.copy(), Nsamples, barcodes, ipoint['min_test'], ipoint['min_test_invalid'])
+            list_.append(decided.assign(**ipoint))
+    results = pd.concat(list_, ignore_index=True)
+    return results[filter_params + decision_params + ['DataSource','Barcode','tax_level','Validation','N']]
+
+
+# ## Main
+
+# In[7]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Barcode validation decisions for a grid of filters and decision parameters')
+    parser.add_argument("--samples_file", type=str, help="spreadsheet of samples with DataSource and taxonomy")
+    parser.add_argument("--DataSources", nargs='*', default=None, help="DataSources, all of the samples file by default")
+    parser.add_argument("--barcodes_table", type=str, default='Barcode_DB/Barcode_Tests.csv')
+    parser.add_argument("--store_dir", type=str, default=blast_store.store_dir, help="blast store (blast_store.py)")
+    parser.add_argument("--grid", type=str, default=None, help="csv of grid points, columns among " +
+                        ', '.join(filter_params + decision_params))
+    for iparam in filter_params + decision_params:
+        parser.add_argument("--" + iparam, nargs='*', type=float if iparam in filter_params else int, default=None)
+    parser.add_argument("--out", type=str, default='Validation_sweep.csv')
+    args = parser.parse_args()
+
+    grid = make_grid(args.grid, vars(args))
+    print(grid.shape[0], 'grid points,', grid.filter_set.nunique(), 'filter sets')
+    filter_sets = grid.drop_duplicates('filter_set').sort_values('filter_set')[filter_params]
+    genes_df = pd.read_csv(args.barcodes_table)
+    barcode_DB_dir = os.path.split(args.barcodes_table)[0] + '/'
+    samples_df = bv_results.load_samples(args.samples_file).drop_duplicates('Sample')
+    DataSources = args.DataSources if args.DataSources is not None else list(samples_df.DataSource.unique())
+    samples_df = samples_df[samples_df.DataSource.isin(DataSources)]
+    Nsamples = samples_df.groupby('DataSource').size()
+
+    # Taxa of samples and barcode databases, coded once
+    taxo_dbs = {ibarcode: load_taxo(barcode_DB_dir, ibarcode) for ibarcode in genes_df.Barcode}
+    taxa = {itax: pd.Index(pd.concat([samples_df[itax]] + [itaxo[itax] for itaxo in taxo_dbs.values()]).dropna().unique())
+            for itax in taxo_ranks}
+
+    tests = pd.concat([sweep_datasource(iDataSource, genes_df, samples_df[samples_df.DataSource==iDataSource],
+                                        filter_sets, taxo_dbs, taxa, args.store_dir) for iDataSource in DataSources],
+                      ignore_index=True)
+    print(tests.shape[0], 'barcode tests for', tests.filter_set.nunique(), 'filter sets')
+    results = sweep(tests, grid, Nsamples, list(genes_df.Barcode))
+    results.to_csv(args.out, index=False)
+    summary = results[results.Barcode=='All'].fillna({iparam: 'table' for iparam in filter_params})\
+        .pivot_table(index=filter_params + decision_params + ['tax_level'], columns='Validation', values='N',
+                     aggfunc='sum').reindex(columns=decisions)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+        print(summary)
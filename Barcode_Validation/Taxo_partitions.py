@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # Taxonomy partitions of barcode databases
+# Splits the references of a barcode database in taxonomic partitions (families, or orders with a family to order
+# table), and picks sentinels: the longest references of each family, as a small subset of the whole database.
+# For barcodes where it is enabled (partition_search column of Barcode_Tests.csv, off by default), a sample is first
+# blasted on the partition of its family plus the sentinels (blastn -seqidlist), and on the full database only if this
+# search is not conclusive.
+# Conclusive is a heuristic, not a guarantee that the references left out would not change the validation: only the
+# sentinels of other partitions are searched, so a close reference of another partition that is not a sentinel is not
+# seen. The search is taken as conclusive when the sample's genus and family (when in the database) are both ranked
+# first by identity and by bitscore (rank_pid and rank_bsc of get_blast_results in Get_validation_cards.py), the best
+# hit is at least margin_threshold above blast_pid, and hits of other partitions (sentinels) are below the best hit by
+# margin_pid and margin_bsc. Samples failing a test or without match are always searched on the full database,
+# so that ranks above 1 are those of the full database.
+#
+# Outputs of conclusive partition searches are marked (<out>.partition_search), and their cards record Search=partition:
+# Nmatch and NseqID then count the hits of the partition and sentinels, not of the full database.
+#
+# python Taxo_partitions.py build --fasta Barcode_DB/Refseq_pt.fasta --groups Barcode_DB/family_order.csv
+# python Taxo_partitions.py enabled --barcodes_table Barcode_DB/Barcode_Tests.csv --barcode Refseq_pt \
+#     --samples_file PAFTOL_samples.csv --sample PAFTOL_000001
+# python Taxo_partitions.py query --index Barcode_DB/Refseq_pt.partitions.csv --samples_file PAFTOL_samples.csv \
+#     --sample PAFTOL_000001 --barcodes_table Barcode_DB/Barcode_Tests.csv --barcode Refseq_pt \
+#     --out out_blast/PAFTOL_000001-Refseq_pt.partition
+# python Taxo_partitions.py check --index Barcode_DB/Refseq_pt.partitions.csv --samples_file PAFTOL_samples.csv \
+#     --sample PAFTOL_000001 --barcodes_table Barcode_DB/Barcode_Tests.csv --barcode Refseq_pt \
+#     --blast out_blast/PAFTOL_000001-Refseq_pt.partition.out
+
+# In[1]:
+
+
+import pandas as pd
+import numpy as np
+import os
+import sys
+import argparse
+import contextlib
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+import ref_index
+import sample_registry
+
+
+# ## Parameters
+
+# In[2]:
+
+
+taxo_ranks=['genus','family']
+sentinels_per_family=1
+margin_pid=1.0     # sentinels of other partitions at least this identity below the best hit
+margin_bsc=0.05    # and this fraction of bitscore below
+margin_threshold=2.0  # best hit at least this identity above blast_pid, references left out may be just below it
+blast_cols=['qseqid','sseqid','pident','length','slen','qlen','mismatch','gapopen','qstart','qend','sstart','send',
+            'evalue','bitscore']
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Partition (family, or group of the family in groups_file) and sentinel flag of each reference
+def build_partitions(fasta_path, groups_file=None, n_sentinels=sentinels_per_family):
+    refs = ref_index.RefIndex(fasta_path)
+    index_df = refs.taxonomy_df()[['Locus','family','genus']].replace('', np.nan)
+    index_df['length'] = index_df.Locus.map(lambda x: refs.fai[x][0])
+    refs.close()
+    index_df['partition'] = index_df.family
+    if groups_file is not None:
+        groups = pd.read_csv(groups_file)
+        groups = groups.drop_duplicates('family').set_index('family')[groups.columns[1]]
+        index_df['partition'] = index_df.family.map(groups).fillna(index_df.family)
+    sentinels = index_df[index_df.family.notna()].sort_values('length', ascending=False)\
+        .groupby('family').head(n_sentinels).index
+    index_df['sentinel'] = index_df.index.isin(sentinels)
+    return index_df.drop(columns='length')
+
+
+# References of the partition of a family plus sentinels, None if the family is not in the database
+def partition_loci(index_df, family):
+    partition = index_df[index_df.family==family].partition.unique()
+    if len(partition) == 0:
+        return None
+    return list(index_df[(index_df.partition==partition[0]) | index_df.sentinel].Locus)
+
+
+# Partition search enabled for a barcode test (partition_search column of Barcode_Tests.csv)
+def partition_enabled(gene_row):
+    return str(gene_row.get('partition_search', False)).strip().lower() in ['true','1','yes']
+
+
+# In[4]:
+
+
+def load_blast_file(blastpath):
+    if not os.path.isfile(blastpath) or os.stat(blastpath).st_size == 0:
+        return None
+    blast_df = pd.read_csv(blastpath, header=None, sep='\t', names=blast_cols, dtype={'sseqid':str})
+    blast_df['pident'] = blast_df.pident.round(2)
+    blast_df['scov'] = round((abs(blast_df.sstart - blast_df.send) + 1) / blast_df.slen * 100, 1)
+    # sseqid in gb|KY652173.1| format
+    blast_df['Locus'] = blast_df.sseqid.str.split('|').str[1].where(blast_df.sseqid.str.contains('|', regex=False),
+                                                                    blast_df.sseqid)
+    return blast_df
+
+
+# Heuristic check that the partition search is likely to give the validation of the full database: genus and family
+# of the sample ranked first by identity and bitscore, best hit well above blast_pid, and sentinels of other
+# partitions below the best hit by the margins
+def is_conclusive(blast_df, sample_dic, index_df, filter_dict, margin_pid=margin_pid, margin_bsc=margin_bsc,
+                  margin_threshold=margin_threshold):
+    if blast_df is None:
+        return False, 'no blast hit'
+    blast_df = blast_df[(blast_df.pident>=filter_dict['min_pident']) & (blast_df.length>=filter_dict['min_length'])
+                        & (blast_df.scov>=filter_dict['min_scov'])]
+    if blast_df.shape[0] == 0:
+        return False, 'no hit after filtering'
+    if blast_df.pident.max() < filter_dict['min_pident'] + margin_threshold:
+        return False, 'best hit close to blast_pid'
+    blast_df = pd.merge(blast_df, index_df, how='left', on='Locus')
+    for itax in taxo_ranks:
+        if sample_dic[itax] not in set(index_df[itax].dropna()):
+            continue
+        match = blast_df[blast_df[itax]==sample_dic[itax]]
+        if match.shape[0] == 0:
+            return False, 'no ' + itax + ' match'
+        if match.pident.max() < blast_df.pident.max() or match.bitscore.max() < blast_df.bitscore.max():
+            return False, itax + ' not ranked first'
+    partition = index_df[index_df.family==sample_dic['family']].partition.unique()
+    others = blast_df[~blast_df.partition.isin(partition)]
+    if others.shape[0] > 0 and (others.pident.max() > blast_df.pident.max() - margin_pid or
+                                others.bitscore.max() > blast_df.bitscore.max() * (1 - margin_bsc)):
+        return False, 'other partitions close to best hit'
+    return True, 'conclusive'
+
+
+# ## Main
+
+# In[5]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Taxonomy partitions of barcode databases, to blast samples on the partition of their family first')
+    parser.add_argument("action", type=str, help="build: partitions of a reference fasta, "
+                        "enabled: exit 0 if partition search is enabled for the barcode, printing the parameters of the "
+                        "search of the sample as name=value (blast cache key), "
+                        "query: references of a sample's partition, check: exit 0 if a partition search is conclusive")
+    parser.add_argument("--fasta", type=str, help="build: reference fasta (e.g. Barcode_DB/Refseq_pt.fasta)")
+    parser.add_argument("--groups", type=str, default=None,
+                        help="build: table of families (first column, family) and their partition (second column, e.g. order)")
+    parser.add_argument("--sentinels", type=int, default=sentinels_per_family, help="build: sentinels per family")
+    parser.add_argument("--index", type=str, help="query, check: partitions (.partitions.csv)")
+    parser.add_argument("--samples_file", type=str, help="enabled, query, check: spreadsheet of samples with their taxonomy")
+    parser.add_argument("--sample", type=str, help="enabled, query, check: sample")
+    parser.add_argument("--out", type=str, help="query: output list of references (blastn -seqidlist)")
+    parser.add_argument("--blast", type=str, help="check: blast output of the partition search")
+    parser.add_argument("--barcodes_table", type=str,
+                        help="enabled, query, check: spreadsheet of barcode tests with parameters")
+    parser.add_argument("--barcode", type=str, help="enabled, query, check: barcode test")
+    args = parser.parse_args()
+
+    if args.action == 'build':
+        index_df = build_partitions(args.fasta, args.groups, args.sentinels)
+        index_path = args.fasta.replace('.fasta', '.partitions.csv')
+        index_df.to_csv(index_path, index=False)
+        print(index_df.shape[0],'references,',index_df.partition.nunique(),'partitions,',index_df.sentinel.sum(),
+              'sentinels, saved to',index_path)
+        print('largest partitions:',index_df.groupby('partition').size().sort_values(ascending=False)[:5].to_dict())
+
+    elif args.action == 'enabled':
+        gene_row = pd.read_csv(args.barcodes_table).set_index('Barcode').loc[args.barcode]
+        if not partition_enabled(gene_row):
+            sys.exit(1)
+        # Thresholds of the check and taxonomy of the sample, the partition and the check depend on them
+        if args.sample is not None:
+            # stdout is only the parameters, messages of the registry go to stderr
+            with contextlib.redirect_stdout(sys.stderr):
+                sample_dic = sample_registry.open_registry(args.samples_file).get('Sample', args.sample) or {}
+            print(' '.join(['partition_' + ikey + '=' + str(ivalue) for ikey, ivalue in
+                            [('margin_pid', margin_pid), ('margin_bsc', margin_bsc), ('margin_threshold', margin_threshold),
+                             ('family', sample_dic.get('family')), ('genus', sample_dic.get('genus'))]]))
+
+    elif args.action in ['query','check']:
+        index_df = pd.read_csv(args.index, dtype={'Locus':str})
+        sample_dic = sample_registry.open_registry(args.samples_file).get('Sample', args.sample)
+        gene_row = pd.read_csv(args.barcodes_table).set_index('Barcode').loc[args.barcode]
+        if not partition_enabled(gene_row):
+            print('partition search not enabled for',args.barcode,'(partition_search), use full database')
+            sys.exit(1)
+        if args.action == 'query':
+            if os.path.isfile(args.out):
+                os.remove(args.out)
+            loci = partition_loci(index_df, sample_dic['family'])
+            if loci is None:
+                print('family',sample_dic['family'],'not in database, use full database')
+                sys.exit(1)
+            print(len(loci),'/',index_df.shape[0],'references in the partition of',sample_dic['family'],'and sentinels')
+            with open(args.out, 'w') as fout:
+                fout.write('\n'.join(loci) + '\n')
+        else:
+            filter_dict={'min_pident':gene_row.blast_pid,'min_length':gene_row.min_len,'min_scov':gene_row.min_cov}
+            conclusive, reason = is_conclusive(load_blast_file(args.blast), sample_dic, index_df, filter_dict)
+            print('partition search:', reason)
+            sys.exit(0 if conclusive else 1)
+    else:
+        print('unknown action', args.action)
+        sys.exit(2)
@@ -9,94 +9,269 @@
 # Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
 ##################################
 
+# Copies the best fasta of a GetOrganelle folder to fasta_<org>/, removes temporary files, and archives the folder.
+# With --sweep, all finished folders of GetOrg/ (log with "Writing output finished") are cleaned at once in a pool of
+# workers, e.g. after tasks that died before their cleanup, and the space reclaimed by each folder is reported.
+# A folder is cleaned under a lock (GetOrg/<Sample>_<org>.lock, removed once cleaned) shared by --path and --sweep, so
+# that a sweep and the cleanup of the array task do not process the same folder, and the sweep skips folders where a file
+# or the GetOrganelle log was modified recently. Log metrics are kept in logs_index.csv, as by GetOrg_prep.py.
+#
+# python ../GetOrg_Clean.py --path GetOrg/PAFTOL_000001_pt/
+# python ../GetOrg_Clean.py --sweep --n_proc 8
+
 # In[1]:
 
 
 import os
 import shutil
 import sys
+import time
+import fcntl
 import argparse
-from Bio import SeqIO
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+import fasta_stats
+import archives
+import telemetry
+
+
+# ## Parameters
+
+# In[2]:
+
+
+rm_dirs=['filtered_spades','seed']
+rm_files=['filtered_1_paired.fq.tar.gz','filtered_2_paired.fq.tar.gz',
+          'filtered_1_unpaired.fq.tar.gz','filtered_2_unpaired.fq.tar.gz']
+getorg_dir='GetOrg/'
+logs_dir='logs/'
+sweep_report='Clean_sweep.csv'
+n_proc=4
+archive_threads=2    # compression threads of each worker in a sweep
+min_age=3600         # sweep: folders or logs modified less than min_age seconds ago may still be cleaned by their task
+logs_index='logs_index.csv'   # in the DataSource directory, as <DataSource>/logs_index.csv of GetOrg_prep.py
 
 
-# In[ ]:
+# ## Functions
 
+# In[3]:
 
-parser = argparse.ArgumentParser(
-    description='Process GetOrganelles results and clean tmp folders')
-parser.add_argument("--path", type=str, help="path of folder to process")
-args = parser.parse_args()
-path = args.path
-print('path to folder:',path)
-Sample = path.split('/')[-2].replace('_pt','').replace('_nr','')
-print('Sample:',Sample)
 
+# Sample and organelle of a GetOrganelle folder (GetOrg/<Sample>_<org>/)
+def parse_path(path):
+    Sample = path.split('/')[-2].replace('_pt','').replace('_nr','')
+    org = path.split('/')[-2].split('_')[-1]
+    return Sample, org
 
-# In[32]:
 
+# Latest modification time of a folder and of the files and folders it contains
+def newest_mtime(path):
+    newest = os.lstat(path).st_mtime
+    for root, dirs, files in os.walk(path):
+        for ientry in dirs + files:
+            try:
+                newest = max(newest, os.lstat(os.path.join(root, ientry)).st_mtime)
+            except OSError:
+                pass
+    return newest
 
-org = path.split('/')[-2].split('_')[-1]
-if org in ['pt','nr']:
-    print('organelle:',org)
-else:
-    print('wrong parsing of organelle:',org)
-    sys.exit()
+
+def dir_size(path):
+    total=0
+    for root, dirs, files in os.walk(path):
+        for ifile in files:
+            try:
+                total += os.lstat(os.path.join(root, ifile)).st_size
+            except OSError:
+                pass
+    return total
+
+
+# In[4]:
 
 
 # ## Copy best organelle fasta
 
-# In[14]:
-
-
-fasta_files = [ifile for ifile in os.listdir(path) if ifile.endswith('.fasta')]
-if len(fasta_files)==1:
-    print('1 fasta file:',fasta_files[0])
-    shutil.copyfile(path + fasta_files[0], 'fasta_' + org + '/' + Sample + '_' + org + '.fasta')
-elif len(fasta_files)>1:
-    print('found',len(fasta_files),'fasta files')
-    best_fasta=''
-    best_len=0
-    for ifasta in fasta_files:
-        sum_len=0
-        for record in SeqIO.parse(path + ifasta, "fasta"):
-            sum_len += len(record.seq)
-        if sum_len>best_len:
-            best_len=sum_len
-            best_fasta=ifasta
+
+# Copy the longest fasta of the folder, None if there is no fasta
+def copy_best_fasta(path, Sample, org):
+    span = telemetry.start('clean_best_fasta', sample=Sample, org=org)
+    fasta_files = [ifile for ifile in os.listdir(path) if ifile.endswith('.fasta')]
+    if len(fasta_files)==1:
+        print('1 fasta file:',fasta_files[0])
+        best_fasta=fasta_files[0]
+    elif len(fasta_files)>1:
+        print('found',len(fasta_files),'fasta files')
+        best_fasta=''
+        best_len=0
+        for ifasta in fasta_files:
+            sum_len = fasta_stats.scan_fasta(path + ifasta)['Sum_len']
+            if sum_len>best_len:
+                best_len=sum_len
+                best_fasta=ifasta
+    else:
+        print('either no fasta or error, exiting.')
+        span.end(status='no_fasta', rows_in=0)
+        return None
     shutil.copyfile(path + best_fasta, 'fasta_' + org + '/' + Sample + '_' + org + '.fasta')
-else:
-    print('either no fasta or error, exiting.')
-    sys.exit()
+    span.end(rows_in=len(fasta_files), rows_out=1)
+    return best_fasta
 
 
 # ## Remove temp files
 
-# In[7]:
 
-
-rm_dirs=['filtered_spades','seed']
-rm_files=['filtered_1_paired.fq.tar.gz','filtered_2_paired.fq.tar.gz',
-          'filtered_1_unpaired.fq.tar.gz','filtered_2_unpaired.fq.tar.gz']
-for idir in rm_dirs:
-    rm_dir = path + idir
-    print(rm_dir)
-    if os.path.isdir(rm_dir):
-        shutil.rmtree(rm_dir)
-for ifile in rm_files:
-    rm_file = path + ifile
-    print(rm_file)
-    if os.path.isfile(rm_file):
-        os.remove(rm_file)
+# Bytes freed by removing temporary folders and files
+def remove_temp(path):
+    freed=0
+    for idir in rm_dirs:
+        rm_dir = path + idir
+        print(rm_dir)
+        if os.path.isdir(rm_dir):
+            freed += dir_size(rm_dir)
+            shutil.rmtree(rm_dir)
+    for ifile in rm_files:
+        rm_file = path + ifile
+        print(rm_file)
+        if os.path.isfile(rm_file):
+            freed += os.path.getsize(rm_file)
+            os.remove(rm_file)
+    return freed
 
 
 # ## Compress and remove folder
 
-# In[ ]:
+
+# Indexed tar.gz compressed in parallel, single files can be read back with archives.py extract
+def archive_folder(path, Sample, org, n_threads=archives.n_threads):
+    zip_path='Archives/' + Sample + '_' + org + '.tar.gz'
+    span = telemetry.start('clean_archive', sample=Sample, org=org)
+    archives.create_archive(path, zip_path, n_threads=n_threads)
+    verified = archives.verify_archive(zip_path)
+    span.end(status='ok' if verified else 'not_verified', bytes_written=os.path.getsize(zip_path))
+    if verified:
+        print('compressed succesfully to',zip_path,', removing folder',path)
+        shutil.rmtree(path)
+    else:
+        print('archive could not be verified, keeping folder',path)
+    return verified, os.path.getsize(zip_path)
+
+
+# In[5]:
+
+
+def new_report(path):
+    Sample, org = parse_path(path)
+    return {'Sample': Sample, 'org': org, 'path': path, 'status': None, 'fasta': None,
+            'size_before': 0, 'temp_freed': 0, 'archive_size': 0, 'reclaimed': 0}
+
+
+# Clean one folder and report the space reclaimed (size of the folder minus its archive if the folder is removed)
+def clean_folder(path, n_threads=archives.n_threads):
+    if not path.endswith('/'):
+        path = path + '/'
+    report = new_report(path)
+    Sample, org = report['Sample'], report['org']
+    report['size_before'] = dir_size(path)
+    if org not in ['pt','nr']:
+        print('wrong parsing of organelle:',org)
+        report['status'] = 'wrong_organelle'
+        return report
+    report['fasta'] = copy_best_fasta(path, Sample, org)
+    if report['fasta'] is None:
+        report['status'] = 'no_fasta'
+        return report
+    report['temp_freed'] = remove_temp(path)
+    verified, report['archive_size'] = archive_folder(path, Sample, org, n_threads)
+    report['status'] = 'archived' if verified else 'not_verified'
+    report['reclaimed'] = report['size_before'] - report['archive_size'] if verified else report['temp_freed']
+    return report
+
+
+# Clean a folder unless it is being cleaned by another process (locked) or was already archived (missing)
+def clean_folder_locked(path, n_threads=archives.n_threads):
+    path = path.rstrip('/') + '/'
+    with open(path.rstrip('/') + '.lock', 'a') as flock:
+        try:
+            fcntl.flock(flock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print('folder being cleaned by another process:',path)
+            return dict(new_report(path), status='locked')
+        try:
+            if not os.path.isdir(path):
+                print('folder already cleaned:',path)
+                return dict(new_report(path), status='missing')
+            return clean_folder(path, n_threads)
+        finally:
+            # removed before release: a process opening it later locks a new file, once this cleanup is done
+            os.remove(path.rstrip('/') + '.lock')
+            fcntl.flock(flock, fcntl.LOCK_UN)
+
+
+# Sweep worker: folders whose log or any file was modified recently are left to their task, and errors are reported
+# instead of stopping the sweep
+def sweep_folder(path, n_threads=archive_threads, min_age=min_age, logs_dir=logs_dir):
+    try:
+        log_path = os.path.join(logs_dir, 'log_' + os.path.basename(path.rstrip('/')) + '.log')
+        log_mtime = os.path.getmtime(log_path) if os.path.isfile(log_path) else 0
+        if time.time() - log_mtime < min_age or time.time() - newest_mtime(path) < min_age:
+            return dict(new_report(path), status='recent')
+        return clean_folder_locked(path, n_threads)
+    except Exception as e:
+        print('error cleaning',path,':',repr(e))
+        return dict(new_report(path), status='error', error=repr(e))
+
+
+# Folders of GetOrg/ whose GetOrganelle log is complete, from the metrics of GetOrg_logs.py (logs_index.csv)
+def finished_folders(getorg_dir=getorg_dir, logs_dir=logs_dir, n_proc=n_proc):
+    import GetOrg_logs
+    folders = [ientry.name for ientry in os.scandir(getorg_dir) if ientry.is_dir()]
+    log_paths = [os.path.join(logs_dir, 'log_' + ifolder + '.log') for ifolder in folders]
+    log_index = GetOrg_logs.LogIndex(logs_index)
+    metrics = log_index.get_metrics(log_paths, n_proc=n_proc)
+    log_index.save()
+    finished = (metrics.Completed_Output==True).tolist()
+    return [os.path.join(getorg_dir, ifolder) + '/' for ifolder, ifinished in zip(folders, finished) if ifinished]
+
+
+# ## Main
+
+# In[6]:
 
 
-zip_path='Archives/' + Sample + '_' + org + '.gz'
-os.system('tar -zcvf ' + zip_path + ' ' + path)
-if os.path.isfile(zip_path):
-    print('compressed succesfully to',zip_path,', removing folder',path)
-    shutil.rmtree(path) 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Process GetOrganelles results and clean tmp folders')
+    parser.add_argument("--path", type=str, help="path of folder to process")
+    parser.add_argument("--sweep", action='store_true', help="process all finished folders of --getorg_dir")
+    parser.add_argument("--getorg_dir", type=str, default=getorg_dir, help="sweep: folder of GetOrganelle results")
+    parser.add_argument("--logs_dir", type=str, default=logs_dir, help="sweep: folder of GetOrganelle logs")
+    parser.add_argument("--n_proc", type=int, default=n_proc, help="sweep: folders cleaned at once")
+    parser.add_argument("--report", type=str, default=sweep_report, help="sweep: space reclaimed by folder")
+    parser.add_argument("--min_age", type=int, default=min_age, help="sweep: skip folders modified less than min_age s ago")
+    args = parser.parse_args()
 
+    if args.sweep:
+        import pandas as pd
+        paths = finished_folders(args.getorg_dir, args.logs_dir, args.n_proc)
+        print(len(paths),'finished folders in',args.getorg_dir)
+        if len(paths) == 0:
+            sys.exit()
+        with ProcessPoolExecutor(max_workers=args.n_proc) as executor:
+            reports = pd.DataFrame(list(executor.map(sweep_folder, paths, [archive_threads] * len(paths),
+                                                     [args.min_age] * len(paths), [args.logs_dir] * len(paths))))
+        reports.to_csv(args.report, index=False)
+        print(reports.groupby('status').size().to_dict())
+        print(round(reports.reclaimed.sum() / 1e9, 2),'GB reclaimed, by folder in',args.report)
+    else:
+        path = args.path
+        print('path to folder:',path)
+        Sample, org = parse_path(path)
+        print('Sample:',Sample)
+        if org in ['pt','nr']:
+            print('organelle:',org)
+        else:
+            print('wrong parsing of organelle:',org)
+            sys.exit()
+        report = clean_folder_locked(path)
+        print(report['status'],', reclaimed',round(report['reclaimed'] / 1e6, 1),'MB')
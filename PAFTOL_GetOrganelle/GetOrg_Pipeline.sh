@@ -3,10 +3,21 @@ module load python/3
 
 # Only arguments needed are DataSource and paftol_export
 # e.g: ./GetOrg_Pipeline.sh 2021-07-27_paftol_export.csv "PAFTOL"
+# Without SLURM, tasks run in a local process pool (job_runner.py):
+# backend=local ./GetOrg_Pipeline.sh 2021-07-27_paftol_export.csv "PAFTOL"
 DataSource=$2
 paftol_export=$1
 rem_search="fasta" # log or fasta
-slurmThrottle=5
+totalMem=${totalMem:-1000000} # MB for all GetOrganelle tasks at once, split in memory tiers
+backend=${backend:-slurm} # slurm or local
+# Stage spans of all tasks of this run are tagged with the same run id, and recorded in run_log.jsonl of each
+# working directory (Pipeline_Utils/telemetry.py)
+export TELEMETRY_RUN=${TELEMETRY_RUN:-$(date +%Y%m%d-%H%M%S)}
+export TELEMETRY_LOG=${TELEMETRY_LOG:-run_log.jsonl}
+export stageQuota=${stageQuota:-500} # GB of fastq copied in Data/
+export baitDB=${baitDB:-} # directory of Refseq_pt.fasta and rDNA barcodes, to bait reads before GetOrganelle
+readcheckDB=${readcheckDB:-} # directory of barcode k-mer indexes (.kmer.npz), to check families from reads first
+readcheckSkip=${readcheckSkip:-no} # yes: Confirmed samples of the read check are not assembled
 
 
 ## Make lists of remaining  samples that have no organelles recovered
@@ -20,49 +31,34 @@ cd $DataSource
 mkdir -p GetOrg; mkdir -p logs; mkdir -p fasta_pt; mkdir -p fasta_nr; mkdir -p Archives;
 
 
-## Copy .fastq.gz files in currrent Data directory
-mkdir -p Data;
-while read iline; do
-	file_path_R1="$(cut -d',' -f2 <<<"$iline")"
-	file_R1=`basename "$file_path_R1"`; file_R1=${file_R1/.gz/}
-	echo $file_R1
-	cp -n $file_path_R1 Data/$file_R1.gz
-
-	file_path_R2="$(cut -d',' -f3 <<<"$iline")"
-	if [ ! -z "$file_path_R2" ]; then
-		file_R2=`basename "$file_path_R2"`; file_R2=${file_R2/.gz/}
-		echo $file_R2
-		cp -n $file_path_R2 Data/$file_R2.gz
-	else
-		echo "No R2"
-	fi
-done < remaining_pt.txt
-
-while read iline; do
-	file_path_R1="$(cut -d',' -f2 <<<"$iline")"
-	file_R1=`basename "$file_path_R1"`; file_R1=${file_R1/.gz/}
-	echo $file_R1
-	cp -n $file_path_R1 Data/$file_R1.gz
+## Provisional family of remaining samples from their first reads (GetOrg_readcheck.py): samples whose reads
+## contradict their family are assembled first, Confirmed samples last (or not at all with readcheckSkip=yes)
+if [ ! -z "$readcheckDB" ]; then
+	if [ $readcheckSkip == yes ]; then skip_confirmed="--skip_confirmed"; else skip_confirmed=""; fi
+	python ../GetOrg_readcheck.py batch --lists remaining_pt.txt remaining_nr.txt --db $readcheckDB $skip_confirmed
+fi
 
-	file_path_R2="$(cut -d',' -f3 <<<"$iline")"
-	if [ ! -z "$file_path_R2" ]; then
-		file_R2=`basename "$file_path_R2"`; file_R2=${file_R2/.gz/}
-		echo $file_R2
-		cp -n $file_path_R2 Data/$file_R2.gz
-	else
-		echo "No R2"
-	fi
-done < remaining_nr.txt
 
+mkdir -p Data;
 
-## Launch remaining pt
-a=($(wc 'remaining_pt.txt')); Ns_pt=${a[0]}; echo $Ns_pt
-if (( $Ns_pt > 0 )); then
-	sbatch --array=1-${Ns_pt}%$slurmThrottle ../GetOrg_array.sh remaining_pt.txt "pt"
-fi
 
-## Launch remaining nr
-a=($(wc 'remaining_nr.txt')); Ns_nr=${a[0]}; echo $Ns_nr
-if (( $Ns_nr > 0 )); then
-	sbatch --array=1-${Ns_nr}%$slurmThrottle ../GetOrg_array.sh remaining_nr.txt "nr"
-fi
+## Launch remaining pt and nr by memory tier, sized from fastq size and past runs (GetOrg_resources.py).
+## Locally, runs killed for lack of memory are retried in the next tier; with SLURM, at the next launch
+## Local tiers run one after the other, each with the whole memory budget
+if [ $backend == local ]; then rounds=3; sequential="--sequential"; else rounds=1; sequential=""; fi
+for iround in $(seq 1 $rounds); do
+	rm -f remaining_*_pt.txt remaining_*_nr.txt
+	if (( $iround > 1 )); then only_oom="--only_oom"; else only_oom=""; fi
+	python ../GetOrg_resources.py --lists remaining_pt.txt remaining_nr.txt --total_mem $totalMem $only_oom $sequential
+	## Stage .fastq.gz files in current Data directory (links or copies up to the quota, in GB) in the order of the plan,
+	## array tasks fetch the rest before running and evict them when done (GetOrg_stage.py)
+	if (( $iround == 1 )); then
+		python ../GetOrg_stage.py stage --lists remaining_pt.txt remaining_nr.txt --quota $stageQuota
+	fi
+	tail -n +2 Resource_plan.csv | while IFS=',' read list_file org state mem cpus Nsamples throttle; do
+		echo $list_file $org $mem MB $cpus cpus, $Nsamples samples, $throttle at a time
+		python ../../Pipeline_Utils/job_runner.py --backend $backend --tasks $list_file --state $state --run $TELEMETRY_RUN \
+			--throttle $throttle --cpus $cpus --mem $mem --total_mem $totalMem \
+			--script ../GetOrg_array.sh --script_args $list_file $org < /dev/null
+	done
+done
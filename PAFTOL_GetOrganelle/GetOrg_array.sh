@@ -6,7 +6,7 @@
 #SBATCH --partition=all
 #SBATCH --mem=80000
 #SBATCH --ntasks=1
-ncpu=4
+ncpu=${SLURM_CPUS_PER_TASK:-4}
 
 module load python/3
 module load blast bowtie2 spades
@@ -27,20 +27,44 @@ echo $file_R1
 
 file_path_R2="$(cut -d',' -f3 <<<"$iline")"
 
+family="$(cut -d',' -f4 <<<"$iline")"
+
+## Stage fastq files of this sample in Data/ if not prefetched, the run fails without them
+if ! python ../GetOrg_stage.py fetch --sample_file $sample_file --task $SLURM_ARRAY_TASK_ID --quota ${stageQuota:-500}; then
+	echo "ERROR $sample, fastq files could not be staged"
+	exit 1
+fi
+
+reads_R1=Data/$file_R1.gz
 if [ ! -z "$file_path_R2" ]; then
 	file_R2=`basename "$file_path_R2"`; file_R2=${file_R2/.gz/}
 	echo $file_R2
-	
+	reads_R2=Data/$file_R2.gz
+fi
+
+## Exit status of GetOrganelle, returned once cleaned up so that crashes and OOM kills are recorded by job_runner
+rc=1
+
+## Bait organelle reads with references of the family if baitDB is set (GetOrg_bait.py), all reads otherwise
+if [ ! -z "$baitDB" ] && python ../GetOrg_bait.py --sample $sample --org $org --family "$family" \
+	--R1 $reads_R1 --R2 "$reads_R2" --db $baitDB; then
+	reads_R1=Baited/${sample}_${org}_R1.fq.gz
+	if [ ! -z "$file_path_R2" ]; then reads_R2=Baited/${sample}_${org}_R2.fq.gz; fi
+fi
+
+if [ ! -z "$file_path_R2" ]; then
 	if [ $org == pt ] 
 	then
-		get_organelle_from_reads.py -1 Data/$file_R1.gz -2 Data/$file_R2.gz -o GetOrg/"$sample"_pt \
+		get_organelle_from_reads.py -1 $reads_R1 -2 $reads_R2 -o GetOrg/"$sample"_pt \
 		--max-reads 536870912 -R 20 -k 21,45,65,85,105 -t $ncpu -F embplant_pt --zip-files > \
 		logs/log_${sample}_pt.log 2> logs/log_${sample}_pt.err
+		rc=$?
 	elif [ $org == nr ]
 	then
-		 get_organelle_from_reads.py -1 Data/$file_R1.gz -2 Data/$file_R2.gz -o GetOrg/"$sample"_nr \
+		 get_organelle_from_reads.py -1 $reads_R1 -2 $reads_R2 -o GetOrg/"$sample"_nr \
 		--max-reads 536870912 -R 10 -k 35,85,115 -t $ncpu -F embplant_nr --zip-files > \
 		logs/log_${sample}_nr.log 2> logs/log_${sample}_nr.err
+		rc=$?
 	fi
 	
 else
@@ -48,18 +72,23 @@ else
 	
 	if [ $org == pt ] 
 	then
-		get_organelle_from_reads.py -u Data/$file_R1.gz -o GetOrg/"$sample"_pt \
+		get_organelle_from_reads.py -u $reads_R1 -o GetOrg/"$sample"_pt \
 		--max-reads 536870912 -R 20 -k 21,45,65,85,105 -t $ncpu -F embplant_pt --zip-files > \
 		logs/log_${sample}_pt.log 2> logs/log_${sample}_pt.err
+		rc=$?
 	elif [ $org == nr ]
 	then
-		get_organelle_from_reads.py -u Data/$file_R1.gz -o GetOrg/"$sample"_nr \
+		get_organelle_from_reads.py -u $reads_R1 -o GetOrg/"$sample"_nr \
 		--max-reads 536870912 -R 10 -k 35,85,115 -t $ncpu -F embplant_nr --zip-files > \
 		logs/log_${sample}_nr.log 2> logs/log_${sample}_nr.err
+		rc=$?
 	fi
 fi
 
 python ../GetOrg_Clean.py --path GetOrg/"$sample"_"$org"/
+rm -f Baited/${sample}_${org}_R1.fq.gz Baited/${sample}_${org}_R2.fq.gz
 
+## Release fastq files, evicted if the other organelle run of the sample is finished
+python ../GetOrg_stage.py release --sample $sample --org $org
 
-
+exit $rc
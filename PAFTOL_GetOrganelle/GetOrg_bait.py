@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # GetOrganelle read baiting
+# Streams the fastq.gz of a sample and keeps only the read pairs sharing k-mers with a seed set, so that GetOrganelle
+# runs on organelle reads rather than on the whole sequencing depth.
+# Seeds are the plastomes of Refseq_pt (pt) or the rDNA references of Barcode_Tests.csv (nr) of the sample's family,
+# completed by one reference per family when the family has too few references. Seed k-mers are cached in Baits/.
+# If too few pairs are kept, no baited file is written (exit 2) and GetOrganelle should run on all reads.
+#
+# python ../GetOrg_bait.py --sample PAFTOL_000001 --org pt --family Fabaceae --R1 Data/PAFTOL_000001_R1.fastq.gz \
+#     --R2 Data/PAFTOL_000001_R2.fastq.gz --db ../Barcode_DB
+
+# In[1]:
+
+
+import pandas as pd
+import numpy as np
+import os
+import sys
+import gzip
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+import kmers
+
+
+# ## Parameters
+
+# In[2]:
+
+
+kmer_size=25
+min_hits=2            # k-mers of a pair found in the seeds
+min_refs=3            # references of the family, completed by other families below this
+max_refs=50           # references in a seed set
+min_pairs=1000        # fewer baited pairs and all reads are used
+bait_dir='Baited'
+seeds_dir='Baits'
+chunk_size=100000
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Reference fastas of the seeds, pt: Refseq_pt, nr: rDNA barcodes of Barcode_Tests.csv
+def get_seed_fastas(db_dir, org):
+    if org == 'pt':
+        return [os.path.join(db_dir, 'Refseq_pt.fasta')]
+    barcodes = pd.read_csv(os.path.join(db_dir, 'Barcode_Tests.csv'), encoding='utf-8-sig')
+    return [os.path.join(db_dir, ibarcode + '.fasta') for ibarcode in barcodes[barcodes.type=='rDNA'].Barcode]
+
+
+# Family of each reference, from _TAXO.csv if it exists, otherwise from the fasta description (;...,f=family,...;)
+def get_ref_families(fasta_path):
+    taxo_file = fasta_path.replace('.fasta', '_TAXO.csv')
+    if os.path.isfile(taxo_file):
+        taxo = pd.read_csv(taxo_file, usecols=['Locus','family']).astype({'Locus':'str'})
+        return dict(zip(taxo.Locus, taxo.family))
+    families={}
+    for seq_id, desc, seq in kmers.read_fasta(fasta_path):
+        fields = dict([ifield.split('=', 1) for ifield in desc.strip(';').split(',') if '=' in ifield])
+        families[seq_id] = fields.get('f')
+    return families
+
+
+# References of the family, completed by one reference per other family
+def select_refs(families, family, min_refs=min_refs, max_refs=max_refs):
+    refs_df = pd.DataFrame({'Locus': list(families), 'family': list(families.values())})
+    selected = list(refs_df[refs_df.family==family].Locus[:max_refs])
+    if len(selected) < min_refs:
+        others = refs_df[(refs_df.family!=family) & (refs_df.family.notnull())].drop_duplicates('family')
+        selected += list(others.Locus[:max_refs - len(selected)])
+    return set(selected)
+
+
+# In[4]:
+
+
+# Sorted unique k-mers of the selected references, cached by organelle, family and k
+def get_seeds(db_dir, org, family, k=kmer_size):
+    os.makedirs(seeds_dir, exist_ok=True)
+    seeds_file = os.path.join(seeds_dir, org + '_' + str(family).replace(' ','_') + '_k' + str(k) + '.npy')
+    if os.path.isfile(seeds_file):
+        return np.load(seeds_file)
+    seeds=[]
+    for fasta_path in get_seed_fastas(db_dir, org):
+        if not os.path.isfile(fasta_path):
+            print('missing reference fasta', fasta_path)
+            continue
+        refs = select_refs(get_ref_families(fasta_path), family)
+        print(len(refs), 'references of', fasta_path)
+        for seq_id, desc, seq in kmers.read_fasta(fasta_path):
+            if seq_id in refs:
+                seeds.append(np.unique(kmers.canonical_kmers(kmers.encode(seq), k)))
+    seeds = np.unique(np.concatenate(seeds)) if len(seeds) > 0 else np.zeros(0, dtype=np.uint64)
+    # written under a name of this process and renamed, as concurrent tasks of the same family load the seeds
+    with open(seeds_file + '.tmp.' + str(os.getpid()), 'wb') as fout:
+        np.save(fout, seeds)
+    os.replace(seeds_file + '.tmp.' + str(os.getpid()), seeds_file)
+    return seeds
+
+
+# In[5]:
+
+
+# Number of seed k-mers of each read of a chunk, reads joined by N so that no k-mer spans two reads
+def read_hits(chunk, seeds, k=kmer_size):
+    seqs = [iread[1] for iread in chunk]
+    starts = np.cumsum([0] + [len(iseq) + 1 for iseq in seqs[:-1]])
+    windows, valid = kmers.kmer_windows(kmers.encode(b'N'.join(seqs)), k)
+    if windows.shape[0] == 0 or seeds.shape[0] == 0:
+        return np.zeros(len(seqs), dtype=np.int64)
+    idx = np.minimum(np.searchsorted(seeds, windows), seeds.shape[0] - 1)
+    hit = valid & (seeds[idx] == windows)
+    read_idx = np.searchsorted(starts, np.flatnonzero(hit), side='right') - 1
+    return np.bincount(read_idx, minlength=len(seqs))
+
+
+def write_reads(fout, chunk, keep):
+    fout.write(b''.join([header + b'\n' + seq + b'\n+\n' + qual + b'\n'
+                         for (header, seq, qual), ikeep in zip(chunk, keep) if ikeep]))
+
+
+# In[6]:
+
+
+# Stream R1 (and R2) and write the pairs with at least min_hits seed k-mers
+def bait_reads(R1, R2, out_prefix, seeds, k=kmer_size, min_hits=min_hits):
+    paths = [R1] if R2 is None else [R1, R2]
+    out_paths = [out_prefix + '_R' + str(iread + 1) + '.fq.gz' for iread in range(len(paths))]
+    fouts = [gzip.open(ipath + '.tmp', 'wb', compresslevel=1) for ipath in out_paths]
+    Ntotal=0; Nkept=0
+    for chunks in zip(*[kmers.read_fastq_chunks(ipath, chunk_size) for ipath in paths]):
+        hits = sum([read_hits(ichunk, seeds, k) for ichunk in chunks])
+        keep = hits >= min_hits
+        for fout, ichunk in zip(fouts, chunks):
+            write_reads(fout, ichunk, keep)
+        Ntotal += keep.shape[0]; Nkept += keep.sum()
+    for fout, ipath in zip(fouts, out_paths):
+        fout.close()
+        os.replace(ipath + '.tmp', ipath)
+    return out_paths, Nkept, Ntotal
+
+
+# ## Main
+
+# In[7]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Keep read pairs sharing k-mers with organelle references, to shrink GetOrganelle input')
+    parser.add_argument("--sample", type=str, help="sample name")
+    parser.add_argument("--org", type=str, help="pt or nr")
+    parser.add_argument("--family", type=str, default=None, help="family of the sample")
+    parser.add_argument("--R1", type=str, help="R1 fastq.gz")
+    parser.add_argument("--R2", type=str, default=None, help="R2 fastq.gz, none for single-end")
+    parser.add_argument("--db", type=str, default='../Barcode_DB', help="directory of Refseq_pt.fasta and Barcode_Tests.csv")
+    parser.add_argument("--k", type=int, default=kmer_size)
+    parser.add_argument("--min_hits", type=int, default=min_hits)
+    args = parser.parse_args()
+
+    seeds = get_seeds(args.db, args.org, args.family, args.k)
+    print(seeds.shape[0], args.org, 'seed k-mers for family', args.family)
+    if seeds.shape[0] == 0:
+        print('no seed k-mers, use all reads')
+        sys.exit(2)
+    os.makedirs(bait_dir, exist_ok=True)
+    R2 = args.R2 if args.R2 not in [None, ''] else None
+    out_paths, Nkept, Ntotal = bait_reads(args.R1, R2, os.path.join(bait_dir, args.sample + '_' + args.org), seeds,
+                                          args.k, args.min_hits)
+    print(Nkept, '/', Ntotal, 'read pairs baited to', ' '.join(out_paths))
+    if Nkept < min_pairs:
+        print('too few baited read pairs, use all reads')
+        for ipath in out_paths:
+            os.remove(ipath)
+        sys.exit(2)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # GetOrganelle logs
+# Metrics of GetOrganelle logs (logs/log_<sample>_<org>.log): completion flags, k-mer values and maxK, assembly status,
+# coverage, repeat patterns and error status.
+# Each log is read once: a single compiled regex of all patterns selects the lines to look at.
+# Logs are parsed in a process pool, and metrics are kept in an index (csv) by log path, size and mtime,
+# so that only new or modified logs are parsed again. Paths of the index are relative to its directory
+# (<DataSource>/logs_index.csv: logs/log_<sample>_<org>.log), whatever the working directory of the caller,
+# and logs removed since are dropped when the index is saved.
+#
+# log_index = GetOrg_logs.LogIndex('logs_index.csv')
+# metrics_df = log_index.get_metrics(list_of_logs)
+# log_index.save()
+
+# In[1]:
+
+
+import os
+import re
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+
+# ## Parameters
+
+# In[2]:
+
+
+# Dictionnary of strings that are either present or absent in the log
+log_TF={'Completed_Reads':'No more reads found and terminated',
+        'Completed_Extending':'Extending finished',
+        'Completed_Assembly':'Assembling finished',
+        'Completed_Slimming':'Slimming assembly graphs finished',
+        'Completed_Output':'Writing output finished',
+        'Warning_Look':'Please ...',
+        'Warning_Multi_Structure':' (gene order) produced',
+        'Warning_Self_Loop':'WARNING: Self-loop contig detected',
+        'Info_Large_Repeats':'Detecting large repeats',
+        'Info_Disentangling_Failed':'Disentangling failed',
+        'K21':'.K21.','K35':'.K35.','K45':'.K45.','K65':'.K65.','K85':'.K85.','K105':'.K105.'}
+
+# Dictionnary of strings of values to recover, {org} is the organelle (pt or nr)
+log_values={'Assembly':'Result status of embplant_{org}: ',
+            'Coverage_Kmer':'embplant_{org} kmer-coverage = ',
+            'Coverage_base':'embplant_{org} base-coverage = ',
+            'Repeat_Pattern':'.repeat_pattern'}
+
+# Errors, the last one found in this list is reported
+error_txts=['No embplant_pt seed reads found!','No embplant_nr seed reads found!','Too few seed reads found!',
+            'ERROR: Error in SPAdes','INFO: Disentangling timeout',
+            "TypeError: 'NoneType' object is not subscriptable",
+            'TypeError: unsupported operand type(s)',
+            'ZeroDivisionError: division by zero','AssertionError','unzipping failed!','ERROR: No valid assembly graph found!',
+            '"No available " + database_name + " information found',
+            "Disentangling failed: 'Unable to generate result with single copy vertex percentage < 50%'"]
+
+Ks=[21,35,45,65,85,105]
+metrics_cols=(list(log_TF) + list(log_values) + ['error','maxK','NRepeat_Pattern','NPath'])
+index_cols=['path','size','mtime','Sample_Name','Organelle'] + metrics_cols
+n_proc=os.cpu_count()
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Sample, organelle and type (log or err) of log file names, e.g. log_PAFTOL_000001_pt.log
+def parse_log_names(files):
+    names = pd.Series(files).str.extract(r'log_(?P<Sample_Name>.+)_(?P<Organelle>pt|nr)\.(?P<Type>log|err)$')
+    names.insert(0, 'file', list(files))
+    return names
+
+
+def get_matcher(org):
+    patterns = list(log_TF.values()) + [ivalue.format(org=org) for ivalue in log_values.values()] + error_txts
+    return re.compile('|'.join([re.escape(ipattern) for ipattern in patterns]))
+
+
+matchers = {iorg: get_matcher(iorg) for iorg in ['pt','nr']}
+
+
+# In[4]:
+
+
+# Metrics of one log, reading it once and testing patterns only on lines matching any of them
+def parse_log(path):
+    names = parse_log_names([os.path.basename(path)]).iloc[0]
+    org = names.Organelle if isinstance(names.Organelle, str) else 'pt'
+    values = {ivariable: istring.format(org=org) for ivariable, istring in log_values.items()}
+    metrics = {ivariable: False for ivariable in log_TF}
+    metrics.update({ivariable: None for ivariable in log_values})
+    error_found = set()
+    with open(path, errors='replace') as fin:
+        for iline in fin:
+            if matchers[org].search(iline) is None:
+                continue
+            iline = iline.rstrip('\n')
+            for ivariable, istring in log_TF.items():
+                if istring in iline:
+                    metrics[ivariable] = True
+            # last value in the log
+            for ivariable, istring in values.items():
+                if istring in iline:
+                    metrics[ivariable] = iline.split(istring)[1]
+            for ierror in error_txts:
+                if ierror in iline:
+                    error_found.add(ierror)
+    errors = [ierror for ierror in error_txts if ierror in error_found]
+    metrics['error'] = errors[-1] if len(errors) > 0 else None
+    metrics['maxK'] = max([iK for iK in Ks if metrics['K' + str(iK)]], default=np.nan)
+    if metrics['Repeat_Pattern'] is not None:
+        pattern = metrics['Repeat_Pattern'].replace('.path_sequence.fasta','').split('.')
+        metrics['NRepeat_Pattern'] = pattern[0]
+        metrics['NPath'] = pattern[1] if len(pattern) > 1 else None
+    if metrics['Assembly'] is not None and 'scaffold' in metrics['Assembly']:
+        metrics['Assembly'] = 'scaffold'
+    metrics.update({'Sample_Name': names.Sample_Name, 'Organelle': names.Organelle})
+    return metrics
+
+
+# In[5]:
+
+
+def file_key(path):
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return None
+
+
+class LogIndex:
+    def __init__(self, index_path='logs_index.csv'):
+        self.index_path = index_path
+        self.index_dir = os.path.dirname(index_path) if index_path is not None else ''
+        self.index = {}
+        if index_path is not None and os.path.isfile(index_path):
+            for row in pd.read_csv(index_path).to_dict('records'):
+                self.index[row['path']] = row
+
+    # Path of a log in the index, relative to the directory of the index
+    def index_key(self, path):
+        return os.path.relpath(path, self.index_dir or '.')
+
+    def save(self):
+        if self.index_path is None:
+            return
+        rows = [row for ikey, row in self.index.items() if os.path.isfile(os.path.join(self.index_dir, ikey))]
+        pd.DataFrame(rows, columns=index_cols).to_csv(self.index_path + '.tmp', index=False)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    # Metrics of logs (one row per path, NaN if missing), parsing new or modified logs only
+    def get_metrics(self, paths, n_proc=n_proc):
+        keys = {ipath: file_key(ipath) for ipath in set(paths)}
+        index_keys = {ipath: self.index_key(ipath) for ipath in keys}
+        todo = [ipath for ipath, ikey in keys.items() if ikey is not None and (index_keys[ipath] not in self.index or
+                (self.index[index_keys[ipath]]['size'], self.index[index_keys[ipath]]['mtime']) != ikey)]
+        if len(todo) > 0:
+            if n_proc > 1 and len(todo) > 1:
+                with ProcessPoolExecutor(max_workers=n_proc) as executor:
+                    metrics = list(executor.map(parse_log, todo, chunksize=max(1, len(todo) // (4 * n_proc))))
+            else:
+                metrics = [parse_log(ipath) for ipath in todo]
+            for ipath, imetrics in zip(todo, metrics):
+                self.index[index_keys[ipath]] = dict(path=index_keys[ipath], size=keys[ipath][0], mtime=keys[ipath][1],
+                                                     **imetrics)
+        # rows with the paths of the caller
+        rows = [dict(self.index[index_keys[ipath]], path=ipath) if keys[ipath] is not None else {'path': ipath}
+                for ipath in paths]
+        return pd.DataFrame(rows, columns=index_cols)
+
+
+# ## Main
+
+# In[6]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Metrics of GetOrganelle logs, indexed by log file')
+    parser.add_argument("--logs", type=str, default='logs/', help="directory of GetOrganelle logs")
+    parser.add_argument("--index", type=str, default='logs_index.csv', help="index of log metrics, updated")
+    parser.add_argument("--n_proc", type=int, default=n_proc)
+    args = parser.parse_args()
+
+    log_files = parse_log_names(sorted(os.listdir(args.logs)))
+    log_files = log_files[log_files.Type == 'log']
+    log_index = LogIndex(args.index)
+    metrics_df = log_index.get_metrics([os.path.join(args.logs, ifile) for ifile in log_files.file], n_proc=args.n_proc)
+    log_index.save()
+    print(metrics_df.shape[0], 'logs,', metrics_df.Completed_Output.sum(), 'completed,',
+          metrics_df.error.notnull().sum(), 'with errors, metrics in', args.index)
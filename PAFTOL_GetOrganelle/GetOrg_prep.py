@@ -13,6 +13,11 @@
 import pandas as pd
 import os; import sys
 import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+import fs_inventory
+import sample_registry
+import GetOrg_logs
+import telemetry
 
 
 # In[2]:
@@ -43,41 +48,38 @@ rem_search = args.rem_search
 # In[4]:
 
 
-# Load export for datasource
-db = pd.read_csv(export_file)
-db = db[(db.DataSource==DataSource) & (db.R1FastqFile.notnull())]
-if DataSource == 'PAFTOL':
-    fastq_path = '/science/projects/paftol/AllData_symlinks/'
-    db['Sample_Name'] = 'PAFTOL_' + db['idSequencing'].astype(int).astype('str').str.zfill(6)
-    db['R1_path'] = fastq_path + db.Sample_Name + '_R1.fastq.gz'
-    db['R2_path'] = fastq_path + db.Sample_Name + '_R2.fastq.gz'
-elif DataSource == 'GAP':
-    fastq_path = '/science/projects/paftol/AllData_symlinks/'
-    db['Sample_Name'] = 'GAP_' + db['idSequencing'].astype(int).astype('str').str.zfill(6)
-    db['R1_path'] = fastq_path + db.Sample_Name + '_R1.fastq.gz'
-    db['R2_path'] = fastq_path + db.Sample_Name + '_R2.fastq.gz'
-elif DataSource == 'SRA':
-    fastq_path = '/data/projects/paftol/SRA_Data/'
-    db['Sample_Name'] = db.ExternalSequenceID
-    db['R1_path'] = fastq_path + db.R1FastqFile
-    db['R2_path'] = fastq_path + db.R2FastqFile
-else:
+# Load export for datasource, from its sample registry (Sample name and fastq paths precomputed)
+if DataSource not in sample_registry.fastq_paths:
     print('unknown action for',DataSource)
     sys.exit()
-
+span = telemetry.start('prep_registry', DataSource=DataSource)
+db = sample_registry.open_registry(export_file).datasource(DataSource)
+span.end(rows_out=db.shape[0])
+db = db[db.R1FastqFile.notnull()]
+db['Sample_Name'] = db.Sample
+
+# Family of samples, 4th field of remaining lists, to bait reads (GetOrg_bait.py)
+if 'Family' not in db.columns:
+    db['Family']=''
 print(db.shape[0],'samples in total')
 
 
 # In[5]:
 
 
+# Cached inventory of fasta, logs and fastq files
+inventory = fs_inventory.Inventory(DataSource + '/.fs_inventory.pkl')
+inv_cols = ['file','size','mtime','is_dir']
+
+
 # List fasta_pt and fasta_nr
+span = telemetry.start('prep_fs_scan', DataSource=DataSource)
 db['fasta_pt']=False; db['fasta_nr']=False;
-fasta_pt = pd.DataFrame(os.listdir(DataSource + '/fasta_pt/'),columns=['file'])
+fasta_pt = pd.DataFrame(inventory.list_dir(DataSource + '/fasta_pt/'),columns=inv_cols)
 if fasta_pt.shape[0]>0:
     fasta_pt['Sample_Name'] = fasta_pt.file.str.split('_pt',expand=True)[0]
     db['fasta_pt']=db.Sample_Name.isin(fasta_pt.Sample_Name)
-fasta_nr = pd.DataFrame(os.listdir(DataSource + '/fasta_nr/'),columns=['file'])
+fasta_nr = pd.DataFrame(inventory.list_dir(DataSource + '/fasta_nr/'),columns=inv_cols)
 if fasta_nr.shape[0]>0:
     fasta_nr['Sample_Name'] = fasta_nr.file.str.split('_nr',expand=True)[0]
     db['fasta_nr']=db.Sample_Name.isin(fasta_nr.Sample_Name)
@@ -90,34 +92,42 @@ print(db.fasta_nr.sum(),'/',db.shape[0],'nr recovered')
 
 # Check logs
 db['log_pt']=False; db['log_nr']=False;
-logs_df = pd.DataFrame(os.listdir(DataSource + '/logs/'),columns=['file'])
+logs_df = pd.DataFrame(inventory.list_dir(DataSource + '/logs/', stat=True),columns=inv_cols)
 if logs_df.shape[0]>0:
-    logs_df['Sample_Name'] = logs_df.file.str.split('log_',expand=True)[1]
-    logs_df['Type'] = logs_df.Sample_Name.str.split('.',expand=True)[1]
-    logs_df['Sample_Name'] = logs_df.Sample_Name.str.split('.',expand=True)[0]
-    logs_df['Organelle'] = logs_df.Sample_Name.str.split('_').str[-1]
-    logs_df['Sample_Name'] = logs_df.Sample_Name.str.replace('_nr','').str.replace('_pt','')
-    logs_df['filesize']=logs_df.file.apply(lambda x: os.stat(DataSource + '/logs/' + x).st_size)
+    logs_df = pd.merge(logs_df, GetOrg_logs.parse_log_names(logs_df.file), on='file')
+    logs_df['filesize']=logs_df['size']
     db['log_pt']=db.Sample_Name.isin(logs_df[(logs_df.Type=='log') & (logs_df.Organelle=='pt')]['Sample_Name'])
     db['log_nr']=db.Sample_Name.isin(logs_df[(logs_df.Type=='log') & (logs_df.Organelle=='nr')]['Sample_Name'])
+span.end(rows_in=db.shape[0], rows_out=fasta_pt.shape[0] + fasta_nr.shape[0] + logs_df.shape[0])
 print(db.log_pt.sum(),'/',db.shape[0],'pt processed')
 print(db.log_nr.sum(),'/',db.shape[0],'nr processed')
 if logs_df.shape[0]>0:
-    db['error_pt']=pd.merge(db, logs_df[(logs_df.Type=='err') & (logs_df.Organelle=='pt')]).filesize > 0
-    db['error_nr']=pd.merge(db, logs_df[(logs_df.Type=='err') & (logs_df.Organelle=='nr')]).filesize > 0
+    db['error_pt']=db.Sample_Name.isin(logs_df[(logs_df.Type=='err') & (logs_df.Organelle=='pt') & (logs_df.filesize>0)]['Sample_Name'])
+    db['error_nr']=db.Sample_Name.isin(logs_df[(logs_df.Type=='err') & (logs_df.Organelle=='nr') & (logs_df.filesize>0)]['Sample_Name'])
     print(db.error_pt.sum(),'/',db.shape[0],'error during pt recovery')
     print(db.error_nr.sum(),'/',db.shape[0],'error during nr recovery')
 
+    # Metrics of GetOrganelle logs, only new or modified logs are parsed
+    span = telemetry.start('prep_log_metrics', DataSource=DataSource)
+    log_index = GetOrg_logs.LogIndex(DataSource + '/logs_index.csv')
+    log_metrics = log_index.get_metrics(list(DataSource + '/logs/' + logs_df[logs_df.Type=='log'].file))
+    log_index.save()
+    span.end(rows_in=(logs_df.Type=='log').sum(), rows_out=log_metrics.shape[0])
+    for iorg in ['pt','nr']:
+        org_metrics = log_metrics[log_metrics.Organelle==iorg]
+        print(iorg,'logs:',(org_metrics.Completed_Output==True).sum(),'completed,',
+              org_metrics.error.notnull().sum(),'with errors',org_metrics.groupby('error').size().to_dict())
+
 
 # In[7]:
 
 
 if rem_search == 'fasta':
-    todo_pt = db[(db.fasta_pt==False)][['Sample_Name','R1_path','R2_path']]
-    todo_nr = db[(db.fasta_nr==False)][['Sample_Name','R1_path','R2_path']]
+    todo_pt = db[(db.fasta_pt==False)][['Sample_Name','R1_path','R2_path','Family']]
+    todo_nr = db[(db.fasta_nr==False)][['Sample_Name','R1_path','R2_path','Family']]
 elif rem_search == 'log':
-    todo_pt = db[(db.log_pt==False)][['Sample_Name','R1_path','R2_path']]
-    todo_nr = db[(db.log_nr==False)][['Sample_Name','R1_path','R2_path']]
+    todo_pt = db[(db.log_pt==False)][['Sample_Name','R1_path','R2_path','Family']]
+    todo_nr = db[(db.log_nr==False)][['Sample_Name','R1_path','R2_path','Family']]
 if todo_pt.shape[0]>0:
     print('\n',todo_pt.shape[0],DataSource,'samples listed for pt recovery')
 if todo_nr.shape[0]>0:
@@ -127,29 +137,28 @@ if todo_nr.shape[0]>0:
 # In[ ]:
 
 
-if todo_pt.shape[0]>0:
-    for idx, row in todo_pt.iterrows():
-#         print(row['R1_path'],end=':'); print(os.path.exists(row['R1_path']))
-        todo_pt.loc[idx,'R1_exist'] = os.path.exists(row['R1_path'])
-#         print(row['R2_path'],end=':'); print(os.path.exists(row['R2_path']))
-        todo_pt.loc[idx,'R2_exist'] = os.path.exists(row['R2_path'])
+# Check fastq files of pt and nr lists at once, concurrently
+span = telemetry.start('prep_fastq_check', DataSource=DataSource)
+fastq_paths = pd.concat([todo_pt.R1_path, todo_pt.R2_path, todo_nr.R1_path, todo_nr.R2_path]).dropna().unique()
+fastq_exist = dict(zip(fastq_paths, inventory.exists_many(list(fastq_paths))))
+inventory.save()
+span.end(rows_in=len(fastq_paths), rows_out=sum(fastq_exist.values()))
+
+todo_pt['R1_exist'] = todo_pt.R1_path.map(fastq_exist).fillna(False).astype(bool)
+todo_pt['R2_exist'] = todo_pt.R2_path.map(fastq_exist).fillna(False).astype(bool)
 todo_pt = todo_pt[(todo_pt.R1_exist) & (todo_pt.R2_exist)]
 if todo_pt.shape[0]>0:
     print(todo_pt.shape[0],'paired-end fastq files found')
-    todo_pt[['Sample_Name','R1_path','R2_path']].to_csv(DataSource + '/remaining_pt.txt',index=False,header=None)
+    todo_pt[['Sample_Name','R1_path','R2_path','Family']].to_csv(DataSource + '/remaining_pt.txt',index=False,header=None)
 else:
     print('no fastq file found or no sample to process, remaining list not written')
 
-if todo_nr.shape[0]>0:
-    for idx, row in todo_nr.iterrows():
-#         print(row['R1_path'],end=':'); print(os.path.exists(row['R1_path']))
-        todo_nr.loc[idx,'R1_exist'] = os.path.exists(row['R1_path'])
-#         print(row['R2_path'],end=':'); print(os.path.exists(row['R2_path']))
-        todo_nr.loc[idx,'R2_exist'] = os.path.exists(row['R2_path'])
+todo_nr['R1_exist'] = todo_nr.R1_path.map(fastq_exist).fillna(False).astype(bool)
+todo_nr['R2_exist'] = todo_nr.R2_path.map(fastq_exist).fillna(False).astype(bool)
 todo_nr = todo_nr[(todo_nr.R1_exist) & (todo_nr.R2_exist)]
 if todo_nr.shape[0]>0:
     print(todo_nr.shape[0],'paired-end fastq files found')
-    todo_nr[['Sample_Name','R1_path','R2_path']].to_csv(DataSource + '/remaining_nr.txt',index=False,header=None)
+    todo_nr[['Sample_Name','R1_path','R2_path','Family']].to_csv(DataSource + '/remaining_nr.txt',index=False,header=None)
 else:
     print('no fastq file found or no sample to process, remaining list not written')
 
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # Read-level family check
+# Streams the first read pairs of a sample's fastq.gz and matches their sketch k-mers with the k-mer indexes of the
+# barcode databases (<Barcode>.kmer.npz of Kmer_prescreen.py build), before any organelle assembly.
+# A read pair is assigned to the family (and genus) sharing most of its k-mers, if at least min_hits and without tie.
+# Read support of each taxon is saved in Read_check/<sample>_support.csv, and the provisional call of the sample is
+# Confirmed if at least min_reads pairs are assigned and min_frac of them support the family of the sample,
+# Rejected if as many support another family of the databases, and Inconclusive otherwise.
+# In batch, remaining lists are reordered so that Rejected samples are assembled first and Confirmed samples last
+# (or skipped with --skip_confirmed), and calls of all samples are saved in Read_check.csv. The lists are then split in
+# memory tiers (GetOrg_resources.py), which keep this order within each tier only.
+#
+# python ../GetOrg_readcheck.py run --sample PAFTOL_000001 --family Fabaceae --R1 Data/PAFTOL_000001_R1.fastq.gz \
+#     --R2 Data/PAFTOL_000001_R2.fastq.gz --db ../Barcode_DB
+# python ../GetOrg_readcheck.py batch --lists remaining_pt.txt remaining_nr.txt --db ../Barcode_DB
+
+# In[1]:
+
+
+import pandas as pd
+import numpy as np
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+import kmers
+
+
+# ## Parameters
+
+# In[2]:
+
+
+max_pairs=200000      # read pairs streamed per sample
+min_hits=2            # sketch k-mers of a pair shared with its taxon
+min_reads=20          # assigned pairs for a call
+min_frac=0.8          # fraction of assigned pairs supporting the call
+tax_levels=['family','genus']
+check_dir='Read_check'
+summary_file='Read_check.csv'
+chunk_size=50000
+n_proc=4
+status_order={'Rejected': 0, 'Inconclusive': 1, 'Confirmed': 2}
+
+
+# ## Functions
+
+# In[3]:
+
+
+# K-mer indexes of the barcodes of Barcode_Tests.csv that have one, with taxon codes of their references
+def load_indexes(db_dir, barcodes=None):
+    tests = pd.read_csv(os.path.join(db_dir, 'Barcode_Tests.csv'), encoding='utf-8-sig')
+    indexes={}
+    for ibarcode in tests.Barcode:
+        index_path = os.path.join(db_dir, ibarcode + '.kmer.npz')
+        if (barcodes is not None and ibarcode not in barcodes) or not os.path.isfile(index_path):
+            continue
+        with np.load(index_path) as npz:
+            index = {ikey: npz[ikey] for ikey in ['hashes','ref_idx','family','genus','k','scale']}
+        for itax in tax_levels:
+            codes, taxa = pd.factorize(pd.Series(index[itax]).replace('', np.nan))
+            index[itax + '_codes'] = codes
+            index[itax + '_taxa'] = np.array(taxa, dtype=str)
+            # unique (hash, taxon) pairs of the references, sorted by hash: a read hash is matched once per taxon
+            hashes, hash_taxa = index['hashes'], codes[index['ref_idx']]
+            hashes, hash_taxa = hashes[hash_taxa >= 0], hash_taxa[hash_taxa >= 0]
+            order = np.lexsort((hash_taxa, hashes))
+            hashes, hash_taxa = hashes[order], hash_taxa[order]
+            first = np.concatenate([[True], (hashes[1:] != hashes[:-1]) | (hash_taxa[1:] != hash_taxa[:-1])])
+            index[itax + '_hashes'] = hashes[first]
+            index[itax + '_hash_taxa'] = hash_taxa[first]
+        indexes[ibarcode] = index
+    return indexes
+
+
+# Families of the references of all indexes
+def db_families(db_dir, barcodes=None):
+    families=set()
+    tests = pd.read_csv(os.path.join(db_dir, 'Barcode_Tests.csv'), encoding='utf-8-sig')
+    for ibarcode in tests.Barcode:
+        index_path = os.path.join(db_dir, ibarcode + '.kmer.npz')
+        if (barcodes is None or ibarcode in barcodes) and os.path.isfile(index_path):
+            with np.load(index_path) as npz:
+                families.update(npz['family'])
+    families.discard('')
+    return families
+
+
+# In[4]:
+
+
+# Unique sketch hashes of each read pair of a chunk (R1 and R2 reads of a pair at the same position)
+def pair_hashes(chunks, k, scale):
+    pairs=[]; hashes=[]
+    for ichunk in chunks:
+        seqs = [iread[1] for iread in ichunk]
+        starts = np.cumsum([0] + [len(iseq) + 1 for iseq in seqs[:-1]])
+        windows, valid = kmers.kmer_windows(kmers.encode(b'N'.join(seqs)), k)
+        ihashes = kmers.hash_kmers(windows)
+        pos = np.flatnonzero(valid & (ihashes <= kmers.max_hash // np.uint64(scale)))
+        pairs.append(np.searchsorted(starts, pos, side='right') - 1)
+        hashes.append(ihashes[pos])
+    pairs = np.concatenate(pairs); hashes = np.concatenate(hashes)
+    order = np.lexsort((hashes, pairs))
+    pairs, hashes = pairs[order], hashes[order]
+    first = np.concatenate([[True], (pairs[1:] != pairs[:-1]) | (hashes[1:] != hashes[:-1])])
+    return pairs[first], hashes[first]
+
+
+# Number of pairs assigned to each taxon of an index: the taxon sharing most hashes with the pair, without tie
+def assign_pairs(pairs, hashes, index, itax, min_hits=min_hits):
+    Ntaxa = index[itax + '_taxa'].shape[0]
+    left = np.searchsorted(index[itax + '_hashes'], hashes, side='left')
+    right = np.searchsorted(index[itax + '_hashes'], hashes, side='right')
+    counts = right - left
+    if Ntaxa == 0 or counts.sum() == 0:
+        return np.zeros(Ntaxa, dtype=np.int64)
+    # taxa of every matched hash, hashes being unique in each pair and (hash, taxon) unique in the index
+    taxa = index[itax + '_hash_taxa'][np.arange(counts.sum()) + np.repeat(left - (np.cumsum(counts) - counts), counts)]
+    # hashes shared by each pair and taxon
+    keys, Nhits = np.unique(np.repeat(pairs, counts).astype(np.int64) * Ntaxa + taxa, return_counts=True)
+    kpairs, ktaxa = keys // Ntaxa, keys % Ntaxa
+    order = np.lexsort((-Nhits, kpairs))
+    kpairs, ktaxa, Nhits = kpairs[order], ktaxa[order], Nhits[order]
+    first = np.concatenate([[True], kpairs[1:] != kpairs[:-1]])
+    tie = np.concatenate([(kpairs[1:] == kpairs[:-1]) & (Nhits[1:] == Nhits[:-1]), [False]])
+    assigned = first & ~tie & (Nhits >= min_hits)
+    return np.bincount(ktaxa[assigned], minlength=Ntaxa)
+
+
+# In[5]:
+
+
+# Read support of each taxon, from the first max_pairs read pairs of R1 (and R2)
+def read_support(R1, R2, indexes, max_pairs=max_pairs, min_hits=min_hits):
+    paths = [R1] if R2 is None else [R1, R2]
+    support = {(ibarcode, itax): np.zeros(index[itax + '_taxa'].shape[0], dtype=np.int64)
+               for ibarcode, index in indexes.items() for itax in tax_levels}
+    Npairs=0
+    for chunks in zip(*[kmers.read_fastq_chunks(ipath, min(chunk_size, max_pairs)) for ipath in paths]):
+        chunks = [ichunk[:max_pairs - Npairs] for ichunk in chunks]
+        # hashes computed once per k-mer size and scale
+        chunk_hashes={}
+        for ibarcode, index in indexes.items():
+            ikey = (int(index['k']), int(index['scale']))
+            if ikey not in chunk_hashes:
+                chunk_hashes[ikey] = pair_hashes(chunks, *ikey)
+            for itax in tax_levels:
+                support[(ibarcode, itax)] += assign_pairs(*chunk_hashes[ikey], index, itax, min_hits)
+        Npairs += len(chunks[0])
+        if Npairs >= max_pairs:
+            break
+    rows=[]
+    for (ibarcode, itax), icounts in support.items():
+        taxa = indexes[ibarcode][itax + '_taxa']
+        rows += [{'Barcode': ibarcode, 'tax_level': itax, 'taxon': taxa[i], 'Nreads': icounts[i]}
+                 for i in np.flatnonzero(icounts)]
+    return pd.DataFrame(rows, columns=['Barcode','tax_level','taxon','Nreads']), Npairs
+
+
+
+# Provisional call of a sample from its read support (pairs assigned in each barcode database, summed),
+# and status for the family of the sample if it is in the databases
+def call_sample(support, family, families, min_reads=min_reads, min_frac=min_frac):
+    call={'Family': family}
+    for itax in tax_levels:
+        itaxa = support[support.tax_level==itax].groupby('taxon').Nreads.sum().sort_values(ascending=False)
+        call[itax + '_call'] = itaxa.index[0] if itaxa.shape[0] > 0 else np.nan
+        call[itax + '_reads'] = itaxa.iloc[0] if itaxa.shape[0] > 0 else 0
+        call[itax + '_assigned'] = itaxa.sum()
+    confident = call['family_reads'] >= max(min_reads, min_frac * call['family_assigned'])
+    if pd.isnull(family) or family not in families or not confident:
+        call['Status'] = 'Inconclusive'
+    elif call['family_call'] == family:
+        call['Status'] = 'Confirmed'
+    else:
+        call['Status'] = 'Rejected'
+    return call
+
+
+# In[6]:
+
+
+# Read support of one sample, saved in check_dir (read again if it exists)
+def check_sample(sample, R1, R2, db_dir, barcodes=None, max_pairs=max_pairs):
+    support_file = os.path.join(check_dir, sample + '_support.csv')
+    if os.path.isfile(support_file):
+        return pd.read_csv(support_file)
+    support, Npairs = read_support(R1, R2, load_indexes(db_dir, barcodes), max_pairs)
+    print(sample, Npairs, 'read pairs,', support[support.tax_level=='family'].Nreads.sum(), 'assigned to a family')
+    os.makedirs(check_dir, exist_ok=True)
+    support.to_csv(support_file + '.tmp', index=False)
+    os.replace(support_file + '.tmp', support_file)
+    return support
+
+
+# Unreadable fastq files (missing, truncated gzip) give no support, so that the sample is Inconclusive
+def check_row(row, db_dir, barcodes, max_pairs):
+    try:
+        return check_sample(row['Sample_Name'], row['R1_path'], row['R2_path'], db_dir, barcodes, max_pairs)
+    except (OSError, EOFError) as e:
+        print(row['Sample_Name'], 'fastq not readable:', e)
+        return pd.DataFrame(columns=['Barcode','tax_level','taxon','Nreads'])
+
+
+# Samples of the remaining lists (Sample_Name, R1_path, R2_path, Family), once per sample
+def read_lists(list_files):
+    lists = [pd.read_csv(ilist, header=None, names=['Sample_Name','R1_path','R2_path','Family'])
+             for ilist in list_files if os.path.isfile(ilist) and os.stat(ilist).st_size > 0]
+    if len(lists) == 0:
+        return pd.DataFrame(columns=['Sample_Name','R1_path','R2_path','Family'])
+    return pd.concat(lists).drop_duplicates('Sample_Name')
+
+
+# Rewrite a remaining list with Rejected samples first and Confirmed samples last (or removed)
+def prioritize(list_file, calls, skip_confirmed=False):
+    if not os.path.isfile(list_file):
+        return
+    with open(list_file) as fin:
+        lines = fin.readlines()
+    status = calls.set_index('Sample_Name').Status
+    ranks = [status_order.get(status.get(iline.split(',')[0]), 1) for iline in lines]
+    lines = [iline for irank, iline in sorted(zip(ranks, lines), key=lambda x: x[0])
+             if not (skip_confirmed and irank == status_order['Confirmed'])]
+    with open(list_file + '.tmp', 'w') as fout:
+        fout.write(''.join(lines))
+    os.replace(list_file + '.tmp', list_file)
+
+
+# ## Main
+
+# In[7]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Provisional family of samples from k-mers of their reads, before organelle assembly')
+    parser.add_argument("action", type=str, help="run: check one sample, "
+                        "batch: check the samples of remaining lists and reorder the lists")
+    parser.add_argument("--sample", type=str, help="run: sample name")
+    parser.add_argument("--family", type=str, default=None, help="run: family of the sample")
+    parser.add_argument("--R1", type=str, help="run: R1 fastq.gz")
+    parser.add_argument("--R2", type=str, default=None, help="run: R2 fastq.gz, none for single-end")
+    parser.add_argument("--lists", type=str, nargs='+', help="batch: remaining lists (e.g. remaining_pt.txt)")
+    parser.add_argument("--skip_confirmed", action='store_true', help="batch: remove Confirmed samples from the lists")
+    parser.add_argument("--db", type=str, default='../Barcode_DB',
+                        help="directory of Barcode_Tests.csv and k-mer indexes (<Barcode>.kmer.npz)")
+    parser.add_argument("--barcodes", type=str, nargs='*', default=None, help="barcodes to use, all indexed by default")
+    parser.add_argument("--max_pairs", type=int, default=max_pairs)
+    parser.add_argument("--n_proc", type=int, default=n_proc)
+    args = parser.parse_args()
+
+    families = db_families(args.db, args.barcodes)
+    if len(families) == 0:
+        print('no k-mer index in', args.db, ', run Kmer_prescreen.py build on the barcode databases')
+        sys.exit(2)
+
+    if args.action == 'run':
+        R2 = args.R2 if args.R2 not in [None, ''] else None
+        support = check_sample(args.sample, args.R1, R2, args.db, args.barcodes, args.max_pairs)
+        call = call_sample(support, args.family, families)
+        print(pd.Series(call).to_string())
+        print(support.sort_values('Nreads', ascending=False).groupby('tax_level').head(5).to_string(index=False))
+
+    elif args.action == 'batch':
+        samples = read_lists(args.lists)
+        samples['R2_path'] = samples.R2_path.astype(object).where(samples.R2_path.notnull(), None)
+        print(samples.shape[0], 'samples to check,',
+              samples.Sample_Name.map(lambda x: os.path.isfile(os.path.join(check_dir, x + '_support.csv'))).sum(),
+              'already checked')
+        rows = samples.to_dict('records')
+        with ProcessPoolExecutor(max_workers=args.n_proc) as executor:
+            supports = list(executor.map(check_row, rows, [args.db] * len(rows), [args.barcodes] * len(rows),
+                                         [args.max_pairs] * len(rows)))
+        calls = pd.DataFrame([dict(Sample_Name=irow['Sample_Name'], **call_sample(isupport, irow['Family'], families))
+                              for irow, isupport in zip(rows, supports)])
+        if os.path.isfile(summary_file) and calls.shape[0] > 0:
+            previous = pd.read_csv(summary_file)
+            calls = pd.concat([previous[~previous.Sample_Name.isin(calls.Sample_Name)], calls])
+        if calls.shape[0] > 0:
+            calls.to_csv(summary_file, index=False)
+            print(calls[calls.Sample_Name.isin(samples.Sample_Name)].groupby('Status').size().to_dict())
+            rejected = calls[(calls.Status=='Rejected') & calls.Sample_Name.isin(samples.Sample_Name)]
+            if rejected.shape[0] > 0:
+                print(rejected.shape[0], 'samples with reads of another family:')
+                print(rejected[['Sample_Name','Family','family_call','family_reads','family_assigned']]
+                      .to_string(index=False))
+            for ilist in args.lists:
+                prioritize(ilist, calls, args.skip_confirmed)
+    else:
+        print('unknown action', args.action)
+        sys.exit(2)
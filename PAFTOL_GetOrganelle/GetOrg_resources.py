@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # GetOrganelle resources
+# Sizes GetOrganelle tasks from their input and from past runs.
+# Past runs are read from the job_runner state files (remaining_<org>.txt.runner.csv): peak memory and elapsed time
+# of local runs, or from sacct for SLURM runs, and are kept with the size of their fastq files in GetOrg_resources.csv.
+# Peak memory is fitted against fastq size per organelle, and each remaining sample is assigned the smallest memory tier
+# above its prediction. Samples killed for lack of memory are assigned the tier above the one they failed in.
+# Runs are killed for lack of memory when they exit with a kill signal, or when the GetOrganelle error log of the run
+# (logs/log_<sample>_<org>.err) reports a memory error, e.g. MemoryError with an address space limit (--enforce_mem).
+# Remaining lists are split by tier (remaining_<mem>_<org>.txt), and the concurrency of each tier is set so that
+# all tiers fit in the memory budget, or so that each tier uses the whole budget when tiers run one after the other
+# (--sequential, local runs). The plan is written in Resource_plan.csv, read by GetOrg_Pipeline.sh.
+#
+# python ../GetOrg_resources.py --lists remaining_pt.txt remaining_nr.txt --total_mem 1000000
+
+# In[1]:
+
+
+import pandas as pd
+import numpy as np
+import os
+import subprocess
+import argparse
+
+
+# ## Parameters
+
+# In[2]:
+
+
+mem_tiers=[16000,32000,64000,80000,128000,192000]  # MB
+default_mem=80000     # without enough past runs
+cpus=4
+total_mem=1000000     # MB for all GetOrganelle tasks at once
+max_throttle=50
+min_history=10        # successful runs to fit the model
+margin=1.25
+oom_exit_codes=[137,-9]
+mem_errors=['MemoryError','std::bad_alloc','Cannot allocate memory','Out of memory','out of memory']
+history_file='GetOrg_resources.csv'
+history_cols=['sample','org','job','input_mb','mem','status','exit_code','elapsed_s','maxrss_mb','oom']
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Total size of the fastq files of each sample of a remaining list, in MB
+def input_sizes(list_file):
+    sizes={}
+    with open(list_file) as fin:
+        for iline in fin:
+            fields = iline.strip().split(',')
+            size=0
+            for ipath in fields[1:3]:
+                if ipath != '' and os.path.exists(ipath):
+                    size += os.path.getsize(ipath)
+            sizes[fields[0]] = size / 1024**2
+    return sizes
+
+
+# In[4]:
+
+
+# MaxRSS (MB), elapsed (s), state and exit code of the tasks of slurm array jobs
+def read_sacct(job_ids):
+    cmd = ['sacct', '-n', '-P', '-j', ','.join(job_ids), '--format=JobID,State,ExitCode,ElapsedRaw,MaxRSS']
+    try:
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    except OSError:
+        print('sacct not available, slurm runs ignored')
+        return pd.DataFrame(columns=['job','state','exit_code','elapsed_s','maxrss_mb'])
+    rows=[]
+    for iline in out.splitlines():
+        job, state, exit_code, elapsed, maxrss = iline.split('|')
+        units = {'K': 1/1024, 'M': 1, 'G': 1024}
+        rss = float(maxrss[:-1]) * units[maxrss[-1]] if maxrss[-1:] in units else np.nan
+        rows.append({'job': job.split('.')[0], 'state': state.split(' ')[0], 'exit_code': int(exit_code.split(':')[0]),
+                     'elapsed_s': float(elapsed or 'nan'), 'maxrss_mb': rss})
+    sacct = pd.DataFrame(rows, columns=['job','state','exit_code','elapsed_s','maxrss_mb'])
+    # job line has the state, steps (.batch) have the memory
+    return sacct.groupby('job').agg({'state':'first','exit_code':'max','elapsed_s':'max','maxrss_mb':'max'}).reset_index()
+
+
+# Memory error in the error log of a run, written between its start and end (the log is overwritten by the next run)
+def log_mem_error(log_file, start, end, tail_bytes=65536):
+    if not os.path.isfile(log_file):
+        return False
+    mtime = os.path.getmtime(log_file)
+    if mtime < start or (not np.isnan(end) and mtime > end + 60):
+        return False
+    with open(log_file, 'rb') as fin:
+        fin.seek(max(0, os.path.getsize(log_file) - tail_bytes))
+        tail = fin.read().decode(errors='replace')
+    return any([imsg in tail for imsg in mem_errors])
+
+
+# In[5]:
+
+
+# Runs of the job_runner state file of an organelle, with their usage
+def read_runs(state_file, org, sizes):
+    if not os.path.isfile(state_file):
+        return pd.DataFrame(columns=history_cols)
+    state = pd.read_csv(state_file, dtype={'job_id': str})
+    for icol in ['mem','job_id']:
+        if icol not in state.columns:
+            state[icol] = np.nan
+    state = state.rename(columns={'label':'sample'})
+    state['org'] = org
+    state['job'] = state.backend + '_' + state.job_id.fillna('') + '_' + state.task_id.astype(str) + '_' + state.start.astype(str)
+    state['maxrss_mb'] = state.maxrss_kb / 1024
+    slurm = state[(state.backend=='slurm') & (state.job_id.notnull())]
+    if slurm.shape[0] > 0:
+        sacct = read_sacct(list(slurm.job_id.unique()))
+        slurm_job = slurm.job_id + '_' + slurm.task_id.astype(str)
+        sacct = sacct.set_index('job')
+        for icol in ['exit_code','elapsed_s','maxrss_mb']:
+            state.loc[slurm.index, icol] = slurm_job.map(sacct[icol]).values
+        slurm_state = slurm_job.map(sacct.state)
+        state.loc[slurm.index, 'status'] = np.select([slurm_state=='COMPLETED',
+                                                      slurm_state.isin(['PENDING','RUNNING']) | slurm_state.isnull()],
+                                                     ['done', 'submitted'], 'failed')
+        state.loc[slurm.index[(slurm_state=='OUT_OF_MEMORY').values], 'exit_code'] = oom_exit_codes[0]
+    state['oom'] = state.exit_code.isin(oom_exit_codes)
+    for icol in ['start','end']:
+        state[icol] = pd.to_numeric(state[icol], errors='coerce') if icol in state.columns else np.nan
+    failed = state[(state.status=='failed') & (~state.oom)]
+    state.loc[failed.index, 'oom'] = [log_mem_error('logs/log_' + irow['sample'] + '_' + org + '.err',
+                                                    state.start[idx], state.end[idx]) for idx, irow in failed.iterrows()]
+    state['input_mb'] = state['sample'].map(sizes)
+    return state[state.status.isin(['done','failed'])][history_cols]
+
+
+def update_history(list_files):
+    history = pd.read_csv(history_file) if os.path.isfile(history_file) else pd.DataFrame(columns=history_cols)
+    for list_file in list_files:
+        org = os.path.basename(list_file).replace('.txt','').split('_')[-1]
+        runs = read_runs(list_file + '.runner.csv', org, input_sizes(list_file))
+        # input size of samples no longer in the lists is kept from previous updates
+        history = pd.concat([history, runs]).drop_duplicates(['job','org'], keep='last')
+    history.to_csv(history_file, index=False)
+    return history
+
+
+# In[6]:
+
+
+# Peak memory (MB) against fastq size (MB): fit and upper residual of successful runs, None without enough runs
+def fit_model(history, org):
+    runs = history[(history.org==org) & (history.status=='done') & (history.maxrss_mb.notnull()) &
+                   (history.input_mb.notnull())]
+    if runs.shape[0] < min_history:
+        return None
+    slope, intercept = np.polyfit(runs.input_mb.astype(float), runs.maxrss_mb.astype(float), 1)
+    residuals = runs.maxrss_mb - (intercept + slope * runs.input_mb)
+    return slope, intercept, residuals.quantile(0.9)
+
+
+def predict_mem(model, input_mb):
+    if model is None or input_mb is None or np.isnan(input_mb):
+        return default_mem
+    slope, intercept, residual = model
+    return max(0, intercept + slope * input_mb + residual) * margin
+
+
+# Smallest tier above the prediction, and above the memory of runs killed for lack of memory
+def assign_tier(pred_mem, oom_mem=0):
+    tiers = [itier for itier in mem_tiers if itier >= pred_mem and itier > oom_mem]
+    return tiers[0] if len(tiers) > 0 else mem_tiers[-1]
+
+
+# In[7]:
+
+
+# Tier lists of the remaining samples, or only of those whose last run was killed for lack of memory
+def plan_resources(list_files, history, total_mem=total_mem, only_oom=False, sequential=False):
+    plan=[]
+    for list_file in list_files:
+        if not os.path.isfile(list_file):
+            continue
+        org = os.path.basename(list_file).replace('.txt','').split('_')[-1]
+        model = fit_model(history, org)
+        sizes = input_sizes(list_file)
+        # memory of runs killed before the state recorded it was the former default
+        oom = history[(history.org==org) & (history.oom==True)].fillna({'mem': default_mem}).groupby('sample').mem.max()
+        last_oom = history[history.org==org].groupby('sample').oom.last()
+        tiers={}
+        with open(list_file) as fin:
+            for iline in fin:
+                isample = iline.split(',')[0]
+                if only_oom and not last_oom.get(isample, False):
+                    continue
+                itier = assign_tier(predict_mem(model, sizes.get(isample)), oom.get(isample, 0))
+                tiers.setdefault(itier, []).append(iline)
+        print(org, 'model (slope, intercept, residual):', model, ', samples per tier:',
+              {itier: len(ilines) for itier, ilines in sorted(tiers.items())})
+        for itier, ilines in sorted(tiers.items()):
+            tier_file = list_file.replace('_' + org + '.txt', '_' + str(itier) + '_' + org + '.txt')
+            with open(tier_file, 'w') as fout:
+                fout.write(''.join(ilines))
+            plan.append({'list_file': tier_file, 'org': org, 'state': list_file + '.runner.csv', 'mem': itier,
+                         'cpus': cpus, 'Nsamples': len(ilines)})
+    plan = pd.DataFrame(plan, columns=['list_file','org','state','mem','cpus','Nsamples'])
+    # Share the memory budget between tiers by number of samples, or the whole budget for each tier run on its own
+    if plan.shape[0] > 0:
+        share = total_mem if sequential else total_mem * plan.Nsamples / plan.Nsamples.sum()
+        plan['throttle'] = (share // plan.mem).clip(1, max_throttle).astype(int)
+    return plan
+
+
+# ## Main
+
+# In[8]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Memory tiers and concurrency of GetOrganelle tasks, from input size and past runs')
+    parser.add_argument("--lists", nargs='*', default=['remaining_pt.txt','remaining_nr.txt'],
+                        help="remaining lists, the organelle is the end of the file name")
+    parser.add_argument("--total_mem", type=int, default=total_mem, help="MB for all GetOrganelle tasks at once")
+    parser.add_argument("--only_oom", action="store_true", default=False,
+                        help="only samples whose last run was killed for lack of memory, to retry them")
+    parser.add_argument("--sequential", action="store_true", default=False,
+                        help="tiers run one after the other (local backend), each with the whole memory budget")
+    parser.add_argument("--out", type=str, default='Resource_plan.csv')
+    args = parser.parse_args()
+
+    history = update_history([ilist for ilist in args.lists if os.path.isfile(ilist)])
+    print(history.shape[0], 'past runs,', (history.oom==True).sum(), 'killed for lack of memory')
+    plan = plan_resources(args.lists, history, args.total_mem, args.only_oom, args.sequential)
+    plan.to_csv(args.out, index=False)
+    print(plan)
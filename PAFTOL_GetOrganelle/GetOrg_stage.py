@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # GetOrganelle staging of fastq files
+# Stages the fastq.gz of remaining_pt.txt and remaining_nr.txt into Data/, as read by GetOrg_array.sh.
+# Files are staged once for both lists, by hardlink or reflink when Data/ is on the same filesystem as the reads,
+# otherwise copied concurrently with a bandwidth cap, and checked by size and md5.
+# Copies are kept under a quota (GB): the pipeline prefetches files in execution order up to the quota, and each array
+# task fetches its own files before running (waiting for space if needed). Execution order is the order of the memory
+# tier lists in Resource_plan.csv (GetOrg_resources.py), as run by GetOrg_Pipeline.sh, then the order of the lists. When a run finishes, it is released,
+# and files needed by no other unfinished run are evicted from Data/.
+# Staged files are recorded in Data/staged.csv, runs released in Data/released.txt.
+#
+# Run from the DataSource directory:
+# python ../GetOrg_stage.py stage --lists remaining_pt.txt remaining_nr.txt --quota 500
+# python ../GetOrg_stage.py fetch --sample_file remaining_pt.txt --task 3
+# python ../GetOrg_stage.py release --sample PAFTOL_000001 --org pt
+
+# In[1]:
+
+
+import os
+import sys
+import csv
+import time
+import fcntl
+import hashlib
+import threading
+import subprocess
+import argparse
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ## Parameters
+
+# In[2]:
+
+
+data_dir='Data'
+manifest_file='Data/staged.csv'
+released_file='Data/released.txt'
+plan_file='Resource_plan.csv'
+lock_file='Data/.stage.lock'
+manifest_cols=['file','source','size','md5','method','status','staged_time']
+n_threads=4
+chunk_size=16*1024*1024
+bw_limit=200       # MB/s for all copies of one process, 0 for no limit
+quota=500          # GB of copied fastq in Data/ (links do not count)
+max_wait=4*3600    # seconds an array task waits for space before staging over quota
+wait_step=60
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Name of a fastq in Data/, as used by GetOrg_array.sh
+def staged_name(source):
+    return os.path.join(data_dir, os.path.basename(source).replace('.gz','') + '.gz')
+
+
+# Runs (sample, org) of the remaining lists and their fastq, e.g. remaining_pt.txt > pt
+def read_runs(list_files):
+    runs=[]
+    for list_file in list_files:
+        if not os.path.isfile(list_file):
+            continue
+        org = os.path.basename(list_file).replace('.txt','').split('_')[-1]
+        with open(list_file) as fin:
+            for iline in fin:
+                fields = iline.strip().split(',')
+                if fields[0] == '':
+                    continue
+                for ipath in fields[1:3]:
+                    if ipath != '':
+                        runs.append({'sample': fields[0], 'org': org, 'source': ipath, 'file': staged_name(ipath)})
+    return runs
+
+
+# Lists in execution order: tier lists of the resource plan of the lists, in the order they are run, then the lists
+def ordered_lists(list_files, plan_file=plan_file):
+    tier_lists=[]
+    if os.path.isfile(plan_file):
+        with open(plan_file) as fin:
+            for row in csv.DictReader(fin):
+                if row['state'].replace('.runner.csv', '') in list_files and os.path.isfile(row['list_file']):
+                    tier_lists.append(row['list_file'])
+    return tier_lists + list(list_files)
+
+
+# Files to stage in execution order, each with the runs needing it
+def get_files(runs):
+    files={}
+    for irun in runs:
+        ifile = files.setdefault(irun['file'], {'file': irun['file'], 'source': irun['source'], 'runs': set()})
+        ifile['runs'].add(irun['sample'] + '_' + irun['org'])
+    return files
+
+
+# In[4]:
+
+
+@contextmanager
+def locked():
+    with open(lock_file, 'a') as flock:
+        fcntl.flock(flock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(flock, fcntl.LOCK_UN)
+
+
+def read_manifest():
+    manifest={}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as fin:
+            for row in csv.DictReader(fin):
+                manifest[row['file']] = row
+    return manifest
+
+
+def write_manifest(manifest):
+    with open(manifest_file + '.tmp', 'w') as fout:
+        writer = csv.DictWriter(fout, fieldnames=manifest_cols)
+        writer.writeheader()
+        for row in manifest.values():
+            writer.writerow(row)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def read_released():
+    if not os.path.isfile(released_file):
+        return set()
+    with open(released_file) as fin:
+        return set([iline.strip() for iline in fin if iline.strip() != ''])
+
+
+# In[5]:
+
+
+# Bandwidth cap shared by the copy threads
+class Throttle:
+    def __init__(self, mb_per_s):
+        self.rate = mb_per_s * 1024 * 1024
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self, nbytes):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(self.next_time, now)
+            self.next_time = start + nbytes / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def md5_file(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def same_fs(source, target_dir):
+    return os.stat(source).st_dev == os.stat(target_dir).st_dev
+
+
+# In[6]:
+
+
+# Link (hardlink, then reflink) or copy one file, returns method and md5 of copies
+def link_file(source, tmp_path):
+    try:
+        os.link(source, tmp_path)
+        return 'hardlink'
+    except OSError:
+        pass
+    if subprocess.call(['cp', '--reflink=always', source, tmp_path], stderr=subprocess.DEVNULL) == 0:
+        return 'reflink'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    return None
+
+
+def copy_file(source, tmp_path, throttle):
+    md5 = hashlib.md5()
+    with open(source, 'rb') as fin, open(tmp_path, 'wb') as fout:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            throttle.consume(len(chunk))
+            md5.update(chunk)
+            fout.write(chunk)
+    return md5.hexdigest()
+
+
+def stage_file(ifile, throttle, checksum=True):
+    source = os.path.realpath(ifile['source']); tmp_path = ifile['file'] + '.part'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    size = os.path.getsize(source)
+    method = link_file(source, tmp_path) if same_fs(source, data_dir) else None
+    md5 = ''
+    if method is None:
+        method = 'copy'
+        md5 = copy_file(source, tmp_path, throttle)
+    if os.path.getsize(tmp_path) != size or (checksum and method == 'copy' and md5_file(tmp_path) != md5):
+        os.remove(tmp_path)
+        print('staging failed, size or md5 differs:', source)
+        return None
+    os.replace(tmp_path, ifile['file'])
+    print('staged', method, source, '>', ifile['file'], flush=True)
+    return {'file': ifile['file'], 'source': ifile['source'], 'size': size, 'md5': md5, 'method': method,
+            'status': 'staged', 'staged_time': round(time.time(), 1)}
+
+
+# In[7]:
+
+
+# GB of copies in Data/, including copies in progress
+def used_gb(manifest):
+    return sum([float(row['size']) for row in manifest.values() if row['method'] in ['copy','']]) / 1024**3
+
+
+# Reserve files in order until the quota is reached. Must be called under lock
+def reserve(files, manifest, quota, force=[]):
+    # Forget files removed from Data/ and reservations of tasks that died while staging
+    for ikey, row in list(manifest.items()):
+        if (row['status'] == 'staged' and not os.path.exists(ikey)) or \
+           (row['status'] == 'staging' and time.time() - float(row['staged_time']) > max_wait):
+            del manifest[ikey]
+    reserved=[]; used = used_gb(manifest)
+    for ifile in files:
+        if ifile['file'] in manifest:
+            continue
+        if not os.path.exists(ifile['source']):
+            print('missing source', ifile['source'])
+            continue
+        size = os.path.getsize(ifile['source'])
+        # links do not use space
+        cost = 0 if same_fs(os.path.realpath(ifile['source']), data_dir) else size / 1024**3
+        if used + cost > quota and ifile['file'] not in force:
+            break
+        used += cost
+        manifest[ifile['file']] = {'file': ifile['file'], 'source': ifile['source'], 'size': size, 'md5': '',
+                                   'method': '' if cost > 0 else 'link', 'status': 'staging', 'staged_time': round(time.time(), 1)}
+        reserved.append(ifile)
+    return reserved
+
+
+def stage_files(files, quota, bw_limit=bw_limit, checksum=True, force=[]):
+    with locked():
+        manifest = read_manifest()
+        reserved = reserve(files, manifest, quota, force)
+        write_manifest(manifest)
+    if len(reserved) == 0:
+        return []
+    throttle = Throttle(bw_limit)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        rows = list(executor.map(lambda ifile: stage_file(ifile, throttle, checksum), reserved))
+    with locked():
+        manifest = read_manifest()
+        for ifile, row in zip(reserved, rows):
+            if row is None:
+                manifest.pop(ifile['file'], None)
+            else:
+                manifest[ifile['file']] = row
+        write_manifest(manifest)
+    return [row for row in rows if row is not None]
+
+
+# In[8]:
+
+
+# Remove staged files needed by no unfinished run of the lists
+def evict(files, released):
+    evicted=[]
+    with locked():
+        manifest = read_manifest()
+        for ifile, row in list(manifest.items()):
+            if row['status'] != 'staged':
+                continue
+            runs = files[ifile]['runs'] if ifile in files else set()
+            if runs.issubset(released):
+                if os.path.exists(ifile):
+                    os.remove(ifile)
+                del manifest[ifile]
+                evicted.append(ifile)
+        write_manifest(manifest)
+    if len(evicted) > 0:
+        print('evicted', len(evicted), 'files:', ' '.join(evicted))
+    return evicted
+
+
+# In[9]:
+
+
+# Files of one array task (line of the sample file), staged before running, waiting for space if over quota
+def fetch(sample_file, task, list_files, quota, bw_limit=bw_limit, checksum=True):
+    task_runs = read_runs([sample_file])
+    with open(sample_file) as fin:
+        sample = fin.readlines()[task - 1].split(',')[0]
+    task_files = get_files([irun for irun in task_runs if irun['sample'] == sample])
+    # A run retried after being released (e.g. in a higher memory tier) needs its files again
+    task_keys = set().union(*[ifile['runs'] for ifile in task_files.values()])
+    with locked():
+        released = read_released()
+        if len(released.intersection(task_keys)) > 0:
+            with open(released_file, 'w') as fout:
+                fout.write(''.join([irun + '\n' for irun in sorted(released.difference(task_keys))]))
+    files = get_files(read_runs(ordered_lists(list_files)))
+    start = time.time()
+    while True:
+        stage_files(task_files.values(), quota, bw_limit, checksum,
+                    force=list(task_files) if time.time() - start > max_wait else [])
+        manifest = read_manifest()
+        pending = [ifile for ifile in task_files if manifest.get(ifile, {}).get('status') != 'staged']
+        if len(pending) == 0:
+            break
+        if not all([os.path.exists(task_files[ifile]['source']) for ifile in pending]):
+            print('missing source fastq for', sample)
+            return False
+        print('waiting for space or staging by another task:', ' '.join(pending), flush=True)
+        time.sleep(wait_step)
+        evict(files, read_released())
+    # Prefetch the next files of the lists while there is space
+    stage_files(files.values(), quota, bw_limit, checksum)
+    return True
+
+
+# ## Main
+
+# In[10]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Stage fastq files for GetOrganelle in Data/, and evict them once their runs are finished')
+    parser.add_argument("action", type=str, help="stage: prefetch the lists up to the quota, fetch: files of one task, "
+                        "release: mark a run finished and evict, evict: evict files of finished runs")
+    parser.add_argument("--lists", nargs='*', default=['remaining_pt.txt','remaining_nr.txt'],
+                        help="remaining lists, the organelle is the end of the file name")
+    parser.add_argument("--quota", type=float, default=quota, help="GB of copied fastq in Data/")
+    parser.add_argument("--bw_limit", type=float, default=bw_limit, help="MB/s of copies, 0 for no limit")
+    parser.add_argument("--no_checksum", action="store_true", default=False, help="only check size of copies")
+    parser.add_argument("--sample_file", type=str, help="fetch: sample file of the array (e.g. remaining_pt.txt)")
+    parser.add_argument("--task", type=int, help="fetch: line of the sample file (SLURM_ARRAY_TASK_ID)")
+    parser.add_argument("--sample", type=str, help="release: sample of the finished run")
+    parser.add_argument("--org", type=str, help="release: organelle of the finished run (pt or nr)")
+    args = parser.parse_args()
+
+    os.makedirs(data_dir, exist_ok=True)
+    files = get_files(read_runs(ordered_lists(args.lists)))
+
+    if args.action == 'stage':
+        # New lists: runs released by a previous launch are run again
+        with locked():
+            runs = set().union(*[ifile['runs'] for ifile in files.values()])
+            released = read_released().difference(runs)
+            with open(released_file, 'w') as fout:
+                fout.write(''.join([irun + '\n' for irun in sorted(released)]))
+        print(len(files), 'fastq files for', len(set().union(*[ifile['runs'] for ifile in files.values()])), 'runs')
+        evict(files, read_released())
+        rows = stage_files(files.values(), args.quota, args.bw_limit, not args.no_checksum)
+        print(len(rows), 'files staged,', round(used_gb(read_manifest()), 1), '/', args.quota, 'GB used')
+
+    elif args.action == 'fetch':
+        if not fetch(args.sample_file, args.task, args.lists, args.quota, args.bw_limit, not args.no_checksum):
+            sys.exit(1)
+
+    elif args.action == 'release':
+        with locked():
+            with open(released_file, 'a') as fout:
+                fout.write(args.sample + '_' + args.org + '\n')
+        evict(files, read_released())
+
+    elif args.action == 'evict':
+        evict(files, read_released())
+
+    else:
+        print('unknown action', args.action)
+        sys.exit(1)
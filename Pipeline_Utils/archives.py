@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # archives
+# Indexed tar.gz archives of result folders (GetOrganelle runs), compressed in parallel.
+# The tar stream is cut in blocks compressed as independent gzip members on a thread pool; the concatenation
+# is a standard gzip file (tar -xzf works). An index (<archive>.idx, json) records the uncompressed and compressed
+# offset of each block, and the offset and size of each member, so that one file (log, graph, fasta) can be read
+# back by seeking to its block instead of decompressing the whole archive.
+#
+# python archives.py create --path GetOrg/PAFTOL_000001_pt/ --archive Archives/PAFTOL_000001_pt.tar.gz
+# python archives.py list --archive Archives/PAFTOL_000001_pt.tar.gz
+# python archives.py extract --archive Archives/PAFTOL_000001_pt.tar.gz --member GetOrg/PAFTOL_000001_pt/get_org.log.txt
+
+# In[1]:
+
+
+import os
+import sys
+import json
+import zlib
+import gzip
+import tarfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ## Parameters
+
+# In[2]:
+
+
+block_size=4*1024*1024
+compress_level=6
+n_threads=4
+
+
+# ## Functions
+
+# In[3]:
+
+
+# File object compressing what is written in blocks, each block an independent gzip member
+class BlockWriter:
+    def __init__(self, fout, n_threads=n_threads, level=compress_level):
+        self.fout = fout
+        self.level = level
+        self.executor = ThreadPoolExecutor(max_workers=n_threads)
+        self.max_pending = 2 * n_threads
+        self.buffer = []; self.buffer_len = 0
+        self.pending = []
+        self.blocks = []  # [uncompressed offset, compressed offset]
+        self.uoffset = 0; self.coffset = 0
+
+    def write(self, data):
+        self.buffer.append(bytes(data)); self.buffer_len += len(data)
+        if self.buffer_len >= block_size:
+            self.submit()
+        return len(data)
+
+    def submit(self):
+        if self.buffer_len == 0:
+            return
+        data = b''.join(self.buffer)
+        self.pending.append((len(data), self.executor.submit(gzip.compress, data, self.level)))
+        self.buffer = []; self.buffer_len = 0
+        while len(self.pending) > self.max_pending:
+            self.write_next()
+
+    def write_next(self):
+        ulen, future = self.pending.pop(0)
+        cdata = future.result()
+        self.blocks.append([self.uoffset, self.coffset])
+        self.fout.write(cdata)
+        self.uoffset += ulen; self.coffset += len(cdata)
+
+    def close(self):
+        self.submit()
+        while len(self.pending) > 0:
+            self.write_next()
+        self.executor.shutdown()
+
+
+# In[4]:
+
+
+def create_archive(path, archive_path, n_threads=n_threads, level=compress_level):
+    arc_root = path.rstrip('/')
+    members=[]
+    with open(archive_path + '.tmp', 'wb') as fout:
+        writer = BlockWriter(fout, n_threads, level)
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            for root, dirs, files in os.walk(arc_root):
+                dirs.sort()
+                for iname in [root] + [os.path.join(root, ifile) for ifile in sorted(files)]:
+                    tarinfo = tar.gettarinfo(iname)
+                    if tarinfo is None:
+                        continue
+                    start = tar.offset
+                    if tarinfo.isreg():
+                        with open(iname, 'rb') as fin:
+                            tar.addfile(tarinfo, fin)
+                    else:
+                        tar.addfile(tarinfo)
+                    # data follows the header(s), padded to 512 bytes
+                    offset_data = tar.offset - (-(-tarinfo.size // 512) * 512)
+                    members.append({'name': tarinfo.name, 'type': 'file' if tarinfo.isreg() else 'other',
+                                    'size': tarinfo.size, 'offset_data': offset_data, 'header': start})
+        writer.close()
+    os.replace(archive_path + '.tmp', archive_path)
+    index = {'blocks': writer.blocks, 'members': members}
+    with open(archive_path + '.idx', 'w') as fout:
+        json.dump(index, fout)
+    return index
+
+
+# In[5]:
+
+
+def load_index(archive_path):
+    with open(archive_path + '.idx') as fin:
+        return json.load(fin)
+
+
+# Read the whole archive back, and check that its members match the index
+def verify_archive(archive_path):
+    index = load_index(archive_path)
+    try:
+        with tarfile.open(archive_path, mode='r:gz') as tar:
+            found = [(tarinfo.name, tarinfo.size) for tarinfo in tar]
+    except (tarfile.TarError, OSError, EOFError, zlib.error) as err:
+        print('could not read archive', archive_path, err)
+        return False
+    expected = [(imember['name'], imember['size']) for imember in index['members']]
+    if found != expected:
+        print('members of', archive_path, 'do not match its index')
+        return False
+    return True
+
+
+# In[6]:
+
+
+# Bytes of one member, decompressing from the block containing its data
+def read_member(archive_path, name, index=None):
+    index = load_index(archive_path) if index is None else index
+    member = [imember for imember in index['members'] if imember['name'] == name.rstrip('/')]
+    if len(member) == 0:
+        raise KeyError(name + ' not in ' + archive_path)
+    member = member[0]
+    block = max([iblock for iblock in index['blocks'] if iblock[0] <= member['offset_data']], default=[0, 0])
+    skip = member['offset_data'] - block[0]; size = member['size']
+    data=[]; data_len = 0
+    with open(archive_path, 'rb') as fin:
+        fin.seek(block[1])
+        dobj = zlib.decompressobj(wbits=31)
+        while data_len < skip + size:
+            # next gzip member starts in the unused data of the previous one
+            if dobj.eof:
+                chunk = dobj.unused_data
+                dobj = zlib.decompressobj(wbits=31)
+            else:
+                chunk = fin.read(1024*1024)
+                if chunk == b'':
+                    break
+            idata = dobj.decompress(chunk)
+            data.append(idata); data_len += len(idata)
+    return b''.join(data)[skip:skip + size]
+
+
+# ## Main
+
+# In[7]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Indexed tar.gz archives compressed in parallel')
+    parser.add_argument("action", type=str, help="create, verify, list or extract")
+    parser.add_argument("--archive", type=str, help="archive path (.tar.gz)")
+    parser.add_argument("--path", type=str, help="create: folder to archive")
+    parser.add_argument("--member", type=str, help="extract: member to extract")
+    parser.add_argument("--out", type=str, default=None, help="extract: output file, default to stdout")
+    parser.add_argument("--threads", type=int, default=n_threads)
+    args = parser.parse_args()
+
+    if args.action == 'create':
+        index = create_archive(args.path, args.archive, n_threads=args.threads)
+        print(len(index['members']), 'members,', len(index['blocks']), 'blocks, archived to', args.archive)
+        sys.exit(0 if verify_archive(args.archive) else 1)
+    elif args.action == 'verify':
+        sys.exit(0 if verify_archive(args.archive) else 1)
+    elif args.action == 'list':
+        for imember in load_index(args.archive)['members']:
+            print(imember['size'], imember['name'], sep='\t')
+    elif args.action == 'extract':
+        data = read_member(args.archive, args.member)
+        if args.out is None:
+            sys.stdout.buffer.write(data)
+        else:
+            with open(args.out, 'wb') as fout:
+                fout.write(data)
+    else:
+        print('unknown action', args.action)
+        sys.exit(1)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # blast_cache
+# Content-addressed cache of blast outputs, keyed by a hash of the query fasta, of the database fasta and of the
+# search parameters (perc_identity, max_target_seqs, prescreen indexes, and parameters of the prescreens: thresholds of
+# the k-mer prescreen, thresholds and taxonomy of the sample for partition searches). After a database update, or when a
+# sample's fasta is regenerated, only the changed (sample, database) pairs miss the cache and are blasted again.
+# Outputs are stored as <cache_dir>/<key[:2]>/<key>.out, with the marks of outputs of partition searches
+# (<out>.partition_search, Taxo_partitions.py). Database fingerprints are kept next to the fasta (<fasta>.sha256) and
+# recomputed when the fasta changes.
+# Validation cards record the key of their inputs (BV_<sample>.keys), with the taxonomy of the sample, and cards whose
+# inputs changed are stale. Query hashes are kept by path, size and mtime in a process.
+#
+# Run from the DataSource directory:
+# python ../../Pipeline_Utils/blast_cache.py get --query fasta_pt/PAFTOL_000001_pt.fasta --db ../Barcode_DB/BOLD_matK.fasta \
+#     --perc_identity 95 --max_target_seqs 100 --params min_shared=5 --out out_blast/PAFTOL_000001-BOLD_matK.out || blastn ...
+# python ../../Pipeline_Utils/blast_cache.py put --out out_blast/PAFTOL_000001-BOLD_matK.out
+
+# In[1]:
+
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import pandas as pd
+
+
+# ## Parameters
+
+# In[2]:
+
+
+cache_dir='../Blast_cache'
+blast_fmt='6 qseqid sseqid pident length slen qlen mismatch gapopen qstart qend sstart send evalue bitscore'
+type_org={'cpDNA':'pt','rDNA':'nr','pt':'pt','nr':'nr'}
+block_size=1024**2
+marks=['.partition_search']   # files kept and restored with an output
+query_hashes={}   # (path, size, mtime) > hash
+
+
+# ## Functions
+
+# In[3]:
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# Hash of a database fasta, from <fasta>.sha256 if the fasta did not change since
+def db_fingerprint(fasta_path):
+    st = os.stat(fasta_path)
+    fp_file = fasta_path + '.sha256'
+    if os.path.isfile(fp_file):
+        fields = open(fp_file).read().split()
+        if len(fields) == 3 and fields[1:] == [str(st.st_size), str(st.st_mtime_ns)]:
+            return fields[0]
+    sha = file_hash(fasta_path)
+    try:
+        with open(fp_file + '.tmp' + str(os.getpid()), 'w') as fout:
+            fout.write(' '.join([sha, str(st.st_size), str(st.st_mtime_ns)]) + '\n')
+        os.replace(fp_file + '.tmp' + str(os.getpid()), fp_file)
+    except OSError:
+        print('could not write', fp_file)
+    return sha
+
+
+# Hash of a query fasta, computed once per version of the file
+def query_hash(path):
+    st = os.stat(path)
+    ikey = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if ikey not in query_hashes:
+        query_hashes[ikey] = file_hash(path)
+    return query_hashes[ikey]
+
+
+def hash_fields(fields):
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+
+# In[4]:
+
+
+# Key of a blast search: query, database, blast parameters, prescreen indexes (k-mer index, taxonomy partitions) and
+# parameters of the prescreens ({name: value}, e.g. thresholds, family of the sample for partition searches)
+def blast_key(query_file, db_fasta, perc_identity, max_target_seqs, prescreen=None, params=None):
+    prescreen = [prescreen] if isinstance(prescreen, str) else (prescreen or [])
+    fields = {'query': query_hash(query_file), 'db': db_fingerprint(db_fasta), 'outfmt': blast_fmt,
+              'perc_identity': float(perc_identity), 'max_target_seqs': int(max_target_seqs),
+              'prescreen': ' '.join([db_fingerprint(iindex) for iindex in prescreen if iindex != ''])}
+    # searches without prescreen parameters keep their keys
+    if params:
+        fields['params'] = {str(ikey): str(ivalue) for ikey, ivalue in params.items()}
+    return hash_fields(fields)
+
+
+class BlastCache:
+    def __init__(self, cache_dir=cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.out')
+
+    # Copy the cached output of key to out, with its marks, False if not cached
+    def get(self, key, out):
+        if not os.path.isfile(self.path(key)):
+            return False
+        for imark in marks:
+            if os.path.isfile(self.path(key) + imark):
+                open(out + imark, 'w').close()
+            elif os.path.isfile(out + imark):
+                os.remove(out + imark)
+        shutil.copyfile(self.path(key), out + '.tmp')
+        os.replace(out + '.tmp', out)
+        return True
+
+    def put(self, key, out):
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        for imark in marks:
+            if os.path.isfile(out + imark):
+                open(self.path(key) + imark, 'w').close()
+            elif os.path.isfile(self.path(key) + imark):
+                os.remove(self.path(key) + imark)
+        tmp = self.path(key) + '.tmp' + str(os.getpid())
+        shutil.copyfile(out, tmp)
+        os.replace(tmp, self.path(key))
+
+
+# In[5]:
+
+
+# Path of the query fasta for a sample, relative to the DataSource directory
+def get_query_file(sample, org, fasta_type):
+    if fasta_type == 'contigs':
+        return 'in_fasta/' + sample + '.fasta'
+    elif fasta_type == 'pt_nr':
+        return 'fasta_' + org + '/' + sample + '_' + org + '.fasta'
+
+
+# Key of the inputs of each barcode test of a validation card, empty if the query fasta is missing, with the taxonomy
+# of the sample (genus, family) if given. Independent of how blast was run (per sample, batched, prescreened).
+def card_keys(sample, genes_df, fasta_type, barcode_DB_dir, project_dir='', sample_dic=None):
+    taxonomy = {} if sample_dic is None else \
+        {itax: '' if pd.isnull(sample_dic.get(itax)) else str(sample_dic.get(itax)) for itax in ['genus','family']}
+    keys=[]
+    for gene_idx, gene_row in genes_df.iterrows():
+        query_file = project_dir + get_query_file(sample, type_org[gene_row['type']], fasta_type)
+        if not os.path.isfile(query_file):
+            keys.append({'Barcode': gene_row.Barcode, 'key': ''})
+            continue
+        fields = {'query': query_hash(query_file), 'db': db_fingerprint(barcode_DB_dir + gene_row.Barcode + '.fasta'),
+                  'perc_identity': float(gene_row.blast_pid), 'max_target_seqs': int(gene_row.max_blast),
+                  'min_len': float(gene_row.min_len), 'min_cov': float(gene_row.min_cov)}
+        if len(taxonomy) > 0:
+            fields['taxonomy'] = taxonomy
+        keys.append({'Barcode': gene_row.Barcode, 'key': hash_fields(fields)})
+    return pd.DataFrame(keys, columns=['Barcode','key'])
+
+
+# Samples whose validation card was made from other inputs than the current ones, taxonomy from samples_df if given
+# (Sample, genus, family). Cards without keys (made before keys were recorded) are not considered stale.
+def stale_cards(samples, genes_df, fasta_type, barcode_DB_dir, project_dir='', samples_df=None):
+    taxonomy = {} if samples_df is None else samples_df.set_index('Sample')[['genus','family']].to_dict('index')
+    stale=[]
+    for isample in samples:
+        keys_file = project_dir + 'Barcode_Validation/BV_' + isample + '.keys'
+        if not os.path.isfile(keys_file):
+            continue
+        card = pd.read_csv(keys_file, keep_default_na=False).set_index('Barcode').key.to_dict()
+        current = card_keys(isample, genes_df, fasta_type, barcode_DB_dir, project_dir,
+                            taxonomy.get(isample)).set_index('Barcode').key.to_dict()
+        if card != current:
+            stale.append(isample)
+    return stale
+
+
+# ## Main
+
+# In[6]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Cache of blast outputs, keyed by query, database and parameters')
+    parser.add_argument("action", type=str, help="get: copy the cached output to --out (exit 1 if not cached), "
+                        "put: store --out under the key written by get")
+    parser.add_argument("--out", type=str, help="blast output file, its key is kept in <out>.key")
+    parser.add_argument("--query", type=str, help="get: query fasta")
+    parser.add_argument("--db", type=str, help="get: database fasta")
+    parser.add_argument("--perc_identity", type=float, help="get: blastn -perc_identity")
+    parser.add_argument("--max_target_seqs", type=int, help="get: blastn -max_target_seqs")
+    parser.add_argument("--prescreen", nargs='*', default=None,
+                        help="get: k-mer prescreen index and taxonomy partitions, if used")
+    parser.add_argument("--params", nargs='*', default=[],
+                        help="get: parameters of the prescreens, as name=value (Kmer_prescreen.py params, "
+                        "Taxo_partitions.py enabled)")
+    parser.add_argument("--cache_dir", type=str, default=cache_dir)
+    args = parser.parse_args()
+
+    cache = BlastCache(args.cache_dir)
+    if args.action == 'get':
+        params = dict([iparam.split('=', 1) for iparam in args.params])
+        key = blast_key(args.query, args.db, args.perc_identity, args.max_target_seqs, args.prescreen, params)
+        with open(args.out + '.key', 'w') as fout:
+            fout.write(key + '\n')
+        if cache.get(key, args.out):
+            print('cached blast output', key, 'for', args.out)
+            sys.exit(0)
+        sys.exit(1)
+    elif args.action == 'put':
+        cache.put(open(args.out + '.key').read().strip(), args.out)
+    else:
+        print('unknown action', args.action)
+        sys.exit(2)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # blast_store
+# Columnar store of the raw blast hits (out_blast/<sample>-<barcode>.out) of all samples, partitioned by DataSource
+# and barcode (<store_dir>/<DataSource>/<Barcode>/), so that validation cards can be made again with other
+# thresholds (blast_pid, min_len, min_cov of Barcode_Tests.csv) without blasting or parsing the outputs again.
+# Each column is a typed numpy array (<column>.npy, memory-mapped when read), with scov and qcov precomputed as in
+# Get_validation_cards.py. Text columns (sample, qseqid, sseqid) are stored as int32 codes of <column>.dict.npy.
+# Rows are sorted by sample, with the rows of each sample in offsets.csv.
+# Scans push down partitions, samples and filters: only the rows of the samples requested are read, filters are
+# evaluated on their own columns, and only the columns requested are gathered for the rows passing the filters.
+# Ingestion is incremental: files.csv records the size and mtime of the blast output of each sample, and only the
+# samples whose output changed are parsed again.
+#
+# Run from the working directory containing the DataSource directories:
+# python ../Pipeline_Utils/blast_store.py ingest --DataSource PAFTOL --barcodes_table Barcode_DB/Barcode_Tests.csv
+# python ../Pipeline_Utils/blast_store.py scan --DataSource PAFTOL --barcode NCBI_18s --filters "pident>=99" "scov>=50"
+#
+# part = blast_store.Partition('Blast_store/PAFTOL/NCBI_18s')
+# hits_df = part.scan(samples=['PAFTOL_000001'], filters=[('pident','>=',95),('length','>=',300)])
+
+# In[1]:
+
+
+import os
+import sys
+import shutil
+import argparse
+import operator
+import numpy as np
+import pandas as pd
+
+
+# ## Parameters
+
+# In[2]:
+
+
+store_dir='Blast_store'
+blast_cols=['qseqid','sseqid','pident','length','slen','qlen','mismatch','gapopen','qstart','qend','sstart','send',
+            'evalue','bitscore']
+store_dtypes={'sample':'code','qseqid':'code','sseqid':'code','length':np.int32,'slen':np.int32,'qlen':np.int32,
+              'scov':np.float64,'qcov':np.float64,'pident':np.float64,'evalue':np.float64,'bitscore':np.float64}
+filter_ops={'>=':operator.ge,'>':operator.gt,'<=':operator.le,'<':operator.lt,'==':operator.eq,'!=':operator.ne}
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Hits of a blast output, with scov and qcov as in Get_validation_cards.py, None if empty
+def parse_blast_file(blastpath):
+    if os.stat(blastpath).st_size == 0:
+        return None
+    blast_df = pd.read_csv(blastpath, header=None, sep='\t', names=blast_cols, dtype={'qseqid':str,'sseqid':str})
+    blast_df['pident'] = blast_df.pident.round(2)
+    blast_df['scov'] = round((abs(blast_df.sstart - blast_df.send) + 1) / blast_df.slen * 100, 1)
+    blast_df['qcov'] = round((abs(blast_df.qstart - blast_df.qend) + 1) / blast_df.qlen * 100, 1)
+    return blast_df[[icol for icol in store_dtypes if icol != 'sample']]
+
+
+# Blast outputs of a barcode in out_blast, by sample, with their size and mtime
+def list_outputs(out_dir, barcode):
+    suffix = '-' + barcode + '.out'
+    files=[]
+    for ientry in os.scandir(out_dir):
+        if ientry.name.endswith(suffix) and ientry.is_file():
+            st = ientry.stat()
+            files.append({'Sample': ientry.name[:-len(suffix)], 'path': ientry.path, 'size': st.st_size,
+                          'mtime_ns': st.st_mtime_ns})
+    return pd.DataFrame(files, columns=['Sample','path','size','mtime_ns'])
+
+
+# Filters as (column, operator, value), from strings such as "pident>=95"
+def parse_filters(filters_str):
+    filters=[]
+    for ifilter in filters_str:
+        for iop in sorted(filter_ops, key=len, reverse=True):
+            if iop in ifilter:
+                icol, ivalue = ifilter.split(iop, 1)
+                filters.append((icol.strip(), iop, float(ivalue)))
+                break
+        else:
+            raise ValueError('invalid filter ' + ifilter)
+    return filters
+
+
+# In[4]:
+
+
+def write_partition(part_dir, hits_df, files_df):
+    hits_df = hits_df.sort_values('sample', kind='mergesort').reset_index(drop=True)
+    tmp_dir = part_dir + '.tmp' + str(os.getpid())
+    os.makedirs(tmp_dir)
+    for icol, idtype in store_dtypes.items():
+        if idtype == 'code':
+            codes, values = pd.factorize(hits_df[icol])
+            np.save(os.path.join(tmp_dir, icol + '.npy'), codes.astype(np.int32))
+            np.save(os.path.join(tmp_dir, icol + '.dict.npy'), np.array(values, dtype=str))
+        else:
+            np.save(os.path.join(tmp_dir, icol + '.npy'), hits_df[icol].to_numpy(dtype=idtype))
+    samples, starts = np.unique(hits_df['sample'].to_numpy(dtype=str), return_index=True)
+    offsets = pd.DataFrame({'Sample': samples, 'start': starts}).sort_values('start')
+    offsets['end'] = offsets.start.shift(-1, fill_value=hits_df.shape[0])
+    offsets.to_csv(os.path.join(tmp_dir, 'offsets.csv'), index=False)
+    files_df[['Sample','size','mtime_ns']].to_csv(os.path.join(tmp_dir, 'files.csv'), index=False)
+    # swap with the previous partition
+    if os.path.isdir(part_dir):
+        os.replace(part_dir, part_dir + '.old' + str(os.getpid()))
+    os.replace(tmp_dir, part_dir)
+    shutil.rmtree(part_dir + '.old' + str(os.getpid()), ignore_errors=True)
+
+
+# Load the blast outputs of a barcode in its partition, parsing only new or modified outputs
+def ingest_barcode(part_dir, out_dir, barcode):
+    files_df = list_outputs(out_dir, barcode)
+    old_files = files_df[['Sample','size','mtime_ns']].iloc[:0]
+    if os.path.isfile(os.path.join(part_dir, 'files.csv')):
+        old_files = pd.read_csv(os.path.join(part_dir, 'files.csv'), dtype={'Sample':str})
+    same = pd.merge(files_df, old_files, how='inner', on=['Sample','size','mtime_ns']).Sample
+    if len(same) == files_df.shape[0] == old_files.shape[0]:
+        return 0, files_df.shape[0]
+    list_ = []
+    if len(same) > 0:
+        list_.append(Partition(part_dir).scan(samples=list(same)))
+    for idx, ifile in files_df[~files_df.Sample.isin(same)].iterrows():
+        hits_df = parse_blast_file(ifile.path)
+        if hits_df is not None:
+            hits_df.insert(0, 'sample', ifile.Sample)
+            list_.append(hits_df)
+    hits_df = pd.concat(list_, ignore_index=True) if len(list_) > 0 else \
+        pd.DataFrame({icol: pd.Series(dtype=object if idtype == 'code' else idtype) for icol, idtype in store_dtypes.items()})
+    write_partition(part_dir, hits_df, files_df)
+    return files_df.shape[0] - len(same), files_df.shape[0]
+
+
+def ingest(DataSource, barcodes, store_dir=store_dir, project_dir=None):
+    project_dir = DataSource + '/' if project_dir is None else project_dir
+    for ibarcode in barcodes:
+        part_dir = os.path.join(store_dir, DataSource, ibarcode)
+        os.makedirs(os.path.dirname(part_dir), exist_ok=True)
+        Nparsed, Nfiles = ingest_barcode(part_dir, project_dir + 'out_blast', ibarcode)
+        print(ibarcode + ':', Nparsed, 'blast outputs parsed,', Nfiles - Nparsed, 'unchanged')
+
+
+# In[5]:
+
+
+class Partition:
+    def __init__(self, part_dir):
+        self.part_dir = part_dir
+        self.exists = os.path.isfile(os.path.join(part_dir, 'offsets.csv'))
+        self.offsets = {}
+        self.files = set()
+        if self.exists:
+            offsets = pd.read_csv(os.path.join(part_dir, 'offsets.csv'), dtype={'Sample':str})
+            self.offsets = dict(zip(offsets.Sample, zip(offsets.start, offsets.end)))
+            self.files = set(pd.read_csv(os.path.join(part_dir, 'files.csv'), dtype={'Sample':str}).Sample)
+        self.columns = {}
+
+    def column(self, icol):
+        if icol not in self.columns:
+            self.columns[icol] = np.load(os.path.join(self.part_dir, icol + '.npy'), mmap_mode='r')
+        return self.columns[icol]
+
+    # Values of a text column, by code
+    def dictionary(self, icol):
+        if icol + '.dict' not in self.columns:
+            self.columns[icol + '.dict'] = np.load(os.path.join(self.part_dir, icol + '.dict.npy'))
+        return self.columns[icol + '.dict']
+
+    def decode(self, icol, codes):
+        if store_dtypes[icol] != 'code':
+            return np.asarray(codes)
+        return self.dictionary(icol)[codes].astype(object)
+
+    # Number of hits of a sample, None if the sample has no blast output
+    def count(self, sample):
+        if sample in self.offsets:
+            return self.offsets[sample][1] - self.offsets[sample][0]
+        return 0 if sample in self.files else None
+
+    # Hits of some samples (all by default) passing the filters, with the columns requested (all by default)
+    def scan(self, samples=None, filters=[], columns=None):
+        columns = list(store_dtypes) if columns is None else columns
+        if not self.exists:
+            return pd.DataFrame(columns=columns)
+        if samples is None:
+            ranges = [(0, self.column('sample').shape[0])]
+        else:
+            ranges = [self.offsets[isample] for isample in samples if isample in self.offsets]
+        rows = np.concatenate([np.arange(istart, iend) for istart, iend in ranges]) if len(ranges) > 0 \
+            else np.array([], dtype=np.int64)
+        for icol, iop, ivalue in filters:
+            if store_dtypes[icol] == 'code':
+                raise ValueError('filters apply to numeric columns, not ' + icol)
+            rows = rows[filter_ops[iop](self.column(icol)[rows], ivalue)]
+        return pd.DataFrame({icol: self.decode(icol, self.column(icol)[rows]) for icol in columns})
+
+
+def scan(DataSource, barcode, samples=None, filters=[], columns=None, store_dir=store_dir):
+    return Partition(os.path.join(store_dir, DataSource, barcode)).scan(samples, filters, columns)
+
+
+# ## Main
+
+# In[6]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Columnar store of blast hits, by DataSource and barcode')
+    parser.add_argument("action", type=str, help="ingest: load out_blast outputs in the store, scan: filtered hits as csv")
+    parser.add_argument("--DataSource", type=str)
+    parser.add_argument("--barcodes_table", type=str, default=None, help="ingest: barcodes of Barcode_Tests.csv")
+    parser.add_argument("--barcode", nargs='*', default=[], help="ingest, scan: barcodes")
+    parser.add_argument("--samples", nargs='*', default=None, help="scan: samples (all by default)")
+    parser.add_argument("--filters", nargs='*', default=[], help="scan: filters, e.g. pident>=95 length>=300 scov>=50")
+    parser.add_argument("--columns", nargs='*', default=None, help="scan: columns (all by default)")
+    parser.add_argument("--out", type=str, default=None, help="scan: output csv (stdout by default)")
+    parser.add_argument("--store_dir", type=str, default=store_dir)
+    args = parser.parse_args()
+
+    barcodes = args.barcode
+    if args.barcodes_table is not None:
+        barcodes += list(pd.read_csv(args.barcodes_table).Barcode)
+
+    if args.action == 'ingest':
+        ingest(args.DataSource, barcodes, args.store_dir)
+    elif args.action == 'scan':
+        hits_df = pd.concat([scan(args.DataSource, ibarcode, args.samples, parse_filters(args.filters), args.columns,
+                                  args.store_dir).assign(Barcode=ibarcode) for ibarcode in barcodes], ignore_index=True)
+        hits_df.to_csv(args.out if args.out is not None else sys.stdout, index=False)
+    else:
+        print('unknown action', args.action)
+        sys.exit(1)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # fasta_stats
+# Assembly statistics of fasta files (number of sequences, total length, N50, longest sequence, N and ambiguous bases),
+# computed on bytes without parsing records with Bio.SeqIO.
+# Statistics are kept in an index (csv) by path, with the size and mtime of each file, so that only new or modified
+# files are scanned again, in parallel processes.
+#
+# stats_index = fasta_stats.StatsIndex('fasta_stats.csv')
+# stats_df = stats_index.get_stats(list_of_fasta)
+# stats_index.save()
+#
+# python fasta_stats.py --index fasta_stats.csv fasta_pt/ fasta_nr/
+
+# In[1]:
+
+
+import os
+import argparse
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+
+# ## Parameters
+
+# In[2]:
+
+
+stats_cols=['Nseq','Sum_len','N50','Max_len','N_count','Ambig_count']
+index_cols=['path','size','mtime'] + stats_cols
+n_proc=os.cpu_count()
+
+
+# ## Functions
+
+# In[3]:
+
+
+def n50(lengths):
+    cum_len=0; sum_len=sum(lengths)
+    for ilen in sorted(lengths, reverse=True):
+        cum_len += ilen
+        if cum_len * 2 >= sum_len:
+            return ilen
+    return 0
+
+
+# Statistics of one fasta file, ambiguous bases are all but ACGT
+def scan_fasta(path):
+    with open(path, 'rb') as fin:
+        data = fin.read()
+    lengths=[]; N_count=0; Ambig_count=0
+    for record in data.split(b'\n>'):
+        if record.strip() == b'':
+            continue
+        header_end = record.find(b'\n')
+        seq = record[header_end + 1:].translate(None, b'\r\n\t ') if header_end >= 0 else b''
+        lengths.append(len(seq))
+        N_count += seq.count(b'N') + seq.count(b'n')
+        Ambig_count += len(seq.translate(None, b'ACGTacgt'))
+    return {'Nseq': len(lengths), 'Sum_len': sum(lengths), 'N50': n50(lengths),
+            'Max_len': max(lengths) if len(lengths) > 0 else 0, 'N_count': N_count, 'Ambig_count': Ambig_count}
+
+
+# In[4]:
+
+
+def file_key(path):
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return None
+
+
+class StatsIndex:
+    def __init__(self, index_path='fasta_stats.csv'):
+        self.index_path = index_path
+        self.index = {}
+        if index_path is not None and os.path.isfile(index_path):
+            for row in pd.read_csv(index_path).to_dict('records'):
+                self.index[row['path']] = row
+
+    def save(self):
+        if self.index_path is None:
+            return
+        pd.DataFrame(list(self.index.values()), columns=index_cols).to_csv(self.index_path + '.tmp', index=False)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    # Statistics of fasta files (one row per path, NaN if missing), scanning new or modified files only
+    def get_stats(self, paths, n_proc=n_proc):
+        keys = {ipath: file_key(ipath) for ipath in set(paths)}
+        todo = [ipath for ipath, ikey in keys.items() if ikey is not None and
+                (ipath not in self.index or (self.index[ipath]['size'], self.index[ipath]['mtime']) != ikey)]
+        if len(todo) > 0:
+            if n_proc > 1 and len(todo) > 1:
+                with ProcessPoolExecutor(max_workers=n_proc) as executor:
+                    stats = list(executor.map(scan_fasta, todo, chunksize=max(1, len(todo) // (4 * n_proc))))
+            else:
+                stats = [scan_fasta(ipath) for ipath in todo]
+            for ipath, istats in zip(todo, stats):
+                self.index[ipath] = dict(path=ipath, size=keys[ipath][0], mtime=keys[ipath][1], **istats)
+        rows = [self.index[ipath] if keys[ipath] is not None else {'path': ipath} for ipath in paths]
+        return pd.DataFrame(rows, columns=index_cols)
+
+
+# ## Main
+
+# In[5]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Assembly statistics of fasta files (Nseq, Sum_len, N50, Max_len, N_count, Ambig_count)')
+    parser.add_argument("paths", nargs='+', help="fasta files or directories of fasta files")
+    parser.add_argument("--index", type=str, default='fasta_stats.csv', help="index of statistics, updated")
+    parser.add_argument("--n_proc", type=int, default=n_proc)
+    args = parser.parse_args()
+
+    fasta_files=[]
+    for ipath in args.paths:
+        if os.path.isdir(ipath):
+            fasta_files += [os.path.join(ipath, ifile) for ifile in sorted(os.listdir(ipath)) if ifile.endswith('.fasta')]
+        else:
+            fasta_files.append(ipath)
+    stats_index = StatsIndex(args.index)
+    stats_df = stats_index.get_stats(fasta_files, n_proc=args.n_proc)
+    stats_index.save()
+    print(stats_df.shape[0], 'fasta files,', stats_df.Nseq.notnull().sum(), 'with statistics in', args.index)
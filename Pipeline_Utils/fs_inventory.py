@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # fs_inventory
+# Cached inventory of the directories and files used to build sample lists (fasta_pt, fasta_nr, logs,
+# Barcode_Validation, fastq symlinks), for network filesystems where every listdir and stat is slow.
+# Directories are listed with os.scandir and their file names are cached with their mtime: a directory is only listed
+# again when files were added or removed. Size and mtime of files change without the directory mtime changing (e.g. logs
+# rewritten in place), so they are not cached: they are stat'ed concurrently on a thread pool when asked (stat=True).
+# Existence of many paths (e.g. R1/R2 fastq) is checked concurrently and cached as long as the mtime of their parent
+# directory does not change, except for symlinks, whose target can appear or disappear elsewhere.
+#
+# inventory = fs_inventory.Inventory('.fs_inventory.pkl')
+# files_df = pd.DataFrame(inventory.list_dir('PAFTOL/logs/', stat=True))
+# exists = inventory.exists_many(list_of_paths)
+# inventory.save()
+
+# In[1]:
+
+
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ## Parameters
+
+# In[2]:
+
+
+n_threads=32
+
+
+# ## Functions
+
+# In[3]:
+
+
+def dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+# Size and mtime of a file, None for broken symlinks
+def stat_entry(path):
+    try:
+        st = os.stat(path)
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+    except OSError:
+        return {'size': None, 'mtime': None}
+
+
+# Existence of a path, and whether it can be cached until its parent directory changes (not a symlink)
+def check_path(path):
+    return os.path.exists(path), not os.path.islink(path)
+
+
+# In[4]:
+
+
+def scan_dir(path):
+    entries=[]
+    with os.scandir(path) as it:
+        for ientry in it:
+            try:
+                entries.append({'file': ientry.name, 'is_dir': ientry.is_dir()})
+            except OSError:
+                entries.append({'file': ientry.name, 'is_dir': False})
+    return entries
+
+
+# In[5]:
+
+
+class Inventory:
+    def __init__(self, cache_path='.fs_inventory.pkl'):
+        self.cache_path = cache_path
+        self.dirs = {}    # path: {'mtime':, 'scan_time':, 'entries':}
+        self.exists = {}  # parent dir: {'mtime':, 'paths': {path: bool}}
+        if cache_path is not None and os.path.isfile(cache_path):
+            try:
+                with open(cache_path, 'rb') as fin:
+                    cache = pickle.load(fin)
+                self.dirs, self.exists = cache['dirs'], cache['exists']
+            except Exception:
+                print('could not read inventory cache', cache_path, ', starting empty')
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'wb') as fout:
+            pickle.dump({'dirs': self.dirs, 'exists': self.exists}, fout)
+        os.replace(tmp_path, self.cache_path)
+
+    # Entries of a directory (file, is_dir), from cache if the directory did not change, with their current size
+    # and mtime if stat
+    def list_dir(self, path, stat=False):
+        path = os.path.normpath(path)
+        mtime = dir_mtime(path)
+        if mtime is None:
+            return []
+        cached = self.dirs.get(path)
+        if cached is None or cached['mtime'] != mtime:
+            cached = {'mtime': mtime, 'entries': scan_dir(path)}
+            self.dirs[path] = cached
+        entries = [{'file': ientry['file'], 'is_dir': ientry['is_dir']} for ientry in cached['entries']]
+        if stat and len(entries) > 0:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                stats = executor.map(stat_entry, [os.path.join(path, ientry['file']) for ientry in entries])
+                for ientry, ist in zip(entries, stats):
+                    ientry.update(ist)
+        return entries
+
+    # os.path.exists for many paths, concurrently, cached by parent directory mtime. Missing values (NaN) do not exist
+    def exists_many(self, paths):
+        valid = [isinstance(ipath, str) for ipath in paths]
+        exist = self._exists_many([os.path.normpath(ipath) for ipath, ivalid in zip(paths, valid) if ivalid])[::-1]
+        return [exist.pop() if ivalid else False for ivalid in valid]
+
+    def _exists_many(self, paths):
+        parents = set([os.path.dirname(ipath) for ipath in paths])
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            parent_mtimes = dict(zip(parents, executor.map(dir_mtime, parents)))
+        for iparent, imtime in parent_mtimes.items():
+            if iparent not in self.exists or self.exists[iparent]['mtime'] != imtime:
+                self.exists[iparent] = {'mtime': imtime, 'paths': {}}
+        todo = list(set([ipath for ipath in paths if ipath not in self.exists[os.path.dirname(ipath)]['paths']]))
+        checked = {}
+        if len(todo) > 0:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                for ipath, (iexist, icache) in zip(todo, executor.map(check_path, todo)):
+                    checked[ipath] = iexist
+                    if icache:
+                        self.exists[os.path.dirname(ipath)]['paths'][ipath] = iexist
+        return [checked[ipath] if ipath in checked else self.exists[os.path.dirname(ipath)]['paths'][ipath]
+                for ipath in paths]
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # job_runner
+# Runs the array scripts of the pipeline (Blast_on_barcodes.sh, GetOrg_array.sh, ...) either locally in a pool of
+# processes, or through SLURM (sbatch --array), from the same task lists (Samples_to_barcode.txt, remaining_pt.txt, ...).
+# Task i is line i of the task list, and is passed to the script as SLURM_ARRAY_TASK_ID, so scripts run unchanged.
+# The exit status, timing and peak memory of each task are recorded in a state file, by sample (first field of the line)
+# and hash of the line, and tasks already completed are skipped when a run is resumed. A run is set by the launching
+# pipeline (--run, e.g. TELEMETRY_RUN of Barcode_Validation.sh or GetOrg_Pipeline.sh), or is the content of the task list:
+# a new launch of the pipeline starts a new run, so batches or samples listed again are not skipped because of an
+# earlier launch, and the same launch is resumed with the same run. The state file keeps the history of all runs
+# (used by GetOrg_resources.py). With SLURM, tasks are recorded as submitted, and their final status is read from sacct
+# when the run is resumed: tasks still pending or running are not submitted again.
+#
+# python job_runner.py --tasks remaining_pt.txt --script ../GetOrg_array.sh --script_args remaining_pt.txt pt \
+#     --backend local --throttle 5 --cpus 4 --mem 80000 --total_cpus 32 --total_mem 256000 --run 20210727-101500
+
+# In[1]:
+
+
+import os
+import sys
+import csv
+import hashlib
+import time
+import resource
+import subprocess
+import threading
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ## Parameters
+
+# In[2]:
+
+
+state_cols=['task_id','label','task_hash','backend','status','exit_code','start','end','elapsed_s','maxrss_kb','mem',
+            'job_id','run']
+# sacct states of tasks not finished yet
+active_states=['PENDING','RUNNING','REQUEUED','RESIZING','SUSPENDED','CONFIGURING','COMPLETING']
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Tasks as {task_id: {label, task_hash}}, label being the first field of the line (sample), task_hash the hash of the line
+def read_tasks(tasks_file):
+    tasks={}
+    with open(tasks_file) as fin:
+        for itask, iline in enumerate(fin, start=1):
+            if iline.strip() != '':
+                tasks[itask] = {'label': iline.strip().split(',')[0],
+                                'task_hash': hashlib.sha1(iline.strip().encode()).hexdigest()[:12]}
+    return tasks
+
+
+# Run of a task list without a run set by the pipeline, from its content only
+def task_list_run(tasks_file):
+    with open(tasks_file, 'rb') as fin:
+        return hashlib.sha1(fin.read()).hexdigest()[:12]
+
+
+# In[4]:
+
+
+# Last recorded status of each task of a run, by label and task_hash
+def read_state(state_file, run):
+    state={}
+    if os.path.isfile(state_file):
+        with open(state_file) as fin:
+            for row in csv.DictReader(fin):
+                if row.get('run') == run:
+                    state[(row['label'], row.get('task_hash') or '')] = row
+    return state
+
+
+class StateWriter:
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.cols = state_cols
+        if not os.path.isfile(state_file):
+            with open(state_file, 'w') as fout:
+                csv.writer(fout).writerow(state_cols)
+        else:
+            # state files written by older versions get the new columns, their rows are kept as history
+            with open(state_file) as fin:
+                rows = list(csv.DictReader(fin))
+                cols = rows[0].keys() if len(rows) > 0 else state_cols
+            if list(cols) != state_cols:
+                with open(state_file + '.tmp', 'w') as fout:
+                    writer = csv.DictWriter(fout, fieldnames=state_cols, extrasaction='ignore')
+                    writer.writeheader()
+                    writer.writerows(rows)
+                os.replace(state_file + '.tmp', state_file)
+
+    def write(self, row):
+        with self.lock:
+            with open(self.state_file, 'a') as fout:
+                csv.DictWriter(fout, fieldnames=self.cols, extrasaction='ignore').writerow(row)
+                fout.flush()
+
+
+# In[5]:
+
+
+# Tasks to run, neither completed nor still pending or running on SLURM (running)
+def pending_tasks(tasks, state, retry_failed=True):
+    done_status = ['done','running'] if retry_failed else ['done','running','failed']
+    return [itask for itask, task in tasks.items()
+            if state.get((task['label'], task['task_hash']), {}).get('status') not in done_status]
+
+
+# In[6]:
+
+
+def exit_code_from_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+# In[7]:
+
+
+# Run one task locally, with its peak memory (ru_maxrss) from os.wait4
+def run_local_task(itask, task, script, script_args, cpus, mem, log_dir, enforce_mem, writer, run=''):
+    env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(itask), SLURM_CPUS_PER_TASK=str(cpus),
+               SLURM_MEM_PER_NODE=str(mem), OMP_NUM_THREADS=str(cpus))
+
+    def set_limits():
+        if enforce_mem:
+            mem_bytes = int(mem) * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (mem_bytes, mem_bytes))
+
+    log_name = os.path.join(log_dir, os.path.basename(script) + '_' + str(itask))
+    start = time.time()
+    with open(log_name + '.out', 'w') as fout, open(log_name + '.err', 'w') as ferr:
+        # tasks do not read the stdin of the runner (e.g. a list read by the launching loop)
+        proc = subprocess.Popen(['bash', script] + script_args, stdin=subprocess.DEVNULL, stdout=fout, stderr=ferr,
+                                env=env, preexec_fn=set_limits if enforce_mem else None)
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = exit_code_from_status(status)
+    end = time.time()
+    row = {'task_id': itask, 'label': task['label'], 'task_hash': task['task_hash'], 'backend': 'local',
+           'status': 'done' if proc.returncode == 0 else 'failed', 'exit_code': proc.returncode,
+           'start': round(start, 1), 'end': round(end, 1), 'elapsed_s': round(end - start, 1), 'maxrss_kb': rusage.ru_maxrss, 'mem': mem, 'run': run}
+    writer.write(row)
+    print(row['status'], itask, task['label'], 'exit:', row['exit_code'], 'elapsed:', row['elapsed_s'], 's', flush=True)
+    return row
+
+
+# In[8]:
+
+
+# Number of tasks run at once, within the throttle and the cpu and memory budgets of the machine
+def get_concurrency(throttle, cpus, mem, total_cpus=None, total_mem=None):
+    concurrency = throttle
+    if total_cpus is not None:
+        concurrency = min(concurrency, max(1, total_cpus // cpus))
+    if total_mem is not None:
+        concurrency = min(concurrency, max(1, total_mem // mem))
+    return concurrency
+
+
+def run_local(tasks, pending, script, script_args, cpus, mem, concurrency, state_file, log_dir='runner_logs',
+              enforce_mem=False, run=''):
+    os.makedirs(log_dir, exist_ok=True)
+    writer = StateWriter(state_file)
+    print('running', len(pending), 'tasks locally,', concurrency, 'at a time')
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_local_task, itask, tasks[itask], script, script_args, cpus, mem, log_dir,
+                                   enforce_mem, writer, run) for itask in pending]
+        rows = [ifuture.result() for ifuture in futures]
+    return rows
+
+
+# In[9]:
+
+
+# Compact array specification, e.g. [1,2,3,7,9,10] > 1-3,7,9-10
+def array_spec(task_ids):
+    task_ids = sorted(task_ids); ranges=[]
+    for itask in task_ids:
+        if len(ranges) > 0 and ranges[-1][1] == itask - 1:
+            ranges[-1][1] = itask
+        else:
+            ranges.append([itask, itask])
+    return ','.join([str(istart) if istart == iend else str(istart) + '-' + str(iend) for istart, iend in ranges])
+
+
+def run_slurm(tasks, pending, script, script_args, cpus, mem, throttle, state_file, sbatch_args=[], run=''):
+    cmd = ['sbatch', '--array=' + array_spec(pending) + '%' + str(throttle), '--cpus-per-task=' + str(cpus),
+           '--mem=' + str(mem)] + sbatch_args + [script] + script_args
+    print(' '.join(cmd))
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    print(proc.stdout, end='')
+    exit_code = proc.returncode
+    # "Submitted batch job <job_id>", to get the usage of tasks from sacct
+    job_id = proc.stdout.strip().split(' ')[-1] if exit_code == 0 else ''
+    writer = StateWriter(state_file)
+    for itask in pending:
+        writer.write({'task_id': itask, 'label': tasks[itask]['label'], 'task_hash': tasks[itask]['task_hash'],
+                      'backend': 'slurm',
+                      'status': 'submitted' if exit_code == 0 else 'failed', 'exit_code': exit_code,
+                      'start': round(time.time(), 1), 'mem': mem, 'job_id': job_id, 'run': run})
+    return exit_code
+
+
+# Task ids of an array specification, e.g. 1-3,7 > [1,2,3,7]
+def expand_array_spec(spec):
+    task_ids=[]
+    for irange in spec.split(','):
+        bounds = irange.split('-')
+        task_ids += list(range(int(bounds[0]), int(bounds[-1]) + 1))
+    return task_ids
+
+
+# State, exit code, elapsed time and peak memory (kB) of the tasks of slurm array jobs, by <job_id>_<task_id>
+def read_sacct(job_ids):
+    cmd = ['sacct', '-n', '-P', '-j', ','.join(sorted(job_ids)), '--format=JobID,State,ExitCode,ElapsedRaw,MaxRSS']
+    try:
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    except OSError:
+        print('sacct not available, status of slurm tasks not updated')
+        return {}
+    units = {'K': 1, 'M': 1024, 'G': 1024**2}
+    sacct={}
+    for iline in out.splitlines():
+        job, state, exit_code, elapsed, maxrss = iline.split('|')
+        job = job.split('.')[0]
+        # tasks of an array not started yet, e.g. 1234_[5-9%10]
+        if '_[' in job:
+            job_id, spec = job.split('_[')
+            for itask in expand_array_spec(spec.rstrip(']').split('%')[0]):
+                sacct[job_id + '_' + str(itask)] = {'state': 'PENDING'}
+            continue
+        # job line has the state, steps (.batch) have the memory
+        if job not in sacct:
+            code, signal = [int(icode) for icode in exit_code.split(':')]
+            sacct[job] = {'state': state.split(' ')[0], 'exit_code': -signal if signal > 0 else code,
+                          'elapsed_s': elapsed, 'maxrss_kb': 0}
+        if maxrss[-1:] in units:
+            sacct[job]['maxrss_kb'] = max(sacct[job]['maxrss_kb'], int(float(maxrss[:-1]) * units[maxrss[-1]]))
+    return sacct
+
+
+# Final status of the tasks of a run submitted to SLURM, recorded in the state file. Tasks still pending or running are
+# marked running in the state returned, not in the state file.
+def refresh_slurm(state, state_file):
+    submitted = {ikey: row for ikey, row in state.items()
+                 if row.get('backend') == 'slurm' and row.get('status') == 'submitted' and row.get('job_id')}
+    if len(submitted) == 0:
+        return state
+    sacct = read_sacct(set([row['job_id'] for row in submitted.values()]))
+    writer = StateWriter(state_file)
+    for ikey, row in submitted.items():
+        task = sacct.get(row['job_id'] + '_' + row['task_id'])
+        if task is None:
+            continue
+        if task['state'] in active_states:
+            state[ikey] = dict(row, status='running')
+            continue
+        elapsed = float(task['elapsed_s'] or 0)
+        state[ikey] = dict(row, status='done' if task['state'] == 'COMPLETED' else 'failed',
+                           exit_code=task['exit_code'], end=round(float(row['start']) + elapsed, 1),
+                           elapsed_s=elapsed, maxrss_kb=task['maxrss_kb'])
+        writer.write(state[ikey])
+    return state
+
+
+# ## Main
+
+# In[10]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Run the tasks of an array script locally (process pool) or with SLURM')
+    parser.add_argument("--tasks", type=str, help="task list, one task per line (e.g. remaining_pt.txt)")
+    parser.add_argument("--script", type=str, help="array script reading SLURM_ARRAY_TASK_ID (e.g. ../GetOrg_array.sh)")
+    parser.add_argument("--script_args", nargs='*', default=[], help="arguments of the script")
+    parser.add_argument("--backend", type=str, default='local', help="local or slurm")
+    parser.add_argument("--throttle", type=int, default=5, help="maximum number of tasks running at once")
+    parser.add_argument("--cpus", type=int, default=1, help="cpus per task")
+    parser.add_argument("--mem", type=int, default=4000, help="memory per task, in MB")
+    parser.add_argument("--total_cpus", type=int, default=os.cpu_count(), help="local: cpus available")
+    parser.add_argument("--total_mem", type=int, default=None, help="local: memory available, in MB")
+    parser.add_argument("--enforce_mem", action="store_true", default=False,
+                        help="local: limit the address space of each task to --mem")
+    parser.add_argument("--state", type=str, default=None, help="state file, default <tasks>.runner.csv")
+    parser.add_argument("--no_retry", action="store_true", default=False, help="do not rerun failed tasks when resuming")
+    parser.add_argument("--sbatch_args", type=str, default='', help="slurm: extra sbatch arguments (e.g. '-p short')")
+    parser.add_argument("--run", type=str, default=None,
+                        help="run id set by the pipeline (one per launch), default from the content of the task list")
+    args = parser.parse_args()
+
+    state_file = args.state if args.state is not None else args.tasks + '.runner.csv'
+    tasks = read_tasks(args.tasks)
+    run = args.run if args.run is not None else task_list_run(args.tasks)
+    state = refresh_slurm(read_state(state_file, run), state_file)
+    pending = pending_tasks(tasks, state, retry_failed=not args.no_retry)
+    print(len(tasks), 'tasks,', len(tasks) - len(pending), 'already completed or running,', len(pending), 'to run')
+    if len(pending) == 0:
+        sys.exit(0)
+
+    if args.backend == 'local':
+        concurrency = get_concurrency(args.throttle, args.cpus, args.mem, args.total_cpus, args.total_mem)
+        rows = run_local(tasks, pending, args.script, args.script_args, args.cpus, args.mem, concurrency, state_file,
+                         enforce_mem=args.enforce_mem, run=run)
+        Nfailed = sum([irow['status'] == 'failed' for irow in rows])
+        print(len(rows) - Nfailed, 'tasks done,', Nfailed, 'failed')
+        sys.exit(1 if Nfailed > 0 else 0)
+    elif args.backend == 'slurm':
+        sys.exit(run_slurm(tasks, pending, args.script, args.script_args, args.cpus, args.mem, args.throttle, state_file,
+                           sbatch_args=args.sbatch_args.split(), run=run))
+    else:
+        print('unknown backend', args.backend)
+        sys.exit(1)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # kmers
+# Numpy k-mer utilities shared by the k-mer prescreen of barcode databases and the read-level checks.
+# Sequences are 2-bit encoded (A,C,G,T), k-mers containing other characters (N, gaps, IUPAC) are skipped,
+# and k-mers are canonical (minimum of forward and reverse complement) so that strand does not matter.
+# Sketches keep the fraction 1/scale of hashed k-mers (FracMinHash), comparable between sequences of any length.
+
+# In[1]:
+
+
+import numpy as np
+import gzip
+
+
+# ## Parameters
+
+# In[2]:
+
+
+max_k=31
+invalid_code=4
+# Byte to 2-bit code lookup, upper and lower case
+code_table = np.full(256, invalid_code, dtype=np.uint8)
+for ibase, icode in zip('ACGT', range(4)):
+    code_table[ord(ibase)] = icode
+    code_table[ord(ibase.lower())] = icode
+max_hash = np.uint64(2**64 - 1)
+
+
+# ## Functions
+
+# In[3]:
+
+
+def encode(seq):
+    if isinstance(seq, str):
+        seq = seq.encode()
+    return code_table[np.frombuffer(seq, dtype=np.uint8)]
+
+
+# In[4]:
+
+
+# Canonical k-mers of every window of an encoded sequence, and whether the window has no invalid character.
+# Window i starts at position i, so that k-mers can be traced back to reads joined by an invalid code
+def kmer_windows(codes, k):
+    if k > max_k:
+        raise ValueError('k must be <= ' + str(max_k))
+    n = codes.shape[0] - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    # Windows without invalid characters
+    invalid = np.concatenate([[0], np.cumsum(codes == invalid_code)])
+    valid = (invalid[k:] - invalid[:-k]) == 0
+    codes64 = codes.astype(np.uint64) & np.uint64(3)
+    fw = np.zeros(n, dtype=np.uint64)
+    rc = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        fw = (fw << np.uint64(2)) | codes64[j:j + n]
+        rc = rc | ((np.uint64(3) - codes64[j:j + n]) << np.uint64(2 * j))
+    return np.minimum(fw, rc), valid
+
+
+# Canonical k-mers of an encoded sequence (or of several sequences joined by an invalid code)
+def canonical_kmers(codes, k):
+    kmers, valid = kmer_windows(codes, k)
+    return kmers[valid]
+
+
+# In[5]:
+
+
+# 64-bit mix (splitmix64 finalizer), so that sketches are a uniform sample of k-mers
+def hash_kmers(kmers):
+    h = kmers.copy()
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xbf58476d1ce4e5b9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94d049bb133111eb)
+    h ^= h >> np.uint64(31)
+    return h
+
+
+# In[6]:
+
+
+# Unique hashes kept in the sketch (hash < max_hash / scale)
+def sketch(seq, k, scale=1):
+    hashes = hash_kmers(canonical_kmers(encode(seq), k))
+    if scale > 1:
+        hashes = hashes[hashes <= max_hash // np.uint64(scale)]
+    return np.unique(hashes)
+
+
+# In[7]:
+
+
+# Iterate over (id, description, sequence) of a fasta file, gzipped or not
+def read_fasta(fasta_path):
+    opener = gzip.open if fasta_path.endswith('.gz') else open
+    seq_id = None
+    with opener(fasta_path, 'rt') as fin:
+        for iline in fin:
+            iline = iline.rstrip()
+            if iline.startswith('>'):
+                if seq_id is not None:
+                    yield seq_id, desc, ''.join(seq)
+                header = iline[1:].split(None, 1)
+                seq_id = header[0]
+                desc = header[1] if len(header) > 1 else ''
+                seq = []
+            elif seq_id is not None:
+                seq.append(iline)
+    if seq_id is not None:
+        yield seq_id, desc, ''.join(seq)
+
+
+# Iterate over chunks of (header, sequence, quality) of a fastq file, gzipped or not, as bytes
+def read_fastq_chunks(fastq_path, chunk_size=100000):
+    opener = gzip.open if fastq_path.endswith('.gz') else open
+    with opener(fastq_path, 'rb') as fin:
+        chunk=[]
+        while True:
+            header = fin.readline()
+            if header == b'':
+                break
+            seq = fin.readline().rstrip(); fin.readline(); qual = fin.readline().rstrip()
+            chunk.append((header.rstrip(), seq, qual))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk=[]
+        if len(chunk) > 0:
+            yield chunk
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # ref_index
+# Random access to reference fasta files (barcode databases) by Locus.
+# Sequences are located with a faidx index (<fasta>.fai: name, length, offset, bases and bytes per line,
+# as samtools faidx), and taxonomy is stored in a typed numpy sidecar (<fasta>.taxo.npy), in the order of the fai.
+# Taxonomy comes from _TAXO.csv when it exists, completed by the fasta description (;gene=..,type=..,f=..,g=..,s=..;).
+# The sidecar can be memory-mapped, and both are rebuilt when the fasta or _TAXO.csv is newer.
+#
+# refs = ref_index.RefIndex('Barcode_DB/NCBI_18s.fasta')
+# seq = refs.fetch('KY652173.1'); taxo = refs.taxonomy('KY652173.1')
+# refs.write_subset(list_of_loci, 'Fabaceae_18s.fasta')
+#
+# python ref_index.py build --fasta Barcode_DB/NCBI_18s.fasta
+# python ref_index.py fetch --fasta Barcode_DB/NCBI_18s.fasta --loci KY652173.1 MN123456.1
+
+# In[1]:
+
+
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+
+# ## Parameters
+
+# In[2]:
+
+
+taxo_fields={'gene':'gene','type':'type','f':'family','g':'genus','s':'sci_name'}
+taxo_cols=['Locus','gene','type','family','genus','species','sci_name','TaxID']
+int_cols=['TaxID']
+
+
+# ## Functions
+
+# In[3]:
+
+
+# faidx entries (name, length, offset, line bases, line bytes) and descriptions of a fasta
+def scan_fasta(fasta_path):
+    entries=[]; descs=[]
+    with open(fasta_path, 'rb') as fin:
+        offset = 0; entry = None
+        for iline in fin:
+            if iline.startswith(b'>'):
+                if entry is not None:
+                    entries.append(entry)
+                header = iline[1:].decode().rstrip().split(None, 1)
+                descs.append(header[1] if len(header) > 1 else '')
+                entry = {'name': header[0], 'length': 0, 'offset': offset + len(iline), 'linebases': 0,
+                         'linewidth': 0, 'last_line': False}
+            elif entry is not None and iline.strip() != b'':
+                bases = len(iline.rstrip(b'\r\n'))
+                if entry['linebases'] == 0:
+                    entry['linebases'] = bases; entry['linewidth'] = len(iline)
+                elif entry['last_line'] or len(iline) != entry['linewidth']:
+                    if entry['last_line'] or bases > entry['linebases']:
+                        raise ValueError('irregular line length in ' + entry['name'] + ', rewrap ' + fasta_path)
+                    entry['last_line'] = True
+                entry['length'] += bases
+            offset += len(iline)
+        if entry is not None:
+            entries.append(entry)
+    fai = pd.DataFrame(entries, columns=['name','length','offset','linebases','linewidth'])
+    return fai, descs
+
+
+def parse_description(desc):
+    taxo={}
+    for ifield in desc.strip().strip(';').split(','):
+        if '=' in ifield:
+            ikey, ivalue = ifield.split('=', 1)
+            if ikey in taxo_fields:
+                taxo[taxo_fields[ikey]] = ivalue
+    return taxo
+
+
+# In[4]:
+
+
+# Taxonomy of references in fai order, as a numpy structured array with fixed width strings
+def taxonomy_table(fasta_path, fai, descs):
+    taxo_df = pd.DataFrame([parse_description(idesc) for idesc in descs], columns=taxo_cols[1:], dtype=object)
+    taxo_df.insert(0, 'Locus', fai.name.values)
+    taxo_file = fasta_path.replace('.fasta', '_TAXO.csv')
+    if os.path.isfile(taxo_file):
+        taxo_csv = pd.read_csv(taxo_file).rename(columns={'mol_type':'type'}).astype({'Locus':'str'})
+        taxo_csv = taxo_csv.drop_duplicates('Locus').set_index('Locus').astype(object)
+        taxo_df = taxo_df.set_index('Locus')
+        taxo_df.update(taxo_csv[[icol for icol in taxo_cols[1:] if icol in taxo_csv.columns]])
+        taxo_df = taxo_df.reset_index()
+    dtypes=[]
+    for icol in taxo_cols:
+        if icol in int_cols:
+            taxo_df[icol] = pd.to_numeric(taxo_df[icol], errors='coerce').fillna(-1).astype(np.int64)
+            dtypes.append((icol, np.int64))
+        else:
+            taxo_df[icol] = taxo_df[icol].fillna('').astype(str)
+            dtypes.append((icol, 'U' + str(max(1, taxo_df[icol].str.len().max() if taxo_df.shape[0] > 0 else 1))))
+    return np.array(list(taxo_df[taxo_cols].itertuples(index=False, name=None)), dtype=dtypes)
+
+
+def build_index(fasta_path):
+    fai, descs = scan_fasta(fasta_path)
+    fai.to_csv(fasta_path + '.fai', sep='\t', header=False, index=False)
+    np.save(fasta_path + '.taxo.npy', taxonomy_table(fasta_path, fai, descs))
+    print(fai.shape[0], 'references indexed in', fasta_path + '.fai and .taxo.npy')
+
+
+# Index older than the fasta or than its _TAXO.csv
+def is_stale(fasta_path):
+    mtime = os.path.getmtime(fasta_path)
+    taxo_file = fasta_path.replace('.fasta', '_TAXO.csv')
+    if os.path.isfile(taxo_file):
+        mtime = max(mtime, os.path.getmtime(taxo_file))
+    return any([not os.path.isfile(ipath) or os.path.getmtime(ipath) < mtime
+                for ipath in [fasta_path + '.fai', fasta_path + '.taxo.npy']])
+
+
+# In[5]:
+
+
+class RefIndex:
+    def __init__(self, fasta_path, build=True):
+        self.fasta_path = fasta_path
+        if build and is_stale(fasta_path):
+            build_index(fasta_path)
+        fai = pd.read_csv(fasta_path + '.fai', sep='\t', header=None, dtype={0: str},
+                          names=['name','length','offset','linebases','linewidth'])
+        self.fai = dict(zip(fai.name, fai[['length','offset','linebases','linewidth']].itertuples(index=False, name=None)))
+        self.taxo = np.load(fasta_path + '.taxo.npy', mmap_mode='r')
+        self.rows = dict(zip(fai.name, range(fai.shape[0])))
+        self.fin = open(fasta_path, 'rb')
+
+    def loci(self):
+        return list(self.fai)
+
+    # Sequence of a locus, or of the bases start:end (0-based)
+    def fetch(self, locus, start=0, end=None):
+        length, offset, linebases, linewidth = self.fai[locus]
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return ''
+        first = offset + (start // linebases) * linewidth + start % linebases
+        last = offset + ((end - 1) // linebases) * linewidth + (end - 1) % linebases
+        self.fin.seek(first)
+        return self.fin.read(last - first + 1).replace(b'\n', b'').replace(b'\r', b'').decode()
+
+    def taxonomy(self, locus):
+        row = self.taxo[self.rows[locus]]
+        return {icol: (int(row[icol]) if icol in int_cols else str(row[icol])) for icol in taxo_cols}
+
+    def taxonomy_df(self, loci=None):
+        taxo_df = pd.DataFrame(np.asarray(self.taxo))
+        return taxo_df if loci is None else taxo_df[taxo_df.Locus.isin(loci)]
+
+    # Sub-database of some loci, with their description and taxonomy
+    def write_subset(self, loci, out_fasta, line_width=60):
+        with open(out_fasta, 'w') as fout:
+            for ilocus in loci:
+                taxo = self.taxonomy(ilocus); seq = self.fetch(ilocus)
+                fout.write('>' + ilocus + ' ;gene=' + taxo['gene'] + ',type=' + taxo['type'] + ',f=' + taxo['family']
+                           + ',g=' + taxo['genus'] + ',s=' + taxo['sci_name'] + ';\n')
+                fout.write(''.join([seq[i:i + line_width] + '\n' for i in range(0, len(seq), line_width)]))
+
+    def close(self):
+        self.fin.close()
+
+
+# ## Main
+
+# In[6]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='faidx and taxonomy index of reference fasta files, and lookups by Locus')
+    parser.add_argument("action", type=str, help="build, fetch, taxo or subset")
+    parser.add_argument("--fasta", type=str, help="reference fasta")
+    parser.add_argument("--loci", nargs='*', default=[], help="fetch, taxo, subset: loci")
+    parser.add_argument("--loci_file", type=str, default=None, help="fetch, taxo, subset: file of loci, one per line")
+    parser.add_argument("--out", type=str, default=None, help="subset: output fasta")
+    args = parser.parse_args()
+
+    loci = args.loci
+    if args.loci_file is not None:
+        loci += [iline.strip() for iline in open(args.loci_file) if iline.strip() != '']
+
+    if args.action == 'build':
+        build_index(args.fasta)
+    elif args.action == 'fetch':
+        refs = RefIndex(args.fasta)
+        for ilocus in loci:
+            sys.stdout.write('>' + ilocus + '\n' + refs.fetch(ilocus) + '\n')
+    elif args.action == 'taxo':
+        RefIndex(args.fasta).taxonomy_df(loci).to_csv(sys.stdout, index=False)
+    elif args.action == 'subset':
+        RefIndex(args.fasta).write_subset(loci, args.out)
+    else:
+        print('unknown action', args.action)
+        sys.exit(1)
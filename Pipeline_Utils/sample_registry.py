@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # sample_registry
+# Sample registry compiled once from a paftol_export (or a <DataSource>_samples.csv), as an sqlite file next to it
+# (<csv>.sqlite), indexed by Sample, idSequencing, idPaftol and DataSource.
+# For exports, DataSource names are shortened (Annotated genome: AG, Unannotated genome: UG), and the Sample name
+# and R1/R2 fastq paths are precomputed. Per-sample tasks then look up their row instead of reading the whole csv.
+# The registry is rebuilt when the csv is newer.
+#
+# registry = sample_registry.open_registry('2021-07-27_paftol_export.csv')
+# sample_dic = registry.get('Sample', 'PAFTOL_000001')
+# db = registry.datasource('PAFTOL')
+
+# In[1]:
+
+
+import os
+import sqlite3
+import fcntl
+import contextlib
+import pandas as pd
+
+
+# ## Parameters
+
+# In[2]:
+
+
+key_cols=['Sample','idSequencing','idPaftol','DataSource']
+datasource_names={'Annotated genome':'AG','Unannotated genome':'UG'}
+fastq_paths={'PAFTOL':'/science/projects/paftol/AllData_symlinks/',
+             'GAP':'/science/projects/paftol/AllData_symlinks/',
+             'SRA':'/data/projects/paftol/SRA_Data/'}
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Sample name and fastq paths of export entries, by DataSource
+def derive_samples(db):
+    db['DataSource'] = db.DataSource.replace(datasource_names)
+    db['Sample'] = None; db['R1_path'] = None; db['R2_path'] = None
+    for iprefix in ['PAFTOL','GAP']:
+        idx = db[(db.DataSource==iprefix) & (db.idSequencing.notnull())].index
+        db.loc[idx,'Sample'] = iprefix + '_' + db.loc[idx,'idSequencing'].astype(int).astype('str').str.zfill(6)
+        db.loc[idx,'R1_path'] = fastq_paths[iprefix] + db.loc[idx,'Sample'] + '_R1.fastq.gz'
+        db.loc[idx,'R2_path'] = fastq_paths[iprefix] + db.loc[idx,'Sample'] + '_R2.fastq.gz'
+    idx = db[db.DataSource.isin(['OneKP','SRA','UG','AG'])].index
+    db.loc[idx,'Sample'] = db.loc[idx,'ExternalSequenceID']
+    idx = db[db.DataSource=='SRA'].index
+    db.loc[idx,'R1_path'] = fastq_paths['SRA'] + db.loc[idx,'R1FastqFile']
+    db.loc[idx,'R2_path'] = fastq_paths['SRA'] + db.loc[idx,'R2FastqFile']
+    return db
+
+
+# In[4]:
+
+
+def build_registry(csv_file, registry_file):
+    db = pd.read_csv(csv_file)
+    if 'DataSource' in db.columns:
+        db = derive_samples(db)
+    # committed, then closed before the registry is replaced (a connection used as context manager is not closed)
+    with contextlib.closing(sqlite3.connect(registry_file + '.tmp')) as con:
+        with con:
+            con.execute('DROP TABLE IF EXISTS samples')
+            db.to_sql('samples', con, index=False)
+            for icol in key_cols:
+                if icol in db.columns:
+                    con.execute('CREATE INDEX idx_' + icol + ' ON samples (' + icol + ')')
+    os.replace(registry_file + '.tmp', registry_file)
+    print('sample registry of', db.shape[0], 'entries written to', registry_file)
+
+
+class Registry:
+    def __init__(self, registry_file):
+        self.con = sqlite3.connect('file:' + registry_file + '?mode=ro', uri=True)
+        self.con.row_factory = sqlite3.Row
+
+    # First entry with key == value, as a dictionary, None if not found
+    def get(self, key, value):
+        if key not in key_cols:
+            raise ValueError('registry lookups are by ' + ', '.join(key_cols))
+        row = self.con.execute('SELECT * FROM samples WHERE ' + key + ' = ? LIMIT 1', (value,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def datasource(self, DataSource):
+        return pd.read_sql('SELECT * FROM samples WHERE DataSource = ?', self.con, params=(DataSource,))
+
+
+# In[5]:
+
+
+# Registry of a csv, built (once, if several tasks start together) when missing or older than the csv
+def open_registry(csv_file):
+    registry_file = csv_file + '.sqlite'
+    if not os.path.isfile(registry_file) or os.path.getmtime(registry_file) < os.path.getmtime(csv_file):
+        with open(registry_file + '.lock', 'a') as flock:
+            fcntl.flock(flock, fcntl.LOCK_EX)
+            if not os.path.isfile(registry_file) or os.path.getmtime(registry_file) < os.path.getmtime(csv_file):
+                build_registry(csv_file, registry_file)
+            fcntl.flock(flock, fcntl.LOCK_UN)
+    return Registry(registry_file)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # TaxID to WCVP cache
+# Resolutions of NCBI TaxIDs against WCVP (output rows of wcvp_taxo.py), kept by WCVP release and wcvp_taxo.py options
+# in TaxID_WCVP/<release>_<options>.csv, so that records of TaxIDs resolved before skip name resolution. TaxIDs whose
+# name was not resolved (no match, diverted duplicates) are kept with an empty sci_name and are not sent again for the
+# same release and options. A new WCVP release, or other options, start a new cache. Concurrent jobs merge their rows
+# under a lock.
+#
+# wcvp_opts = '-g -s similarity_genus -d divert_genusOK'
+# cache = taxid_cache.TaxidCache(taxid_cache.wcvp_release('wcvp_v5_jun_2021.txt'), wcvp_opts)
+# new_taxids = cache.missing(rec_df.TaxID)
+# ... resolve the names of new TaxIDs with wcvp_taxo.py, then:
+# cache.add(rec_df[['TaxID','sci_name']], wcvp_output); cache.save()
+# rec_df = pd.merge(rec_df, cache.lookup(rec_df.TaxID), how='inner', on='TaxID')
+#
+# python taxid_cache.py stats --release wcvp_v5_jun_2021 --options='-g -s similarity_genus -d divert_genusOK'
+
+# In[1]:
+
+
+import pandas as pd
+import os
+import fcntl
+import argparse
+
+
+# ## Parameters
+
+# In[2]:
+
+
+cache_dir = os.environ.get('TAXID_CACHE', 'TaxID_WCVP')
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Release of a WCVP file (e.g. wcvp_v5_jun_2021 for wcvp_v5_jun_2021.txt or .pkl)
+def wcvp_release(wcvp_path):
+    return os.path.basename(wcvp_path).split('.')[0]
+
+
+# Cache name of a release and wcvp_taxo.py options (e.g. wcvp_v5_jun_2021_g_s_similarity_genus_d_divert_genusOK)
+def cache_name(release, options=''):
+    return '_'.join([release] + [iopt.lstrip('-') for iopt in options.split()])
+
+
+class TaxidCache:
+    def __init__(self, release, options='', cache_dir=cache_dir):
+        self.release = release
+        self.options = options
+        self.path = os.path.join(cache_dir, cache_name(release, options) + '.csv')
+        self.table = self.read()
+        self.added = self.table.iloc[:0]
+
+    def read(self):
+        if os.path.isfile(self.path):
+            return pd.read_csv(self.path, dtype={'TaxID': str})
+        return pd.DataFrame(columns=['TaxID','Ini_sci_name','sci_name'])
+
+    # TaxIDs not in the cache, once each
+    def missing(self, taxids):
+        taxids = pd.Series(taxids).dropna().astype(str).unique()
+        cached = set(self.table.TaxID)
+        return [itaxid for itaxid in taxids if itaxid not in cached]
+
+    # Resolutions of new TaxIDs, from their names (TaxID, sci_name) and the wcvp_taxo.py output matching
+    # Ini_sci_name; TaxIDs without output row are kept as unresolved
+    def add(self, taxid_names, resolved):
+        rows = taxid_names[['TaxID','sci_name']].astype({'TaxID': str}).drop_duplicates('TaxID')\
+            .rename(columns={'sci_name':'Ini_sci_name'})
+        rows = pd.merge(rows, resolved.drop_duplicates('Ini_sci_name'), how='left', on='Ini_sci_name')
+        self.table = pd.concat([self.table[~self.table.TaxID.isin(rows.TaxID)], rows], ignore_index=True)
+        self.added = pd.concat([self.added[~self.added.TaxID.isin(rows.TaxID)], rows], ignore_index=True)
+        return rows
+
+    # WCVP columns of resolved TaxIDs, without the name they were resolved from
+    def lookup(self, taxids):
+        taxids = set(pd.Series(taxids).dropna().astype(str))
+        rows = self.table[self.table.TaxID.isin(taxids) & self.table.sci_name.notnull()]
+        return rows.drop(columns=['Ini_sci_name']).reset_index(drop=True)
+
+    # Rows added since loading are merged with the cache on disk, which other jobs may have updated, under a lock
+    def save(self):
+        if self.added.shape[0] == 0:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.lock', 'a') as flock:
+            fcntl.flock(flock, fcntl.LOCK_EX)
+            table = self.read()
+            table = pd.concat([table[~table.TaxID.isin(self.added.TaxID)], self.added], ignore_index=True)
+            table.to_csv(self.path + '.tmp.' + str(os.getpid()), index=False)
+            os.replace(self.path + '.tmp.' + str(os.getpid()), self.path)
+            fcntl.flock(flock, fcntl.LOCK_UN)
+        self.table = table
+        self.added = table.iloc[:0]
+
+
+# ## Main
+
+# In[4]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='TaxID to WCVP cache, by WCVP release')
+    parser.add_argument("action", type=str, help="stats: number of TaxIDs cached and resolved")
+    parser.add_argument("--release", type=str, help="WCVP release (e.g. wcvp_v5_jun_2021) or WCVP file")
+    parser.add_argument("--options", type=str, default='', help="wcvp_taxo.py options of the cache")
+    parser.add_argument("--cache_dir", type=str, default=cache_dir)
+    args = parser.parse_args()
+
+    if args.action == 'stats':
+        cache = TaxidCache(wcvp_release(args.release), args.options, args.cache_dir)
+        print(cache.path, ':', cache.table.shape[0], 'TaxIDs,', cache.table.sci_name.notnull().sum(), 'resolved,',
+              cache.table.sci_name.dropna().nunique(), 'WCVP names')
+    else:
+        print('unknown action', args.action)
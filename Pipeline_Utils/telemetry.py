@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # telemetry
+# Spans of pipeline stages (WCVP loading, GenBank parsing, card building, filesystem scans, ...), by sample and barcode:
+# wall time, cpu time, peak memory, rows in/out and bytes read/written, appended as one json line per span to a run log
+# (TELEMETRY_LOG, nothing is recorded if not set). Pipelines (Barcode_Validation.sh, GetOrg_Pipeline.sh) set it to
+# run_log.jsonl of each working directory. Bytes are counted by the caller, or from /proc/self/io.
+# Peak memory (proc_maxrss_mb) is the peak so far of the whole process and of its largest child, not of the span alone:
+# only the first span of a process, or a span of a command (run action), isolates a stage.
+# Profiling is opt-in: TELEMETRY_PROFILE=cprofile dumps the profile of each span to <run log>.profiles/,
+# TELEMETRY_PROFILE=tracemalloc records the peak of python allocations and the top allocating lines.
+# TELEMETRY_PROFILE_STAGES restricts profiling to some stages (comma separated).
+#
+# span = telemetry.start('card', sample=sample)
+# ...
+# span.end(rows_in=raw_blast.shape[0], rows_out=results_blast_df.shape[0])
+# with telemetry.span('wcvp_load') as s:
+#     wcvp = load_wcvp(wcvp_path); s.rows_out = wcvp.shape[0]
+#
+# python telemetry.py summary run_log.jsonl PAFTOL/run_log.jsonl
+# python telemetry.py run --stage blast --sample PAFTOL_000001 --barcode NCBI_18s -- blastn -query ...
+
+# In[1]:
+
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import argparse
+import pandas as pd
+
+
+# ## Parameters
+
+# In[2]:
+
+
+run_log=os.environ.get('TELEMETRY_LOG', '')
+profile_mode=os.environ.get('TELEMETRY_PROFILE', '')
+profile_stages=[istage for istage in os.environ.get('TELEMETRY_PROFILE_STAGES', '').split(',') if istage != '']
+# Run id set by the launching script (TELEMETRY_RUN), otherwise one per slurm job or per process
+run_id=os.environ.get('TELEMETRY_RUN', os.environ.get('SLURM_ARRAY_JOB_ID', os.environ.get('SLURM_JOB_ID',
+                      time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid()))))
+top_allocs=10
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Bytes read and written by the process (rchar, wchar), None if /proc is not available
+def read_io():
+    try:
+        with open('/proc/self/io') as fin:
+            io = dict([iline.split(': ') for iline in fin.read().splitlines()])
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def cpu_time():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+# Peak memory so far of the process and of its waited children, in MB
+def peak_rss():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def write_record(record, log_path=None):
+    log_path = run_log if log_path is None else log_path
+    if log_path in ['', 'none']:
+        return
+    # a single write per line, so that array tasks can append to the same log
+    with open(log_path, 'a') as fout:
+        fout.write(json.dumps(record, default=str) + '\n')
+
+
+# In[4]:
+
+
+class Span:
+    active_profile = False
+
+    def __init__(self, stage, sample=None, barcode=None, log_path=None, **fields):
+        self.stage = stage; self.sample = sample; self.barcode = barcode; self.log_path = log_path
+        self.fields = fields
+        self.rows_in = None; self.rows_out = None; self.bytes_read = None; self.bytes_written = None
+        self.profiler = None
+
+    def start(self):
+        self.start_time = time.time(); self.start_perf = time.perf_counter(); self.start_cpu = cpu_time()
+        self.start_io = read_io()
+        if profile_mode != '' and not Span.active_profile and (len(profile_stages) == 0 or self.stage in profile_stages):
+            Span.active_profile = True
+            if profile_mode == 'cprofile':
+                import cProfile
+                self.profiler = cProfile.Profile(); self.profiler.enable()
+            elif profile_mode == 'tracemalloc':
+                import tracemalloc
+                tracemalloc.start(); self.profiler = tracemalloc
+        return self
+
+    def stop_profile(self, record):
+        if self.profiler is None:
+            return
+        if profile_mode == 'cprofile':
+            self.profiler.disable()
+            prof_dir = (self.log_path or run_log) + '.profiles'
+            os.makedirs(prof_dir, exist_ok=True)
+            prof_file = os.path.join(prof_dir, '_'.join([str(ifield) for ifield in
+                                                         [run_id, self.stage, self.sample, self.barcode, os.getpid()]
+                                                         if ifield is not None]) + '.prof')
+            self.profiler.dump_stats(prof_file)
+            record['profile'] = prof_file
+        elif profile_mode == 'tracemalloc':
+            record['py_peak_mb'] = round(self.profiler.get_traced_memory()[1] / 1024**2, 1)
+            stats = self.profiler.take_snapshot().statistics('lineno')[:top_allocs]
+            record['top_allocs'] = [str(istat.traceback[0]) + ' ' + str(round(istat.size / 1024**2, 1)) + 'MB'
+                                    for istat in stats]
+            self.profiler.stop()
+        self.profiler = None
+        Span.active_profile = False
+
+    def end(self, status='ok', rows_in=None, rows_out=None, bytes_read=None, bytes_written=None, **fields):
+        wall = time.perf_counter() - self.start_perf
+        io = read_io()
+        record = {'run': run_id, 'host': socket.gethostname(), 'pid': os.getpid(), 'stage': self.stage,
+                  'sample': self.sample, 'barcode': self.barcode, 'status': status, 'start': round(self.start_time, 3),
+                  'wall_s': round(wall, 4), 'cpu_s': round(cpu_time() - self.start_cpu, 4),
+                  'proc_maxrss_mb': round(peak_rss(), 1),
+                  'rows_in': rows_in if rows_in is not None else self.rows_in,
+                  'rows_out': rows_out if rows_out is not None else self.rows_out}
+        io_delta = [io[i] - self.start_io[i] for i in range(2)] if io is not None and self.start_io is not None else [None, None]
+        bytes_read = bytes_read if bytes_read is not None else self.bytes_read
+        bytes_written = bytes_written if bytes_written is not None else self.bytes_written
+        record['bytes_read'] = bytes_read if bytes_read is not None else io_delta[0]
+        record['bytes_written'] = bytes_written if bytes_written is not None else io_delta[1]
+        record.update(self.fields); record.update(fields)
+        self.stop_profile(record)
+        write_record(record, self.log_path)
+        return record
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end(status='ok' if exc_type is None else 'error:' + exc_type.__name__)
+        return False
+
+
+def start(stage, sample=None, barcode=None, **fields):
+    return Span(stage, sample, barcode, **fields).start()
+
+
+def span(stage, sample=None, barcode=None, **fields):
+    return Span(stage, sample, barcode, **fields)
+
+
+# In[5]:
+
+
+# Spans of run logs, lines that cannot be decoded (e.g. truncated by a killed task) are skipped and counted
+def read_logs(log_files):
+    records=[]
+    Nbad = 0
+    for log_file in log_files:
+        with open(log_file) as fin:
+            for iline in fin:
+                if iline.strip() == '':
+                    continue
+                try:
+                    records.append(json.loads(iline))
+                except ValueError:
+                    Nbad += 1
+    if Nbad > 0:
+        print('WARNING:', Nbad, 'undecodable lines skipped')
+    spans = pd.DataFrame(records)
+    # peak memory of logs written before proc_maxrss_mb
+    if 'maxrss_mb' in spans.columns:
+        spans['proc_maxrss_mb'] = spans['proc_maxrss_mb'].fillna(spans.maxrss_mb) if 'proc_maxrss_mb' in spans.columns \
+            else spans.maxrss_mb
+    return spans
+
+
+# Run a command (e.g. blastn) in a span of its own, with the cpu time and peak memory of the command, its exit code
+def run_command(cmd, stage=None, sample=None, barcode=None, **fields):
+    import subprocess
+    stage = os.path.basename(cmd[0]) if stage is None else stage
+    cmd_span = start(stage, sample=sample, barcode=barcode, command=os.path.basename(cmd[0]), **fields)
+    exit_code = subprocess.call(cmd)
+    cmd_span.end(status='ok' if exit_code == 0 else 'error:exit_' + str(exit_code), exit_code=exit_code)
+    return exit_code
+
+
+# Throughput of each stage: spans, wall and cpu time, peak memory, rows and bytes per second
+def summarize(spans, by=['stage']):
+    for icol in ['rows_in','rows_out','bytes_read','bytes_written']:
+        if icol not in spans.columns:
+            spans[icol] = None
+        spans[icol] = pd.to_numeric(spans[icol], errors='coerce')
+    spans['errors'] = spans.status != 'ok'
+    summary = spans.groupby(by).agg(spans=('wall_s','size'), errors=('errors','sum'), samples=('sample','nunique'),
+                                    wall_s=('wall_s','sum'), mean_wall_s=('wall_s','mean'),
+                                    p95_wall_s=('wall_s', lambda x: x.quantile(0.95)), cpu_s=('cpu_s','sum'),
+                                    proc_maxrss_mb=('proc_maxrss_mb','max'), rows_in=('rows_in','sum'), rows_out=('rows_out','sum'),
+                                    read_mb=('bytes_read', lambda x: x.sum() / 1024**2),
+                                    write_mb=('bytes_written', lambda x: x.sum() / 1024**2))
+    summary['cpu_per_wall'] = summary.cpu_s / summary.wall_s
+    summary['rows_per_s'] = summary[['rows_in','rows_out']].max(axis=1) / summary.wall_s
+    summary['mb_per_s'] = (summary.read_mb + summary.write_mb) / summary.wall_s
+    return summary.sort_values('wall_s', ascending=False).round(3)
+
+
+# ## Main
+
+# In[6]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-stage throughput report of pipeline run logs')
+    parser.add_argument("action", type=str, help="summary: throughput of each stage, run: run a command in a span")
+    parser.add_argument("inputs", nargs='+', help="summary: run logs (jsonl), run: command, after --")
+    parser.add_argument("--stage", type=str, default=None, help="run: stage of the span")
+    parser.add_argument("--sample", type=str, default=None, help="run: sample of the span")
+    parser.add_argument("--barcode", type=str, default=None, help="run: barcode of the span")
+    parser.add_argument("--by", nargs='*', default=['stage'], help="grouping columns, e.g. stage barcode, or run stage")
+    parser.add_argument("--out", type=str, default=None, help="write the report as csv")
+    args = parser.parse_args()
+
+    if args.action == 'summary':
+        spans = read_logs(args.inputs)
+        print(spans.shape[0], 'spans from', spans.run.nunique(), 'runs')
+        summary = summarize(spans, args.by)
+        with pd.option_context('display.max_columns', None, 'display.width', 200):
+            print(summary)
+        if args.out is not None:
+            summary.to_csv(args.out)
+    elif args.action == 'run':
+        sys.exit(run_command(args.inputs, args.stage, args.sample, args.barcode))
+    else:
+        print('unknown action', args.action)
+        sys.exit(1)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # wcvp_client
+# Client of the WCVP lookup service (wcvp_server.py). Takes the same sample file and options as wcvp_taxo.py, without
+# the WCVP path, and writes the same output tables (sample_file_wcvp.csv, _duplicates.csv, _unresolved.csv).
+# In python, resolve() returns the output tables as DataFrames.
+#
+# ```console
+# python wcvp_client.py sample_file.csv -g -s similarity_genus -d divert_taxonOK
+# python wcvp_client.py sample_file.csv -oc --socket /tmp/wcvp_taxo.sock
+# ```
+# ```python
+# import wcvp_client
+# tables = wcvp_client.resolve(smpl_df, resolve_genus=True, find_most_similar='similarity_genus')
+# ```
+
+# In[1]:
+
+
+import pandas as pd
+import os
+import io
+import sys
+import json
+import socket
+import argparse
+
+
+# ## Parameters
+
+# In[2]:
+
+
+socket_path = os.environ.get('WCVP_SOCKET', '/tmp/wcvp_taxo.sock')
+timeout = 3600    # seconds to wait for a response
+
+
+# ## Functions
+
+# In[3]:
+
+
+# Send one request to the service and return its response
+def request(message, path=socket_path, timeout=timeout):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(message).encode() + b'\n')
+        chunks=[]
+        while True:
+            chunk = sock.recv(1 << 20)
+            if chunk == b'':
+                break
+            chunks.append(chunk)
+            if chunk.endswith(b'\n'):
+                break
+    response = json.loads(b''.join(chunks))
+    if response['status'] != 'ok':
+        raise RuntimeError('WCVP lookup service: ' + response['error'])
+    return response
+
+
+def is_running(path=socket_path):
+    try:
+        return request({'action': 'ping'}, path, timeout=5)['status'] == 'ok'
+    except (OSError, ValueError):
+        return False
+
+
+# Output tables of a sample file (csv text) as csv text by suffix, with the options of wcvp_taxo.resolve_names
+def resolve_csv(csv_text, path=socket_path, **options):
+    return request({'action': 'resolve', 'csv': csv_text, 'options': options}, path)['tables']
+
+
+# Output tables of a sample table as DataFrames by suffix (wcvp or wcvp_changes, duplicates, unresolved)
+def resolve(smpl_df, path=socket_path, **options):
+    tables = resolve_csv(smpl_df.to_csv(index=False), path, **options)
+    return {isuffix: pd.read_csv(io.StringIO(itable)) for isuffix, itable in tables.items()}
+
+
+# ## Main
+
+# In[4]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Match species names with wcvp using the WCVP lookup service (wcvp_server.py), '
+                    'with the options of wcvp_taxo.py')
+    parser.add_argument("df_path", type=str, nargs='?', default=None,
+                        help="path to spreadsheet in .csv format. Note output will be in the same folder")
+    parser.add_argument("-g", "--resolve_genus", action="store_true", default=False,
+                        help="Optional. find taxa for scientific names written in genus sp. format")
+    parser.add_argument("-s", '--similar_tax_method', action="store", default=None,
+                        help="Optional. similarity_genus, similarity, request_kew")
+    parser.add_argument("-d", '--duplicate_action', action="store", default='rank',
+                        help="Optional. rank, divert, divert_taxonOK, divert_speciesOK, divert_genusOK")
+    parser.add_argument("-oc", "--only_changes", action="store_true", default=False,
+                        help="Optional. Output file only contains IDs that have a different taxonomy than provided")
+    parser.add_argument("-os", "--simple_output", action="store_true", default=False,
+                        help="Optional. Output only ID, kew-id, Ini_sci_name and sci_name")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False,
+                        help="Optional. verbose output in the service console")
+    parser.add_argument("--socket", type=str, default=socket_path, help="Unix socket of the service")
+    parser.add_argument("--stats", action="store_true", default=False, help="print statistics of the service")
+    args = parser.parse_args()
+
+    if args.stats:
+        print(request({'action': 'stats'}, args.socket))
+        sys.exit()
+    if not is_running(args.socket):
+        print('WCVP lookup service not running on', args.socket, ', start wcvp_server.py or use wcvp_taxo.py')
+        sys.exit(1)
+    with open(args.df_path, encoding='utf-8') as fin:
+        csv_text = fin.read()
+    tables = resolve_csv(csv_text, args.socket, resolve_genus=args.resolve_genus,
+                         find_most_similar=args.similar_tax_method, dupl_action=args.duplicate_action,
+                         only_changes=args.only_changes, simple_output=args.simple_output, verbose=args.verbose)
+    for isuffix, itable in tables.items():
+        with open(args.df_path.replace('.csv','_' + isuffix + '.csv'), 'w', encoding='utf-8') as fout:
+            fout.write(itable)
+        print(itable.count('\n') - 1, 'rows written to', args.df_path.replace('.csv','_' + isuffix + '.csv'))
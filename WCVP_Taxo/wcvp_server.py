@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+##################################
+# Author: Kevin Leempoel
+
+# Copyright © 2020 The Board of Trustees of the Royal Botanic Gardens, Kew
+##################################
+
+# # wcvp_server
+# Long-running WCVP lookup service: loads WCVP once (wcvp_taxo.load_wcvp) with the taxon names of each genus used by
+# the similarity searches, and resolves sample tables sent by concurrent jobs over a Unix socket, so that jobs of a
+# node share one WCVP in memory instead of loading it each.
+# Requests and responses are one line of json each. A resolve request holds the csv text of a sample file and the
+# options of wcvp_taxo.py; the response holds the csv text of its output tables by suffix (wcvp or wcvp_changes,
+# duplicates, unresolved), the same as wcvp_taxo.py would write. Requests run in a thread pool, WCVP is only read.
+# Use wcvp_client.py to send requests.
+#
+# ```console
+# python wcvp_server.py wcvp_export.txt --socket /tmp/wcvp_taxo.sock &
+# python wcvp_client.py sample_file.csv -g -s similarity_genus -d divert_taxonOK --socket /tmp/wcvp_taxo.sock
+# python wcvp_client.py --stats
+# ```
+
+# In[1]:
+
+
+import pandas as pd
+import os
+import io
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import wcvp_taxo
+
+
+# ## Parameters
+
+# In[2]:
+
+
+socket_path = os.environ.get('WCVP_SOCKET', '/tmp/wcvp_taxo.sock')
+n_threads = 4
+max_message = 2**30    # bytes of a request line
+# Options of wcvp_taxo.py accepted in requests, and their defaults
+resolve_options = {'resolve_genus': False, 'find_most_similar': None, 'dupl_action': 'rank', 'only_changes': False,
+                   'simple_output': False, 'verbose': False}
+
+
+# ## Functions
+
+# In[3]:
+
+
+class WCVPService:
+    def __init__(self, wcvp_path):
+        self.wcvp = wcvp_taxo.load_wcvp(wcvp_path)
+        print('Indexing taxon names for similarity searches...')
+        self.sim_index = wcvp_taxo.build_sim_index(self.wcvp)
+        self.start_time = time.time()
+        self.stats = {'requests': 0, 'errors': 0, 'names': 0}
+
+    # Output tables of a sample file (csv text) as csv text, by suffix
+    def resolve(self, csv_text, options):
+        options = dict(resolve_options, **{ikey: ivalue for ikey, ivalue in options.items() if ikey in resolve_options})
+        smpl_df = pd.read_csv(io.StringIO(csv_text))
+        tables = wcvp_taxo.resolve_names(smpl_df, self.wcvp, sim_index=self.sim_index, **options)
+        self.stats['names'] += smpl_df.shape[0]
+        return {isuffix: itable.to_csv(index=False) for isuffix, itable in tables.items()}
+
+    def handle(self, request):
+        action = request.get('action', 'resolve')
+        if action == 'ping':
+            return {'status': 'ok'}
+        if action == 'stats':
+            return dict(status='ok', entries=self.wcvp.shape[0], uptime=round(time.time() - self.start_time),
+                        **self.stats)
+        if action == 'resolve':
+            self.stats['requests'] += 1
+            return {'status': 'ok', 'tables': self.resolve(request['csv'], request.get('options', {}))}
+        return {'status': 'error', 'error': 'unknown action ' + str(action)}
+
+
+# In[4]:
+
+
+# One json request per line, answered in the order received; errors are returned, the service keeps running
+async def serve_client(service, executor, reader, writer):
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            line = await reader.readline()
+            if line == b'':
+                break
+            try:
+                response = await loop.run_in_executor(executor, service.handle, json.loads(line))
+            except (Exception, SystemExit) as e:
+                service.stats['errors'] += 1
+                response = {'status': 'error', 'error': repr(e)}
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+        print('client disconnected:', repr(e))
+    finally:
+        writer.close()
+
+
+# True if a service answers on the socket, a socket left by a stopped service refuses connections
+def server_running(path=socket_path):
+    if not os.path.exists(path):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+            return True
+        except OSError:
+            return False
+
+
+async def serve(service, path=socket_path, n_threads=n_threads):
+    if server_running(path):
+        raise RuntimeError('a WCVP lookup service is already listening on ' + path)
+    if os.path.exists(path):
+        os.remove(path)
+    executor = ThreadPoolExecutor(max_workers=n_threads)
+    server = await asyncio.start_unix_server(lambda reader, writer: serve_client(service, executor, reader, writer),
+                                             path=path, limit=max_message)
+    print('WCVP lookup service listening on', path)
+    try:
+        await server.serve_forever()
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# ## Main
+
+# In[5]:
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='WCVP lookup service, resolving scientific names for wcvp_client.py')
+    parser.add_argument("wcvp_path", type=str, help="path to wcvp_export.txt (or its .pkl next to it)")
+    parser.add_argument("--socket", type=str, default=socket_path, help="Unix socket of the service")
+    parser.add_argument("--threads", type=int, default=n_threads, help="requests resolved at once")
+    args = parser.parse_args()
+
+    # checked before loading WCVP, the socket of a running service is not replaced
+    if server_running(args.socket):
+        print('a WCVP lookup service is already listening on', args.socket, ', use it or stop it first')
+        sys.exit(1)
+    service = WCVPService(args.wcvp_path)
+    try:
+        asyncio.run(serve(service, args.socket, args.threads))
+    except KeyboardInterrupt:
+        print('stopped, served', service.stats)
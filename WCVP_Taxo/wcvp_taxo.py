@@ -51,10 +51,14 @@
 # * **sample_file_duplicates.csv**: Samples for which the scientific name matched multiple WCVP entries.
 # * **sample_file_unresolved.csv**: Samples for which the scientific name did not match any WCVP entries.
 # 
+# ## Lookup service
+# wcvp_server.py keeps WCVP loaded for concurrent jobs, and wcvp_client.py sends sample files with the same options.
+# resolve_names(smpl_df, wcvp, **options) returns the output tables by suffix, without writing them.
 # 
 # ## Pipeline
 # ### Pre-processing
 # * Load wcvp database. If only text file exist, saving as .pkl.
+# * WCVP is kept compact in memory: categorical taxonomic status, rank, family and genus, kew ids interned as integer codes for merges, and arrow strings for names if pyarrow is installed. All WCVP columns except the parent columns are kept and written to the outputs, as before. A .pkl saved by a previous version is compacted and saved again, or loaded again from the .txt if its columns were reduced.
 # * Find column containing scientific names. scientific_name or sci_name (default), Species or Genus + Species otherwise.
 # * Search for column with unique IDs. First column in table will be selected. Creates column with unique IDs if it doesn't exist. Will not pick sci_name or Species as ID.
 # 
@@ -74,6 +78,7 @@
 # ## Dependencies
 # pandas, tqdm<br>
 # for similarity: difflib, requests, ast<br>
+# optional: pyarrow<br>
 # numpy, os, argparse, sys
 
 # In[1]:
@@ -86,6 +91,15 @@ pd.options.mode.chained_assignment = None  # default='warn'
 import os
 import argparse
 import sys
+import difflib
+import ast
+import importlib.util
+# Optional stage timings (Pipeline_Utils/telemetry.py), when run within the PAFTOL repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pipeline_Utils'))
+try:
+    import telemetry
+except ImportError:
+    telemetry = None
 
 
 # ## Parameters
@@ -128,18 +142,23 @@ parser.add_argument("-os", "--simple_output",
 parser.add_argument("-v", "--verbose", 
                     help="Optional. verbose output in console", 
                     action="store_true", default=False)
-args = parser.parse_args()
 
-wcvp_path = args.wcvp_path
-df_path = args.df_path
-resolve_genus=args.resolve_genus
-find_most_similar=args.similar_tax_method
-dupl_action=args.duplicate_action
-only_changes=args.only_changes
-simple_output=args.simple_output
-verbose=args.verbose
+# Defaults when imported (e.g. by wcvp_server.py), replaced by the arguments when run as a script
+wcvp_path = None
+df_path = None
+resolve_genus=False
+find_most_similar=None
+dupl_action='rank'
+only_changes=False
+simple_output=False
+verbose=False
 
 status_keep=['Accepted','Unplaced']
+# WCVP columns dropped when loading, all others are kept and written to the output
+wcvp_drop=['parent_kew_id','parent_name','parent_authors']
+pkl_format=2  # compacted .pkl with all columns (version 1 only kept the columns used for matching)
+wcvp_categories=['taxonomic_status','rank','taxon_rank','family','genus']
+wcvp_names=['kew_id','accepted_kew_id','species','infraspecies','taxon_name','authors','taxon_authors']
 
 
 # In[3]:
@@ -165,28 +184,89 @@ status_keep=['Accepted','Unplaced']
 # In[4]:
 
 
+# Stage spans, nothing is recorded without telemetry
+def start_span(stage):
+    if telemetry is None:
+        return None
+    return telemetry.start(stage, sample=os.path.basename(df_path) if df_path is not None else None)
+
+def end_span(span, **fields):
+    if span is not None:
+        span.end(**fields)
+
+
+# In[ ]:
+
+
+# Arrow strings if pyarrow is installed, python strings otherwise
+def names_dtype():
+    if importlib.util.find_spec('pyarrow') is None:
+        return object
+    try:
+        return pd.StringDtype('pyarrow')
+    except (ImportError, TypeError):
+        return object
+
+
+# Compact WCVP: categorical status, rank, family and genus, arrow strings for names, and kew ids interned as integer
+# codes (kew_code, accepted_kew_code, -1 if missing) for merges. Only the parent columns are dropped.
+def compact_wcvp(wcvp):
+    wcvp = wcvp.drop(columns=wcvp_drop, errors='ignore').copy()
+    codes, kew_ids = pd.factorize(pd.concat([wcvp.kew_id, wcvp.accepted_kew_id], ignore_index=True))
+    wcvp['kew_code'] = codes[:wcvp.shape[0]].astype(np.int32)
+    wcvp['accepted_kew_code'] = codes[wcvp.shape[0]:].astype(np.int32)
+    for icol in wcvp_categories:
+        if icol in wcvp.columns:
+            wcvp[icol] = wcvp[icol].astype('category')
+    for icol in wcvp_names:
+        if icol in wcvp.columns:
+            wcvp[icol] = wcvp[icol].astype(names_dtype())
+    wcvp = wcvp.reset_index(drop=True)
+    wcvp.attrs['pkl_format'] = pkl_format
+    return wcvp
+
+
+# Matched entries with plain columns, to be modified and merged with the samples
+def expand_wcvp(wcvp):
+    wcvp = wcvp.copy()
+    for icol in wcvp.columns:
+        if isinstance(wcvp[icol].dtype, (pd.CategoricalDtype, pd.StringDtype)):
+            wcvp[icol] = wcvp[icol].astype(object).where(wcvp[icol].notna(), np.nan)
+    return wcvp
+
+
 # Load wcvp file and save as pickle for faster loading
 def load_wcvp(wcvp_path):
     print('Loading WCVP...',end='')
+    wcvp = None
     # Load pickel
     if os.path.exists(wcvp_path.replace('.txt','.pkl')):
         print('found .pkl...',end='')
         wcvp = pd.read_pickle(wcvp_path.replace('.txt','.pkl'))
-    elif os.path.exists(wcvp_path):
+        # pickle saved by a previous version
+        if wcvp.attrs.get('pkl_format') != pkl_format:
+            if 'kew_code' not in wcvp.columns:
+                print('compacting...',end='')
+                wcvp = compact_wcvp(wcvp)
+                wcvp.to_pickle(wcvp_path.replace('.txt','.pkl'))
+            elif os.path.exists(wcvp_path):
+                # columns not used for matching were dropped, loaded again from the .txt
+                print('missing columns, ',end='')
+                wcvp = None
+            else:
+                print('WARNING: .pkl without the WCVP columns not used for matching, and no',wcvp_path,'...',end='')
+    if wcvp is None and os.path.exists(wcvp_path):
         wcvp = pd.read_table(wcvp_path,sep='|',encoding='utf-8')
         # Rename fields (new dump Nov. 2022)
         wcvp = wcvp.rename(columns = {'powo_id':'kew_id','taxon_status':'taxonomic_status', 'parenthetical_author':'parent_authors','accepted_powo_id':'accepted_kew_id','parent_powo_id':'parent_kew_id'})
-        wcvp['parent_name'] = 'parent_name_test'
-        wcvp['accepted_name'] = 'accepted_name_test'
-        wcvp['accepted_authors'] = 'accepted_authors_test'
         print(wcvp.columns)
 
         print('found .txt, ',end='')
         # Remove extra columns
-        wcvp = wcvp.drop(columns=['parent_kew_id','parent_name','parent_authors'])
+        wcvp = compact_wcvp(wcvp)
         print('saving to .pkl...',end='')
         wcvp.to_pickle(wcvp_path.replace('.txt','.pkl'))
-    else:
+    elif wcvp is None:
         print('could not find',wcvp_path)
         sys.exit()
     print(wcvp.shape[0],'entries')
@@ -267,7 +347,7 @@ def define_sci_name(smpl_df, verbose=False):
 
 
 def get_by_taxon_name(df, wcvp):
-    tmp_wcvp=wcvp[wcvp.taxon_name.isin(df.sci_name)]
+    tmp_wcvp=expand_wcvp(wcvp[wcvp.taxon_name.isin(df.sci_name)])
     match = pd.merge(df, tmp_wcvp, how='inner', left_on='sci_name', right_on='taxon_name')
     return match
 
@@ -275,31 +355,38 @@ def get_by_taxon_name(df, wcvp):
 # In[8]:
 
 
+# Merge on interned kew ids
 def get_by_kew_id(df, wcvp):
-    tmp_wcvp=wcvp[wcvp.kew_id.isin(df.kew_id)]
-    match = pd.merge(df, tmp_wcvp, how='inner', on='kew_id')
+    tmp_wcvp=expand_wcvp(wcvp[wcvp.kew_code.isin(df.kew_code)])
+    match = pd.merge(df, tmp_wcvp, how='inner', on='kew_code')
     return match
 
 
 # In[9]:
 
 
+# Taxon names of each genus and of all WCVP, built once for the similarity searches of many names
+def build_sim_index(wcvp):
+    names = wcvp.taxon_name.astype(str)
+    return {'genus': names.groupby(wcvp.genus.astype(object)).agg(list).to_dict(), 'all': list(names)}
+
+
 #Find closely matching scientific name using difflib.get_close_matches if scientific name was not found
-def find_sim(sci_name, wcvp, only_from_genus=True):
+def find_sim(sci_name, wcvp, only_from_genus=True, sim_index=None):
+    if sim_index is None:
+        sim_index = build_sim_index(wcvp)
     if sci_name==sci_name:
         # Search for similar sci_name with same genus
         smpl_genus=sci_name.split(' ')[0]
-        wcvp_gen=wcvp[wcvp.genus.isin([smpl_genus])]
-        if wcvp_gen.shape[0]>0:
-            sim_tax = difflib.get_close_matches(sci_name, 
-                                                wcvp_gen.taxon_name.astype(str), n=1, cutoff=.9)
+        genus_names=sim_index['genus'].get(smpl_genus, [])
+        if len(genus_names)>0:
+            sim_tax = difflib.get_close_matches(sci_name, genus_names, n=1, cutoff=.9)
             if len(sim_tax)>0:
                 return sim_tax[0]
          # If didn't work, search for similar sci_name
         else:
             if only_from_genus==False:
-                sim_tax = difflib.get_close_matches(sci_name, 
-                                            wcvp.taxon_name.astype(str), n=1, cutoff=.9)
+                sim_tax = difflib.get_close_matches(sci_name, sim_index['all'], n=1, cutoff=.9)
                 if len(sim_tax)>0:
                     return sim_tax[0]
                 else:
@@ -315,6 +402,7 @@ def find_sim(sci_name, wcvp, only_from_genus=True):
 
 #Find closely matching scientific name using kew namematching system
 def kew_namematch(sci_name, verbose=False):
+    import requests
     url = "http://namematch.science.kew.org/api/v2/powo/csv"
     payload = '{\"column\": 0,\"headers\": false,\"outputAllColumns\": true,\"currentChunk\": 0,\"data\": [[\"' +        sci_name + '\"]]}'
     headers = {
@@ -344,14 +432,16 @@ def kew_namematch(sci_name, verbose=False):
 
 
 #Find closely matching scientific name
-def get_sim(df, wcvp, find_most_similar, verbose=False):
+def get_sim(df, wcvp, find_most_similar, verbose=False, sim_index=None):
     print('\nLooking for most similar names')
+    if sim_index is None and find_most_similar in ['similarity_genus','similarity']:
+        sim_index = build_sim_index(wcvp)
     df['Similar_sci_name']=np.nan
     for idx, row in tqdm(df.iterrows(), total=df.shape[0]):
         if find_most_similar=='similarity_genus': 
-            df.loc[idx,'Similar_sci_name']=find_sim(row.sci_name, wcvp, only_from_genus=True)
+            df.loc[idx,'Similar_sci_name']=find_sim(row.sci_name, wcvp, only_from_genus=True, sim_index=sim_index)
         elif find_most_similar=='similarity': 
-            df.loc[idx,'Similar_sci_name']=find_sim(row.sci_name, wcvp, only_from_genus=False)
+            df.loc[idx,'Similar_sci_name']=find_sim(row.sci_name, wcvp, only_from_genus=False, sim_index=sim_index)
         elif find_most_similar=='kewmatch': 
             df.loc[idx,'Similar_sci_name']=kew_namematch(row.sci_name)
         if verbose:
@@ -379,7 +469,7 @@ def get_duplicates_type(df):
         if tmp_df.genus.nunique()==1:
             df.loc[tmp_df.index,'Duplicate_type']='Same_Genus'
         # Check if all entries have the same species
-        if len(set(return_dupl.genus + ' ' + return_dupl.species))==1:
+        if len(set(tmp_df.genus + ' ' + tmp_df.species))==1:
             df.loc[tmp_df.index,'Duplicate_type']='Same_Species'
         # Check if all entries have the same taxon name
         if tmp_df.taxon_name.nunique()==1:
@@ -388,28 +478,18 @@ def get_duplicates_type(df):
     return df
 
 
-# ## Main
+# ### Matching and resolving
 
 # In[13]:
 
 
-if __name__ == "__main__":
-    print('\n\n##### wcvp_taxo v0.5 ##### \nAuthor:   Kevin Leempoel \nLast update: 2021-03-25\n')
-    
-    print(wcvp_path, df_path, 'g:', resolve_genus, ' s:', find_most_similar, ' d:', dupl_action,
-      ' oc:', only_changes, ' os:', simple_output, ' v:', verbose)
-    
-    #Load libraries depending on the similarity method
-    if find_most_similar in ['similarity_genus','similarity']:
-        import difflib
-    if find_most_similar=='request_kew':
-        import requests
-        import ast
-        
-    ## Loading and preparing data
-    print('\n\nLoading and preparing data')
-    wcvp = load_wcvp(wcvp_path)
-    smpl_df = load_df(df_path)
+# Match and resolve the scientific names of a sample table with the options of the command line.
+# Returns the output tables by suffix: wcvp (or wcvp_changes with only_changes), duplicates and unresolved if any
+def resolve_names(smpl_df, wcvp, resolve_genus=resolve_genus, find_most_similar=find_most_similar,
+                  dupl_action=dupl_action, only_changes=only_changes, simple_output=simple_output, verbose=verbose,
+                  sim_index=None):
+    tables={}
+    span = start_span('wcvp_prepare')
     # Find scientific names
     smpl_df = define_sci_name(smpl_df)
     # Select or make ID column
@@ -434,10 +514,14 @@ if __name__ == "__main__":
     # Check if Ini_scinames exist in WCVP
     smpl_df['InWCVP']=smpl_df.sci_name.isin(wcvp.taxon_name)
     print('Missing taxa:',(smpl_df.InWCVP==False).sum(),'IDs not in WCVP')
+    end_span(span, rows_out=smpl_df.shape[0])
     
     # Optional. Find similar names if not in WCVP
     if find_most_similar in ['similarity_genus','similarity','request_kew']:
-        resolved_sim = get_sim(smpl_df[smpl_df.InWCVP==False],wcvp=wcvp,find_most_similar=find_most_similar,verbose=verbose)
+        span = start_span('wcvp_similarity')
+        resolved_sim = get_sim(smpl_df[smpl_df.InWCVP==False],wcvp=wcvp,find_most_similar=find_most_similar,verbose=verbose,
+                               sim_index=sim_index)
+        end_span(span, rows_in=(smpl_df.InWCVP==False).sum(), rows_out=resolved_sim.shape[0], method=find_most_similar)
         smpl_df = pd.concat([smpl_df[~smpl_df.ID.isin(resolved_sim.ID)], resolved_sim])
         print('find_most_similar: found',smpl_df.Similar_match.sum(),'IDs by similarity')
         
@@ -457,26 +541,31 @@ if __name__ == "__main__":
     ## get WCVP taxons
     # Recover accepted and unplaced taxa
     print('\n\nMatching & Resolving')
+    span = start_span('wcvp_match')
     match = get_by_taxon_name(smpl_dfs[(smpl_dfs.Duplicates==False)], wcvp)
     return_df = match[match.taxonomic_status.isin(status_keep)]
     print('After direct matching: found match for',return_df.shape[0],'IDs')
     
     # Resolving synonyms
-    synonyms = match[match.taxonomic_status.isin(['Synonym','Homotypic_Synonym'])]                .rename(columns={'kew_id':'Ini_kew_id','accepted_kew_id':'kew_id','taxonomic_status':'Ini_taxonomic_status'})
+    synonyms = match[match.taxonomic_status.isin(['Synonym','Homotypic_Synonym'])]                .rename(columns={'kew_id':'Ini_kew_id','accepted_kew_id':'kew_id','taxonomic_status':'Ini_taxonomic_status',
+                                 'kew_code':'Ini_kew_code','accepted_kew_code':'kew_code'})
     cols_syn=list(smpl_dfs.columns) + ['Ini_kew_id','Ini_taxonomic_status']
-    return_syn = get_by_kew_id(df = synonyms[cols_syn + ['kew_id']], wcvp = wcvp)
+    return_syn = get_by_kew_id(df = synonyms[cols_syn + ['kew_code']], wcvp = wcvp)
     return_df=pd.concat([return_df,return_syn]).reset_index().drop(columns='index')
     print('After resolving synonyms: found match for',return_df.shape[0],'IDs')
     
     
     
+    end_span(span, rows_in=(smpl_dfs.Duplicates==False).sum(), rows_out=return_df.shape[0])
     ## Resolving duplicates
+    span = start_span('wcvp_duplicates')
     match=get_by_taxon_name(smpl_dfs[(smpl_dfs.Duplicates==True)],wcvp)
     return_dupl = match[match.taxonomic_status.isin(status_keep)]
     
     # Resolving synonyms in duplicates
-    synonyms = match[match.taxonomic_status.isin(['Synonym','Homotypic_Synonym'])]                .rename(columns={'kew_id':'Ini_kew_id','accepted_kew_id':'kew_id','taxonomic_status':'Ini_taxonomic_status'})
-    return_syn = get_by_kew_id(df = synonyms[cols_syn + ['kew_id']], wcvp = wcvp)
+    synonyms = match[match.taxonomic_status.isin(['Synonym','Homotypic_Synonym'])]                .rename(columns={'kew_id':'Ini_kew_id','accepted_kew_id':'kew_id','taxonomic_status':'Ini_taxonomic_status',
+                                 'kew_code':'Ini_kew_code','accepted_kew_code':'kew_code'})
+    return_syn = get_by_kew_id(df = synonyms[cols_syn + ['kew_code']], wcvp = wcvp)
     return_dupl=pd.concat([return_dupl,return_syn]).reset_index().drop(columns='index')
     
     # Action on duplicates
@@ -513,12 +602,15 @@ if __name__ == "__main__":
             dupl_df2 = pd.merge(smpl_df.drop(columns=['InWCVP']),
                                 dupl_df.drop(columns=['Duplicates','sci_name']),how='inner',on='ID')
             dupl_df2 = dupl_df2.sort_values('ID').reset_index().drop(columns=['index','accepted_kew_id',
-                     'accepted_name','accepted_authors','reviewed']).rename(columns={'sci_name':'sci_name_query'})
-            dupl_df2.to_csv(df_path.replace('.csv','_duplicates.csv'),index=False,encoding='utf-8')
+                     'accepted_name','accepted_authors','reviewed','kew_code','accepted_kew_code','Ini_kew_code'],
+                     errors='ignore').rename(columns={'sci_name':'sci_name_query'})
+            tables['duplicates']=dupl_df2
     print('After resolving duplicates: found match for',return_df.shape[0],'IDs')
+    end_span(span, rows_in=(smpl_dfs.Duplicates==True).sum(), rows_out=dupl_df.shape[0], action=dupl_action)
     
     
     ## Cleaning and merging DF
+    span = start_span('wcvp_output')
     smpl_df = pd.merge(smpl_df.drop(columns=['InWCVP']),return_df.drop(columns=['Duplicates','sci_name']),how='left',on='ID')
     # Filter duplicates and unresolved taxa
     print('After filtering of duplicates',dupl_action,': kept',smpl_df.shape[0])
@@ -528,7 +620,7 @@ if __name__ == "__main__":
     if find_most_similar in ['similarity_genus','similarity','request_kew']:
         unresolved = smpl_df[smpl_df.Similar_match==False]
         print(unresolved.shape[0],'Samples are unresolved, no similar match in WCVP')
-        unresolved.to_csv(df_path.replace('.csv','_unresolved.csv'),index=False,encoding='utf-8')
+        tables['unresolved']=unresolved
         smpl_df = smpl_df[~smpl_df.ID.isin(unresolved.ID)]
         print('After discarding unresolved: kept',smpl_df.shape[0],'IDs')
     # Modify taxonomy for genus sp.
@@ -539,17 +631,20 @@ if __name__ == "__main__":
     smpl_df.loc[mod_gensp,'taxon_name']=smpl_df.loc[mod_gensp,'genus'] + ' sp.'
     smpl_df.loc[mod_gensp,'species']=np.nan
     #Sort table by ID
-    out_df = smpl_df.sort_values('ID').reset_index()                .drop(columns=['index','Genus_sp','accepted_kew_id','accepted_name','accepted_authors','reviewed'])                .rename(columns={'sci_name':'sci_name_query','taxon_name':'sci_name'})
+    out_df = smpl_df.sort_values('ID').reset_index()                .drop(columns=['index','Genus_sp','accepted_kew_id','accepted_name','accepted_authors','reviewed',
+                               'kew_code','accepted_kew_code','Ini_kew_code'], errors='ignore')                .rename(columns={'sci_name':'sci_name_query','taxon_name':'sci_name'})
     
     
     
     ## Output options
     # Simple output
     def output_fn(out_df,simple_output,colID):
+        if simple_output==True:
+            simple_output=[]
         if simple_output==False:
             out_df = out_df.drop(columns='ID')
         elif sum([icol in out_df.columns for icol in simple_output])==len(simple_output):
-            simple_output.extend([colID,'kew_id','Ini_sci_name','sci_name','Duplicate_type'])
+            simple_output = list(simple_output) + [colID,'kew_id','Ini_sci_name','sci_name','Duplicate_type']
             out_df = out_df[simple_output]
         else:
             print('error in simple_output',simple_output,', returning full dataframe')
@@ -558,7 +653,7 @@ if __name__ == "__main__":
     # Output All
     if only_changes==False:
         out_df=output_fn(out_df=out_df,simple_output=simple_output,colID=colID)
-        out_df.to_csv(df_path.replace('.csv','_wcvp.csv'),index=False,encoding='utf-8')
+        tables['wcvp']=out_df
     # Output changes only    
     elif only_changes:
         out_df['Same_sci_name']=(out_df.Ini_sci_name==out_df.sci_name)
@@ -566,7 +661,8 @@ if __name__ == "__main__":
             out_df['Same_family']=(out_df.Ini_Family==out_df.family)
             print('Family match:',out_df.groupby('Same_family').size().to_dict())
             out_df = out_df[(out_df.Same_family==False) | (out_df.Same_sci_name==False)]                    .drop(columns=['Same_sci_name'])
-            simple_output.extend(['Same_family','Ini_Family','family'])
+            if simple_output!=False:
+                simple_output = list(simple_output) + ['Same_family','Ini_Family','family']
         else:
             out_df = out_df[(out_df.Same_sci_name==False)].drop(columns='Same_sci_name')
             
@@ -574,7 +670,42 @@ if __name__ == "__main__":
 
         out_df = out_df[(out_df.kew_id.notnull())]
         print('Only_changes:',out_df.shape[0],'IDs have changed taxonomy')
-        out_df.to_csv(df_path.replace('.csv','_wcvp_changes.csv'),index=False,encoding='utf-8')
+        tables['wcvp_changes']=out_df
+    end_span(span, rows_in=smpl_df.shape[0], rows_out=out_df.shape[0])
+    return tables
+
+
+# ## Main
+
+# In[14]:
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    wcvp_path = args.wcvp_path
+    df_path = args.df_path
+    resolve_genus=args.resolve_genus
+    find_most_similar=args.similar_tax_method
+    dupl_action=args.duplicate_action
+    only_changes=args.only_changes
+    simple_output=args.simple_output
+    verbose=args.verbose
+    print('\n\n##### wcvp_taxo v0.5 ##### \nAuthor:   Kevin Leempoel \nLast update: 2021-03-25\n')
+    
+    print(wcvp_path, df_path, 'g:', resolve_genus, ' s:', find_most_similar, ' d:', dupl_action,
+      ' oc:', only_changes, ' os:', simple_output, ' v:', verbose)
+        
+    ## Loading and preparing data
+    print('\n\nLoading and preparing data')
+    span = start_span('wcvp_load')
+    wcvp = load_wcvp(wcvp_path)
+    end_span(span, rows_out=wcvp.shape[0])
+    smpl_df = load_df(df_path)
+    tables = resolve_names(smpl_df, wcvp, resolve_genus=resolve_genus, find_most_similar=find_most_similar,
+                           dupl_action=dupl_action, only_changes=only_changes, simple_output=simple_output,
+                           verbose=verbose)
+    for isuffix, itable in tables.items():
+        itable.to_csv(df_path.replace('.csv','_' + isuffix + '.csv'),index=False,encoding='utf-8')
         
     print('Done!')
 
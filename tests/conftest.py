@@ -0,0 +1,7 @@
+import os
+import sys
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for idir in ['Pipeline_Utils', 'Barcode_Validation', 'PAFTOL_GetOrganelle']:
+    sys.path.append(os.path.join(repo_dir, idir))
+os.environ['TELEMETRY_LOG'] = 'none'
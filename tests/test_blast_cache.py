@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import blast_cache
+
+
+def make_project(tmp_path):
+    (tmp_path / 'DB').mkdir()
+    (tmp_path / 'DB' / 'DB1.fasta').write_text('>L1\nACGT\n')
+    (tmp_path / 'P' / 'fasta_pt').mkdir(parents=True)
+    (tmp_path / 'P' / 'fasta_pt' / 'S1_pt.fasta').write_text('>q1\nACGTACGT\n')
+    (tmp_path / 'P' / 'Barcode_Validation').mkdir()
+    genes_df = pd.DataFrame({'Barcode': ['DB1', 'DB2'], 'type': ['cpDNA', 'rDNA'], 'blast_pid': [90, 90],
+                             'max_blast': [100, 100], 'min_len': [0, 0], 'min_cov': [0, 0]})
+    return genes_df, str(tmp_path / 'DB') + '/', str(tmp_path / 'P') + '/'
+
+
+def write_keys(project_dir, keys):
+    keys.to_csv(project_dir + 'Barcode_Validation/BV_S1.keys', index=False)
+
+
+def test_card_keys(tmp_path):
+    genes_df, db_dir, project_dir = make_project(tmp_path)
+    keys = blast_cache.card_keys('S1', genes_df, 'pt_nr', db_dir, project_dir)
+    assert keys.Barcode.tolist() == ['DB1', 'DB2'] and keys.key[0] != '' and keys.key[1] == ''
+    assert blast_cache.card_keys('S1', genes_df, 'pt_nr', db_dir, project_dir).equals(keys)
+    # missing taxonomy values are keyed as empty, not as nan
+    sample_keys = [blast_cache.card_keys('S1', genes_df, 'pt_nr', db_dir, project_dir, isample).key[0]
+                   for isample in [{'genus': 'Acacia', 'family': 'Fabaceae'}, {'genus': np.nan, 'family': 'Fabaceae'},
+                                   {'genus': '', 'family': 'Fabaceae'}]]
+    assert len({keys.key[0]} | set(sample_keys)) == 3 and sample_keys[1] == sample_keys[2]
+
+
+def test_stale_cards(tmp_path):
+    genes_df, db_dir, project_dir = make_project(tmp_path)
+    samples_df = pd.DataFrame({'Sample': ['S1'], 'genus': ['Acacia'], 'family': ['Fabaceae']})
+    assert blast_cache.stale_cards(['S1'], genes_df, 'pt_nr', db_dir, project_dir, samples_df) == []
+    write_keys(project_dir, blast_cache.card_keys('S1', genes_df, 'pt_nr', db_dir, project_dir,
+                                                  samples_df.iloc[0].to_dict()))
+    assert blast_cache.stale_cards(['S1'], genes_df, 'pt_nr', db_dir, project_dir, samples_df) == []
+    samples_df.loc[0, 'genus'] = 'Racosperma'
+    assert blast_cache.stale_cards(['S1'], genes_df, 'pt_nr', db_dir, project_dir, samples_df) == ['S1']
+    # keys follow the query fasta
+    write_keys(project_dir, blast_cache.card_keys('S1', genes_df, 'pt_nr', db_dir, project_dir))
+    assert blast_cache.stale_cards(['S1'], genes_df, 'pt_nr', db_dir, project_dir) == []
+    query_file = project_dir + 'fasta_pt/S1_pt.fasta'
+    with open(query_file, 'a') as fout:
+        fout.write('>q2\nTTTT\n')
+    assert blast_cache.stale_cards(['S1'], genes_df, 'pt_nr', db_dir, project_dir) == ['S1']
+
+
+def test_query_hash(tmp_path):
+    query_file = tmp_path / 'q.fasta'
+    query_file.write_text('>q1\nACGT\n')
+    ihash = blast_cache.query_hash(str(query_file))
+    assert ihash == blast_cache.file_hash(str(query_file))
+    query_file.write_text('>q1\nACGTACGT\n')
+    assert blast_cache.query_hash(str(query_file)) == blast_cache.file_hash(str(query_file)) != ihash
+
+
+def test_blast_key_params(tmp_path):
+    query_file, db_fasta = tmp_path / 'q.fasta', tmp_path / 'DB1.fasta'
+    query_file.write_text('>q1\nACGT\n'); db_fasta.write_text('>L1\nACGT\n')
+    ikey = blast_cache.blast_key(str(query_file), str(db_fasta), 90, 100)
+    assert blast_cache.blast_key(str(query_file), str(db_fasta), 90, 100, params={}) == ikey
+    assert blast_cache.blast_key(str(query_file), str(db_fasta), 90, 100, params={'kmer_min_shared': '5'}) != ikey
+    assert os.path.isfile(str(db_fasta) + '.sha256')
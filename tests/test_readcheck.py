@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+import GetOrg_readcheck as readcheck
+
+
+# References: Acacia and Mimosa (Fabaceae), Rosa (Rosaceae), a Poaceae without genus
+def make_db(tmp_path):
+    pd.DataFrame({'Barcode': ['DB1', 'DB2']}).to_csv(str(tmp_path / 'Barcode_Tests.csv'), index=False)
+    np.savez(str(tmp_path / 'DB1.kmer.npz'), hashes=np.array([1, 1, 2, 3, 4, 5, 6, 7], dtype=np.uint64),
+             ref_idx=np.array([0, 1, 0, 0, 2, 2, 1, 3]), family=np.array(['Fabaceae', 'Fabaceae', 'Rosaceae', 'Poaceae']),
+             genus=np.array(['Acacia', 'Mimosa', 'Rosa', '']), k=21, scale=1)
+    return str(tmp_path)
+
+
+def test_load_indexes(tmp_path):
+    indexes = readcheck.load_indexes(make_db(tmp_path))
+    assert list(indexes) == ['DB1']
+    index = indexes['DB1']
+    assert index['family_taxa'].tolist() == ['Fabaceae', 'Rosaceae', 'Poaceae']
+    assert index['family_hashes'].tolist() == [1, 2, 3, 4, 5, 6, 7]
+    assert index['genus_taxa'].tolist() == ['Acacia', 'Mimosa', 'Rosa']
+    assert index['genus_hashes'].tolist() == [1, 1, 2, 3, 4, 5, 6]
+    assert index['genus_hash_taxa'].tolist() == [0, 1, 0, 0, 2, 2, 1]
+    assert readcheck.db_families(make_db(tmp_path)) == {'Fabaceae', 'Rosaceae', 'Poaceae'}
+
+
+def test_assign_pairs(tmp_path):
+    index = readcheck.load_indexes(make_db(tmp_path))['DB1']
+    # pair 1 shares hash 1 with two Fabaceae references: one family hit; pair 2 is a tie; hash 8 is not indexed
+    pair_hashes = [[1, 2], [1], [3, 4], [4, 5, 6], [1, 6], [7, 8]]
+    pairs = np.concatenate([[ipair] * len(ihashes) for ipair, ihashes in enumerate(pair_hashes)])
+    hashes = np.concatenate(pair_hashes).astype(np.uint64)
+    assert readcheck.assign_pairs(pairs, hashes, index, 'family').tolist() == [2, 1, 0]
+    assert readcheck.assign_pairs(pairs, hashes, index, 'family', min_hits=1).tolist() == [3, 1, 1]
+    assert readcheck.assign_pairs(pairs, hashes, index, 'genus').tolist() == [1, 1, 1]
+    no_match = readcheck.assign_pairs(np.array([0]), np.array([8], dtype=np.uint64), index, 'family')
+    assert no_match.tolist() == [0, 0, 0]
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Barcode_Validation', 'Get_validation_cards.py')
+blast_line = 'q1\t{}\t{}\t500\t500\t500\t0\t0\t1\t500\t1\t500\t0\t{}\n'
+
+
+def make_project(tmp_path):
+    (tmp_path / 'Barcode_DB').mkdir()
+    (tmp_path / 'Barcode_DB' / 'Barcode_Tests.csv').write_text(
+        'Barcode,min_len,min_cov,type,max_blast,blast_pid\nDB1,0,0,cpDNA,100,90\n')
+    (tmp_path / 'Barcode_DB' / 'DB1_TAXO.csv').write_text(
+        'Locus,species,genus,family\nL1,Aca dea,Acacia,Fabaceae\nL2,Ros can,Rosa,Rosaceae\n')
+    (tmp_path / 'P' / 'out_blast').mkdir(parents=True)
+    (tmp_path / 'P' / 'Barcode_Validation').mkdir()
+    (tmp_path / 'P' / 'P_samples.csv').write_text('Sample,genus,family,species\nS1,Acacia,Fabaceae,Aca dea\n')
+    (tmp_path / 'P' / 'list.txt').write_text('S1\n')
+    (tmp_path / 'P' / 'out_blast' / 'S1-DB1.out').write_text(blast_line.format('L1', 99.0, 900) +
+                                                              blast_line.format('L2', 95.0, 800))
+    return tmp_path / 'P'
+
+
+def run_cards(project_dir):
+    cmd = [sys.executable, script, '--samples_list', 'list.txt', '--samples_file', 'P_samples.csv',
+           '--barcodes_table', '../Barcode_DB/Barcode_Tests.csv', '--blast_store', '../Blast_store/P']
+    proc = subprocess.run(cmd, cwd=str(project_dir), capture_output=True, text=True,
+                          env=dict(os.environ, TELEMETRY_LOG='none'))
+    assert proc.returncode == 0, proc.stdout + proc.stderr
+    card = pd.read_csv(str(project_dir / 'Barcode_Validation' / 'BV_S1.csv'))
+    return proc.stdout, card.set_index('tax_level')
+
+
+def test_store_cards(tmp_path):
+    project_dir = make_project(tmp_path)
+    out, card = run_cards(project_dir)
+    assert 'Blast store of DB1 out of date, 1 / 1 blast outputs ingested again' in out
+    assert card.loc['genus', 'Nmatch'] == 2 and card.loc['genus', 'match'] and card.loc['genus', 'Search'] == 'full'
+    out, card = run_cards(project_dir)
+    assert 'out of date' not in out and card.loc['genus', 'Nmatch'] == 2
+    # a blast output rewritten after ingestion is ingested again and the card follows it
+    blast_out = project_dir / 'out_blast' / 'S1-DB1.out'
+    blast_out.write_text(blast_line.format('L2', 99.0, 900))
+    st = os.stat(str(blast_out))
+    os.utime(str(blast_out), ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    out, card = run_cards(project_dir)
+    assert 'ingested again' in out
+    assert card.loc['genus', 'Nmatch'] == 1 and not card.loc['genus', 'match']
+    assert card.loc['family', 'best'] == 'Rosaceae'
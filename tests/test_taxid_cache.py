@@ -0,0 +1,39 @@
+import pandas as pd
+
+import taxid_cache
+
+
+def test_cache_name():
+    assert taxid_cache.wcvp_release('WCVP/wcvp_v5_jun_2021.pkl') == 'wcvp_v5_jun_2021'
+    assert taxid_cache.cache_name('wcvp_v5_jun_2021', '-g -d divert') == 'wcvp_v5_jun_2021_g_d_divert'
+
+
+def test_taxid_cache(tmp_path):
+    cache = taxid_cache.TaxidCache('wcvp_v5_jun_2021', '-g', str(tmp_path))
+    assert cache.missing(['11', 12, None, '11']) == ['11', '12']
+    taxid_names = pd.DataFrame({'TaxID': [11, 12, 12], 'sci_name': ['Racosperma dealbatum', 'Foo bar', 'Foo bar']})
+    resolved = pd.DataFrame({'Ini_sci_name': ['Racosperma dealbatum'], 'sci_name': ['Acacia dealbata'],
+                             'family': ['Fabaceae']})
+    assert cache.add(taxid_names, resolved).TaxID.tolist() == ['11', '12']
+    assert cache.missing(['11', '12', '13']) == ['13']
+    # unresolved TaxIDs are cached but not looked up
+    lookup = cache.lookup([11, 12])
+    assert lookup.TaxID.tolist() == ['11'] and lookup.sci_name.tolist() == ['Acacia dealbata']
+    assert 'Ini_sci_name' not in lookup.columns
+    cache.save()
+    assert cache.added.shape[0] == 0
+    assert taxid_cache.TaxidCache('wcvp_v5_jun_2021', '-g', str(tmp_path)).missing(['11', '12', '13']) == ['13']
+    assert taxid_cache.TaxidCache('wcvp_v5_jun_2021', '', str(tmp_path)).missing(['11']) == ['11']
+
+
+def test_save_merges_other_jobs(tmp_path):
+    names = pd.DataFrame({'TaxID': ['11', '13'], 'sci_name': ['Racosperma dealbatum', 'Rosa canina']})
+    resolved = pd.DataFrame({'Ini_sci_name': ['Racosperma dealbatum', 'Rosa canina'],
+                             'sci_name': ['Acacia dealbata', 'Rosa canina'], 'family': ['Fabaceae', 'Rosaceae']})
+    job1 = taxid_cache.TaxidCache('wcvp_v5_jun_2021', '', str(tmp_path))
+    job2 = taxid_cache.TaxidCache('wcvp_v5_jun_2021', '', str(tmp_path))
+    job1.add(names.iloc[:1], resolved); job2.add(names.iloc[1:], resolved)
+    job1.save(); job2.save()
+    cache = taxid_cache.TaxidCache('wcvp_v5_jun_2021', '', str(tmp_path))
+    assert sorted(cache.table.TaxID) == ['11', '13']
+    assert cache.lookup(['11', '13']).set_index('TaxID').family.to_dict() == {'11': 'Fabaceae', '13': 'Rosaceae'}
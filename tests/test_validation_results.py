@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+import Barcode_Validation_Results as bvr
+
+
+def results_row(taxo_in_db, Nmatch, match, rank_pid, rank_bsc):
+    return {'taxo_in_db': taxo_in_db, 'Nmatch': Nmatch, 'match': match, 'rank_pid': rank_pid, 'rank_bsc': rank_bsc}
+
+
+def test_classify_tests():
+    results_df = pd.DataFrame([results_row(True, 0, np.nan, np.nan, np.nan),
+                               results_row(np.nan, 0, np.nan, np.nan, np.nan),
+                               results_row(False, 3, False, 5, 5),
+                               results_row(True, 3, True, 1, 1),
+                               results_row(True, 3, True, 1, 2),
+                               results_row(True, 3, True, 2, 1),
+                               results_row(True, 3, True, 2, 2),
+                               results_row(True, 3, False, 2, 2)])
+    validation = bvr.classify_tests(results_df).Validation.tolist()
+    assert validation == ['No Blast match', 'No Blast match', 'Not in DB', 'Pass both', 'Pass pid', 'Pass bitscore',
+                          'Fail rank', 'Fail match']
+
+
+def test_summarize_and_decide():
+    samples_df = pd.DataFrame({'Sample': ['S1', 'S2', 'S3', 'S4']})
+    tests = [('S1', 'family', 'Pass both', 'Fabaceae'),
+             ('S2', 'family', 'Fail match', 'Rosaceae'), ('S2', 'family', 'Fail match', 'Rosaceae'),
+             ('S3', 'family', 'Pass pid', 'Poaceae'), ('S3', 'family', 'Fail match', 'Rosaceae'),
+             ('S3', 'family', 'Fail rank', 'Rosaceae'),
+             ('S4', 'family', 'Not in DB', 'Rosaceae'), ('S4', 'family', 'Fail match', 'Rosaceae')]
+    results_df = pd.DataFrame(tests, columns=['Sample', 'tax_level', 'Validation', 'best'])
+    samples_results = bvr.decide(bvr.summarize_samples(samples_df, results_df))
+    assert samples_results.NVfam.tolist() == [1, 2, 3, 1]
+    assert samples_results.VATfam.tolist() == [1, 0, 1, 0]
+    assert samples_results['best matching family'].tolist()[1:] == ['Rosaceae', 'Rosaceae', 'Rosaceae']
+    assert samples_results.Validation.tolist() == ['Confirmed', 'Rejected', 'Inconclusive', 'Inconclusive']
+    # no genus test: nothing to confirm or reject
+    assert samples_results.Validation_genus.tolist() == ['Inconclusive'] * 4